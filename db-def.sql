@@ -70,20 +70,195 @@ CREATE INDEX ruuvi_air_observations_recorded_brin ON ruuvi_air_observations USIN
 -- Electricity price table
 CREATE TABLE electricity_price (
        id SERIAL PRIMARY KEY,
-       start_time TIMESTAMP WITH TIME ZONE NOT NULL,
+       start_time TIMESTAMP WITH TIME ZONE UNIQUE NOT NULL,
        price REAL NOT NULL
 );
 
 -- Electricity price table for 15 minute resolution
 CREATE TABLE electricity_price_minute (
        id SERIAL PRIMARY KEY,
-       start_time TIMESTAMP WITH TIME ZONE NOT NULL,
+       start_time TIMESTAMP WITH TIME ZONE UNIQUE NOT NULL,
        price REAL NOT NULL
 );
 
 -- Electricity consumption table
 CREATE TABLE electricity_consumption (
        id SERIAL PRIMARY KEY,
-       time TIMESTAMP WITH TIME ZONE NOT NULL,
+       time TIMESTAMP WITH TIME ZONE UNIQUE NOT NULL,
        consumption REAL NOT NULL
 );
+
+-- Daily electricity consumption and cost rollup, days are in Helsinki time
+CREATE TABLE electricity_day_rollup (
+       day DATE PRIMARY KEY,
+       -- consumption in kWh
+       consumption REAL NOT NULL,
+       -- average spot price and number of prices, price is in cents / kWh
+       price_avg REAL,
+       price_count SMALLINT NOT NULL,
+       -- spot price and total cost with fees in euros
+       spot_cost REAL NOT NULL,
+       cost REAL NOT NULL,
+       updated TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+-- Monthly electricity consumption and cost rollup, month is the first day of month
+CREATE TABLE electricity_month_rollup (
+       month DATE PRIMARY KEY,
+       consumption REAL NOT NULL,
+       price_avg REAL,
+       spot_cost REAL NOT NULL,
+       cost REAL NOT NULL,
+       updated TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+-- Refreshes the daily rollup of the given day and the monthly rollup of its month.
+-- Fees are in euros, base fees are monthly and are divided evenly for all days
+-- of a month. The monthly rollup includes the base fees of the days which do not
+-- have a daily rollup.
+CREATE OR REPLACE FUNCTION refresh_electricity_rollup(rollup_day DATE,
+       contract_margin DOUBLE PRECISION, transfer_fee DOUBLE PRECISION,
+       tax DOUBLE PRECISION, contract_base_fee DOUBLE PRECISION,
+       transfer_base_fee DOUBLE PRECISION) RETURNS VOID AS $$
+DECLARE
+       day_start TIMESTAMP WITH TIME ZONE :=
+                 rollup_day::timestamp AT TIME ZONE 'Europe/Helsinki';
+       day_end TIMESTAMP WITH TIME ZONE :=
+               (rollup_day + 1)::timestamp AT TIME ZONE 'Europe/Helsinki';
+       month_start DATE := date_trunc('month', rollup_day)::date;
+       month_days INTEGER := (month_start + INTERVAL '1 month')::date - month_start;
+BEGIN
+       INSERT INTO electricity_day_rollup (day, consumption, price_avg, price_count,
+                                           spot_cost, cost)
+       SELECT rollup_day, COALESCE(c.consumption, 0), p.price_avg, p.price_count,
+              COALESCE(c.spot_cost, 0),
+              COALESCE(c.spot_cost, 0) +
+              COALESCE(c.consumption, 0) * (contract_margin + transfer_fee + tax) +
+              (contract_base_fee + transfer_base_fee) / month_days
+       FROM (SELECT SUM(ec.consumption) AS consumption,
+                    SUM(ec.consumption * ep.price) / 100 AS spot_cost
+             FROM electricity_consumption ec
+             LEFT JOIN electricity_price ep ON ep.start_time = ec.time
+             WHERE ec.time >= day_start AND ec.time < day_end) c,
+            (SELECT AVG(price) AS price_avg, COUNT(price) AS price_count
+             FROM electricity_price
+             WHERE start_time >= day_start AND start_time < day_end) p
+       ON CONFLICT (day) DO UPDATE
+       SET consumption = EXCLUDED.consumption, price_avg = EXCLUDED.price_avg,
+           price_count = EXCLUDED.price_count, spot_cost = EXCLUDED.spot_cost,
+           cost = EXCLUDED.cost, updated = CURRENT_TIMESTAMP;
+
+       INSERT INTO electricity_month_rollup (month, consumption, price_avg,
+                                             spot_cost, cost)
+       SELECT month_start, SUM(consumption),
+              SUM(price_avg * price_count) / NULLIF(SUM(price_count), 0),
+              SUM(spot_cost),
+              SUM(cost) + (contract_base_fee + transfer_base_fee) *
+              (month_days - COUNT(*)) / month_days
+       FROM electricity_day_rollup
+       WHERE day >= month_start AND day < month_start + month_days
+       ON CONFLICT (month) DO UPDATE
+       SET consumption = EXCLUDED.consumption, price_avg = EXCLUDED.price_avg,
+           spot_cost = EXCLUDED.spot_cost, cost = EXCLUDED.cost,
+           updated = CURRENT_TIMESTAMP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Daily electricity price index computed from 15 minute prices by the price
+-- storage script, days are in Helsinki time and prices in cents / kWh with VAT
+CREATE TABLE electricity_price_index (
+       day DATE PRIMARY KEY,
+       slot_count SMALLINT NOT NULL,
+       -- 10th, 25th, 50th, 75th and 90th price percentiles
+       percentiles REAL[] NOT NULL,
+       -- price rank of each slot in time order, the cheapest slot has rank 1
+       slot_ranks SMALLINT[] NOT NULL,
+       -- start times and average prices of the cheapest and most expensive
+       -- contiguous windows, the Nth element is for a window of N hours
+       cheapest_start TIMESTAMP WITH TIME ZONE[] NOT NULL,
+       cheapest_avg REAL[] NOT NULL,
+       expensive_start TIMESTAMP WITH TIME ZONE[] NOT NULL,
+       expensive_avg REAL[] NOT NULL,
+       updated TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+-- Data quality findings of the data quality scanner
+CREATE TABLE data_quality_findings (
+       id SERIAL PRIMARY KEY,
+       table_name VARCHAR(40) NOT NULL,
+       column_name VARCHAR(40) NOT NULL,
+       row_id INTEGER NOT NULL,
+       time TIMESTAMP WITH TIME ZONE NOT NULL,
+       -- name of the rule the value violates: range, rate or zscore
+       rule VARCHAR(10) NOT NULL,
+       value REAL,
+       detail TEXT,
+       found TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+CREATE INDEX data_quality_findings_table_time_idx
+       ON data_quality_findings (table_name, time);
+
+-- Fingerprints of the time chunks scanned by the data quality scanner, a chunk
+-- is scanned again when its fingerprint or the rules of its table change
+CREATE TABLE data_quality_chunks (
+       table_name VARCHAR(40) NOT NULL,
+       chunk_start TIMESTAMP WITH TIME ZONE NOT NULL,
+       row_count INTEGER NOT NULL,
+       max_id INTEGER NOT NULL,
+       max_xmin BIGINT NOT NULL,
+       rules_hash CHAR(64) NOT NULL,
+       scanned TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
+       PRIMARY KEY (table_name, chunk_start)
+);
+
+-- Downsampled RuuviTag observations per device with a resolution of 5, 60
+-- or 1440 minutes, daily buckets are days in Helsinki time
+CREATE TABLE ruuvitag_observations_rollup (
+       resolution SMALLINT NOT NULL,
+       name VARCHAR(15) NOT NULL,
+       bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+       sample_count INTEGER NOT NULL,
+       temperature_min REAL,
+       temperature_avg REAL,
+       temperature_max REAL,
+       humidity_min REAL,
+       humidity_avg REAL,
+       humidity_max REAL,
+       pressure_min REAL,
+       pressure_avg REAL,
+       pressure_max REAL,
+       PRIMARY KEY (resolution, name, bucket)
+);
+
+-- Downsampled Ruuvi Air observations per device with a resolution of 5, 60
+-- or 1440 minutes, daily buckets are days in Helsinki time
+CREATE TABLE ruuvi_air_observations_rollup (
+       resolution SMALLINT NOT NULL,
+       name VARCHAR(15) NOT NULL,
+       bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+       sample_count INTEGER NOT NULL,
+       co2_min REAL,
+       co2_avg REAL,
+       co2_max REAL,
+       nox_min REAL,
+       nox_avg REAL,
+       nox_max REAL,
+       voc_min REAL,
+       voc_avg REAL,
+       voc_max REAL,
+       pm_2_5_min REAL,
+       pm_2_5_avg REAL,
+       pm_2_5_max REAL,
+       iaqs_min REAL,
+       iaqs_avg REAL,
+       iaqs_max REAL,
+       PRIMARY KEY (resolution, name, bucket)
+);
+
+-- Last raw row IDs aggregated into the rollup tables
+CREATE TABLE rollup_watermarks (
+       source_table VARCHAR(40) PRIMARY KEY,
+       last_id INTEGER NOT NULL,
+       updated TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+"""A script for finding suspicious values in the env-logger database.
+
+Values are checked against per column rules: an allowed range, a maximum rate of
+change and a maximum robust z-score against a rolling median. Tables are split
+into time chunks which are scanned in parallel worker processes, the time range
+predicates of the chunks are served by the BRIN indexes of the time columns.
+Findings are stored into the data_quality_findings table and only chunks which
+have changed since the previous run are scanned again. Recent chunks are
+fingerprinted on every run while older chunks are only fingerprinted if they
+have received new rows.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import UTC, date, datetime, timedelta
+from os import cpu_count
+from statistics import median
+
+import psycopg
+
+from db_utils import create_db_conn_string, load_config
+
+logger = logging.getLogger(__name__)
+
+# Scannable tables and their time and sensor columns
+TABLES = {'observations': {'time': 'recorded', 'sensor': None},
+          'weather_data': {'time': 'time', 'sensor': None},
+          'ruuvitag_observations': {'time': 'recorded', 'sensor': 'name'},
+          'ruuvi_air_observations': {'time': 'recorded', 'sensor': 'name'},
+          'electricity_consumption': {'time': 'time', 'sensor': None}}
+# Origin of the chunk boundaries
+CHUNK_ORIGIN = datetime(2000, 1, 1, tzinfo=UTC)
+# Scale factor making the median absolute deviation comparable to the standard
+# deviation of normally distributed values
+MAD_SCALE = 1.4826
+
+# Database connection of a worker process
+connection = None
+
+
+def get_table_rules(config):
+    """Return the configured rules grouped by table.
+
+    Rules are configured as table.column keys. Exits if a rule refers to an
+    unsupported table or an invalid column name.
+    """
+    table_rules = {}
+
+    for key, rule in config['rules'].items():
+        table, _, column = key.partition('.')
+        if table not in TABLES or not column.isidentifier():
+            logger.error('Invalid rule "%s"', key)
+            sys.exit(1)
+        table_rules.setdefault(table, {})[column] = rule
+
+    return table_rules
+
+
+def get_rules_hash(rules, scan_config):
+    """Return a hash of the rules and scan settings of a table."""
+    return hashlib.sha256(json.dumps({'rules': rules, 'scan': scan_config},
+                                     sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def align_to_chunk(time, chunk_size):
+    """Return the start of the chunk the time belongs to."""
+    return CHUNK_ORIGIN + (time - CHUNK_ORIGIN) // chunk_size * chunk_size
+
+
+def get_chunk_fingerprints(cursor, table, chunk_size, since, after_id=None):
+    """Return the fingerprints of the time chunks of a table.
+
+    The fingerprint of a chunk is its row count, maximum ID and maximum
+    transaction ID of its rows, so inserts, deletes and updates all change it.
+    If an ID is given only the chunks having rows with a larger ID are included,
+    those are found with the primary key index instead of scanning the table.
+    """
+    time_column = TABLES[table]['time']
+    params = {'chunk_size': chunk_size, 'origin': CHUNK_ORIGIN, 'since': since,
+              'after_id': after_id}
+    if after_id is None:
+        cursor.execute(f"""
+        SELECT date_bin(%(chunk_size)s, {time_column}, %(origin)s) AS chunk_start,
+               COUNT(*), MAX(id), MAX(xmin::text::bigint)
+        FROM {table}
+        WHERE {time_column} >= %(since)s
+        GROUP BY chunk_start""",  # noqa: S608
+                       params)
+    else:
+        cursor.execute(f"""
+        WITH touched AS (
+            SELECT DISTINCT date_bin(%(chunk_size)s, {time_column}, %(origin)s)
+                AS chunk_start
+            FROM {table}
+            WHERE id > %(after_id)s AND {time_column} >= %(since)s
+        )
+        SELECT t.chunk_start, COUNT(*), MAX(r.id), MAX(r.xmin::text::bigint)
+        FROM touched t
+        JOIN {table} r ON r.{time_column} >= t.chunk_start
+                          AND r.{time_column} < t.chunk_start + %(chunk_size)s
+        GROUP BY t.chunk_start""",  # noqa: S608
+                       params)
+
+    return {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+
+
+def get_scanned_chunks(cursor, table, since):
+    """Return the fingerprints and rule hashes of the scanned chunks of a table."""
+    cursor.execute('SELECT chunk_start, row_count, max_id, max_xmin, rules_hash '
+                   'FROM data_quality_chunks '
+                   'WHERE table_name = %s AND chunk_start >= %s',
+                   (table, since))
+
+    return {row[0]: (tuple(row[1:4]), row[4]) for row in cursor.fetchall()}
+
+
+def get_changed_chunks(cursor, table, rules_hash, scan_config,  # noqa: PLR0913
+                       *, since, recheck_since):
+    """Return the start times of the chunks of a table which must be scanned.
+
+    Chunks from the recheck start time onwards are fingerprinted fully, older
+    chunks only if they have rows with an ID larger than the largest scanned ID.
+    When the scan start time is given, on the first scan and when the rules have
+    changed all chunks from the scan start time are fingerprinted fully instead.
+    Findings and scan records of fully fingerprinted chunks which no longer have
+    any rows are removed.
+    """
+    chunk_size = timedelta(hours=scan_config['chunk_hours'])
+    # Align the start times with chunk boundaries so that whole chunks are compared
+    scan_since = align_to_chunk(since or CHUNK_ORIGIN, chunk_size)
+    scanned = get_scanned_chunks(cursor, table, scan_since)
+
+    if any(chunk[1] != rules_hash for chunk in scanned.values()):
+        logger.info('Rules of table %s have changed, scanning all chunks', table)
+        cursor.execute('DELETE FROM data_quality_findings '
+                       'WHERE table_name = %s AND time >= %s', (table, scan_since))
+        cursor.execute('DELETE FROM data_quality_chunks '
+                       'WHERE table_name = %s AND chunk_start >= %s',
+                       (table, scan_since))
+        scanned = {}
+
+    if since or not scanned:
+        full_since = scan_since
+        current = get_chunk_fingerprints(cursor, table, chunk_size, full_since)
+    else:
+        full_since = max(scan_since, align_to_chunk(recheck_since, chunk_size))
+        current = get_chunk_fingerprints(cursor, table, chunk_size, full_since)
+        max_id = max(chunk[0][1] for chunk in scanned.values())
+        current.update(
+            (chunk_start, fingerprint)
+            for chunk_start, fingerprint in get_chunk_fingerprints(
+                cursor, table, chunk_size, scan_since, after_id=max_id).items()
+            if chunk_start < full_since)
+
+    for chunk_start in scanned.keys() - current.keys():
+        if chunk_start < full_since:
+            continue
+        cursor.execute('DELETE FROM data_quality_findings WHERE table_name = %s '
+                       'AND time >= %s AND time < %s',
+                       (table, chunk_start, chunk_start + chunk_size))
+        cursor.execute('DELETE FROM data_quality_chunks WHERE table_name = %s '
+                       'AND chunk_start = %s', (table, chunk_start))
+
+    return sorted((chunk_start, fingerprint)
+                  for chunk_start, fingerprint in current.items()
+                  if chunk_start not in scanned or
+                  scanned[chunk_start][0] != fingerprint)
+
+
+def check_value(value, time, previous, window, rule):
+    """Check a value against a rule.
+
+    The previous (time, value) tuple of the same sensor is used for the rate
+    check and the window of preceding values for the z-score check. Returns a
+    list of (rule name, detail) tuples of the violated rules.
+    """
+    violations = []
+
+    if ('min' in rule and value < rule['min']) or \
+       ('max' in rule and value > rule['max']):
+        violations.append(('range', (f'outside range [{rule.get("min")}, '
+                                     f'{rule.get("max")}]')))
+
+    if 'max_rate' in rule and previous and time > previous[0]:
+        rate = abs(value - previous[1]) / \
+            ((time - previous[0]).total_seconds() / 3600)
+        if rate > rule['max_rate']:
+            violations.append(('rate', (f'change of {rate:.2f} per hour from '
+                                        f'{previous[1]}')))
+
+    if 'zscore' in rule and len(window) == window.maxlen:
+        window_median = median(window)
+        mad = median(abs(item - window_median) for item in window)
+        zscore = (value - window_median) / (MAD_SCALE * mad) if mad > 0 else 0
+        if abs(zscore) > rule['zscore']:
+            violations.append(('zscore', (f'z-score {zscore:.1f} against median '
+                                          f'{window_median}')))
+
+    return violations
+
+
+def check_values(rows, index, rule, chunk_start, median_window):
+    """Check the values of one column against its rule.
+
+    Rows must be ordered by sensor and time, rows before the chunk start are only
+    used as context for the rate and z-score checks. Returns a list of (row ID,
+    time, rule name, value, detail) tuples.
+    """
+    findings = []
+    sensor = None
+    previous = None
+    window = deque(maxlen=median_window)
+
+    for row in rows:
+        row_id, time, value = row[0], row[1], row[index]
+        if row[2] != sensor:
+            sensor = row[2]
+            previous = None
+            window.clear()
+        if value is None:
+            continue
+
+        if time >= chunk_start:
+            findings.extend((row_id, time, name, value, detail) for name, detail
+                            in check_value(value, time, previous, window, rule))
+
+        previous = (time, value)
+        window.append(value)
+
+    return findings
+
+
+def init_worker(db_config):
+    """Open the database connection of a worker process."""
+    global connection  # noqa: PLW0603
+    connection = psycopg.connect(create_db_conn_string(db_config))
+
+
+def scan_chunk(table, rules, chunk_start, fingerprint, options):
+    """Scan a chunk of a table in a worker process.
+
+    The findings of the chunk are replaced and its fingerprint is recorded in a
+    single transaction. Returns the number of findings.
+    """
+    time_column = TABLES[table]['time']
+    sensor_column = TABLES[table]['sensor'] or "''"
+    columns = list(rules)
+    chunk_end = chunk_start + timedelta(hours=options['scan']['chunk_hours'])
+    findings = []
+
+    with connection.transaction(), connection.cursor() as cursor:
+        cursor.execute(f"""
+        SELECT id, {time_column}, {sensor_column}, {', '.join(columns)}
+        FROM {table}
+        WHERE {time_column} >= %s AND {time_column} < %s
+        ORDER BY 3, 2""",  # noqa: S608
+                       (chunk_start -
+                        timedelta(minutes=options['scan']['context_minutes']),
+                        chunk_end))
+        rows = cursor.fetchall()
+
+        for index, column in enumerate(columns, start=3):
+            findings.extend((table, column, *finding) for finding in
+                            check_values(rows, index, rules[column], chunk_start,
+                                         options['scan']['median_window']))
+
+        cursor.execute('DELETE FROM data_quality_findings WHERE table_name = %s '
+                       'AND time >= %s AND time < %s',
+                       (table, chunk_start, chunk_end))
+        with cursor.copy('COPY data_quality_findings (table_name, column_name, '
+                         'row_id, time, rule, value, detail) FROM STDIN') as copy:
+            for finding in findings:
+                copy.write_row(finding)
+        cursor.execute('INSERT INTO data_quality_chunks (table_name, chunk_start, '
+                       'row_count, max_id, max_xmin, rules_hash) '
+                       'VALUES (%s, %s, %s, %s, %s, %s) '
+                       'ON CONFLICT (table_name, chunk_start) DO UPDATE '
+                       'SET row_count = EXCLUDED.row_count, '
+                       'max_id = EXCLUDED.max_id, max_xmin = EXCLUDED.max_xmin, '
+                       'rules_hash = EXCLUDED.rules_hash, '
+                       'scanned = CURRENT_TIMESTAMP',
+                       (table, chunk_start, *fingerprint, options['rules_hash']))
+
+    return len(findings)
+
+
+def main():
+    """Run the module code."""
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Finds suspicious values in the '
+                                     'env-logger database.')
+    parser.add_argument('--config', type=str, help='configuration file to use')
+    parser.add_argument('--since', type=date.fromisoformat,
+                        help='only scan values from this date (in YYYY-MM-DD '
+                        'format) onwards, all chunks from it are checked for '
+                        'changes')
+    parser.add_argument('--recheck-days', type=int, default=7,
+                        help='number of days of chunks which are checked for '
+                        'updated and deleted rows, older chunks are only checked '
+                        'for new rows (default: 7)')
+    parser.add_argument('--workers', type=int, default=cpu_count(),
+                        help='number of worker processes (default: number of CPUs)')
+
+    args = parser.parse_args()
+    config = load_config(args.config or 'config.json')
+    scan_config = {'chunk_hours': 24, 'context_minutes': 120, 'median_window': 11,
+                   **config.get('scan', {})}
+    since = datetime(args.since.year, args.since.month, args.since.day,
+                     tzinfo=UTC) if args.since else None
+    recheck_since = datetime.now(tz=UTC) - timedelta(days=args.recheck_days)
+
+    tasks = []
+    try:
+        with psycopg.connect(create_db_conn_string(config['db'])) as conn, \
+             conn.cursor() as cursor:
+            for table, rules in get_table_rules(config).items():
+                rules_hash = get_rules_hash(rules, scan_config)
+                chunks = get_changed_chunks(cursor, table, rules_hash, scan_config,
+                                            since=since,
+                                            recheck_since=recheck_since)
+                logger.info('Found %s changed chunks in table %s', len(chunks),
+                            table)
+                tasks.extend((table, rules, chunk_start, fingerprint,
+                              {'scan': scan_config, 'rules_hash': rules_hash})
+                             for chunk_start, fingerprint in chunks)
+    except psycopg.Error:
+        logger.exception('Chunk change detection failed')
+        sys.exit(1)
+
+    failed_chunks = []
+    finding_count = 0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                             initargs=(config['db'],)) as executor:
+        futures = {executor.submit(scan_chunk, *task): task[:3] for task in tasks}
+        for future in as_completed(futures):
+            table, _, chunk_start = futures[future]
+            try:
+                finding_count += future.result()
+            except Exception:
+                logger.exception('Scan of table %s chunk %s failed', table,
+                                 chunk_start)
+                failed_chunks.append((table, chunk_start))
+
+    logger.info('Scanned %s chunks with %s findings', len(tasks) - len(failed_chunks),
+                finding_count)
+    if failed_chunks:
+        logger.error('Scanning failed for %s chunks', len(failed_chunks))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
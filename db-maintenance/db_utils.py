@@ -0,0 +1,46 @@
+"""Shared functions of the env-logger database maintenance tools."""
+
+import json
+import logging
+import sys
+from os import environ
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def load_config(config_file):
+    """Load the JSON configuration file.
+
+    Exits if the file does not exist.
+    """
+    if not Path(config_file).exists():
+        logger.error('Could not find configuration file "%s"', config_file)
+        sys.exit(1)
+
+    with Path(config_file).open('r', encoding='utf-8') as cfg_file:
+        return json.load(cfg_file)
+
+
+def create_db_conn_string(db_config):
+    """Create the database connection string."""
+    db_config = {
+        'host': environ['DB_HOST'] if 'DB_HOST' in environ else db_config['host'],
+        'name': environ['DB_NAME'] if 'DB_NAME' in environ else db_config['dbname'],
+        'username': environ['DB_USERNAME'] if 'DB_USERNAME' in environ
+        else db_config['username'],
+        'password': db_config.get('password', None)
+    }
+    if not db_config['password']:
+        password_file = environ.get('DB_PASSWORD_FILE', None)
+        if password_file:
+            with Path.open(password_file, 'r') as pw_file:
+                db_config['password'] = pw_file.readline().strip()
+        else:
+            logger.error('No database server password provided, exiting')
+            sys.exit(1)
+
+    return (
+        f'host={db_config["host"]} user={db_config["username"]} '
+        f'password={db_config["password"]} dbname={db_config["name"]}'
+    )
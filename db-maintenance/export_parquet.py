@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+"""A script for exporting env-logger data into Parquet files.
+
+Each table is exported into one Parquet file per month. Rows are streamed through
+a server-side cursor and written in fixed-size batches so memory use does not
+depend on the table size. A month is exported once a grace period has passed
+after its end, so that late arriving rows such as consumption and price updates
+are included. Exported months are recorded in a state file and later runs
+continue from the month after the last exported one.
+"""
+
+import argparse
+import json
+import logging
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+import psycopg
+import pyarrow as pa
+import pyarrow.parquet as pq
+from psycopg import sql
+
+from db_utils import create_db_conn_string, load_config
+
+logger = logging.getLogger(__name__)
+HELSINKI_TZ = ZoneInfo('Europe/Helsinki')
+
+# Exported tables and their time columns
+TABLES = {'observations': 'recorded',
+          'weather_data': 'time',
+          'ruuvitag_observations': 'recorded',
+          'ruuvi_air_observations': 'recorded',
+          'electricity_consumption': 'time',
+          'electricity_price': 'start_time',
+          'electricity_price_minute': 'start_time'}
+# Arrow types of PostgreSQL types by type OID, other types are exported as strings
+ARROW_TYPES = {16: pa.bool_(),
+               20: pa.int64(),
+               21: pa.int16(),
+               23: pa.int32(),
+               700: pa.float32(),
+               701: pa.float64(),
+               1082: pa.date32(),
+               1184: pa.timestamp('us', tz='UTC')}
+
+
+def get_schema(description):
+    """Return the Arrow schema of a query result description."""
+    return pa.schema([(column.name, ARROW_TYPES.get(column.type_code, pa.string()))
+                      for column in description])
+
+
+def add_month(month):
+    """Return the start of the month after the given month start."""
+    return month.replace(year=month.year + month.month // 12,
+                         month=month.month % 12 + 1)
+
+
+def get_month_start(time):
+    """Return the start of the month of the given time in Helsinki time."""
+    local_time = time.astimezone(HELSINKI_TZ)
+    return datetime(local_time.year, local_time.month, 1, tzinfo=HELSINKI_TZ)
+
+
+def export_month(conn, table, month, path, batch_size):
+    """Export the rows of a table in a month into a Parquet file.
+
+    The file is written under a temporary name and renamed when complete. Returns
+    the number of exported rows.
+    """
+    time_column = sql.Identifier(TABLES[table])
+    row_count = 0
+    tmp_path = path.with_suffix('.tmp')
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with conn.transaction(), \
+         conn.cursor(name=f'export_{table}') as cursor:
+        cursor.itersize = batch_size
+        cursor.execute(sql.SQL('SELECT * FROM {} WHERE {} >= %s AND {} < %s '
+                               'ORDER BY {}').format(sql.Identifier(table),
+                                                     time_column, time_column,
+                                                     time_column),
+                       (month, add_month(month)))
+        schema = get_schema(cursor.description)
+
+        with pq.ParquetWriter(tmp_path, schema, compression='zstd') as writer:
+            while rows := cursor.fetchmany(batch_size):
+                writer.write_batch(pa.RecordBatch.from_arrays(
+                    [pa.array([row[index] for row in rows], type=field.type)
+                     for index, field in enumerate(schema)], schema=schema))
+                row_count += len(rows)
+
+    tmp_path.replace(path)
+    return row_count
+
+
+def get_export_months(cursor, table, last_exported, grace_days):
+    """Return the complete months of a table which have not been exported.
+
+    Months start from the month after the last exported month or from the month
+    of the oldest row of the table. A month is complete once the given number of
+    days has passed since its end, the current month is never complete.
+    """
+    if last_exported:
+        month = add_month(datetime.strptime(last_exported, '%Y-%m')
+                          .replace(tzinfo=HELSINKI_TZ))
+    else:
+        cursor.execute(sql.SQL('SELECT MIN({}) FROM {}').format(
+            sql.Identifier(TABLES[table]), sql.Identifier(table)))
+        oldest = cursor.fetchone()[0]
+        if not oldest:
+            return []
+        month = get_month_start(oldest)
+
+    first_incomplete_month = get_month_start(datetime.now(tz=HELSINKI_TZ) -
+                                             timedelta(days=grace_days))
+    months = []
+    while month < first_incomplete_month:
+        months.append(month)
+        month = add_month(month)
+
+    return months
+
+
+def save_state(state_file, state):
+    """Save the export state atomically."""
+    tmp_file = state_file.with_suffix('.tmp')
+    with tmp_file.open('w', encoding='utf-8') as state_fd:
+        json.dump(state, state_fd, indent=2)
+    tmp_file.replace(state_file)
+
+
+def main():
+    """Run the module code."""
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Exports env-logger data into '
+                                     'monthly Parquet files.')
+    parser.add_argument('--config', type=str, help='configuration file to use')
+    parser.add_argument('--output', type=Path, default=Path('export'),
+                        help='output directory (default: export)')
+    parser.add_argument('--table', type=str, action='append', choices=list(TABLES),
+                        help='table to export, can be given many times '
+                        '(default: all tables)')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='number of rows fetched and written at once '
+                        '(default: 10000)')
+    parser.add_argument('--grace-days', type=int, default=7,
+                        help='number of days after the end of a month before it '
+                        'is exported, rows stored later are not exported '
+                        '(default: 7)')
+
+    args = parser.parse_args()
+    config = load_config(args.config or 'config.json')
+
+    state_file = args.output / 'export_state.json'
+    try:
+        with state_file.open('r', encoding='utf-8') as state_fd:
+            state = json.load(state_fd)
+    except FileNotFoundError:
+        state = {}
+    args.output.mkdir(parents=True, exist_ok=True)
+
+    try:
+        with psycopg.connect(create_db_conn_string(config['db']),
+                             autocommit=True) as conn:
+            conn.execute("SET TIME ZONE 'UTC'")
+            for table in args.table or TABLES:
+                with conn.cursor() as cursor:
+                    months = get_export_months(cursor, table, state.get(table),
+                                               args.grace_days)
+                for month in months:
+                    month_str = month.strftime('%Y-%m')
+                    row_count = export_month(
+                        conn, table, month,
+                        args.output / table / f'month={month_str}' /
+                        f'{table}_{month_str}.parquet',
+                        args.batch_size)
+                    state[table] = month_str
+                    save_state(state_file, state)
+                    logger.info('Exported %s rows of %s from %s', row_count, table,
+                                month_str)
+    except psycopg.Error:
+        logger.exception('Export failed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+"""A script for managing monthly partitions of high volume observation tables.
+
+Tables are migrated to tables partitioned by month on their time column, future
+partitions are created ahead of time and partitions older than the configured
+retention are detached, archived or dropped instead of deleting rows.
+"""
+
+import argparse
+import logging
+import sys
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+
+import psycopg
+from psycopg import sql
+
+from db_utils import create_db_conn_string, load_config
+
+logger = logging.getLogger(__name__)
+HELSINKI_TZ = ZoneInfo('Europe/Helsinki')
+
+# Partitionable tables and their time columns
+TABLES = {'ruuvitag_observations': 'recorded',
+          'ruuvi_air_observations': 'recorded'}
+# Reasons why other large tables can not be partitioned
+UNSUPPORTED_TABLES = {
+    'observations': 'its ID is referenced by the foreign keys of the beacons and '
+    'weather_data tables and a partitioned table can only have unique keys which '
+    'include the partition key',
+    'beacons': 'it has no time column to partition by'
+}
+# Schema into which archived partitions are moved
+ARCHIVE_SCHEMA = 'archive'
+# Retention actions for partitions older than the retention period
+RETENTION_ACTIONS = ('detach', 'archive', 'drop')
+
+
+def add_months(month, count):
+    """Return the first day of the month count months after the given month."""
+    month_index = month.year * 12 + month.month - 1 + count
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def get_partition_name(table, month):
+    """Return the name of the partition of a month."""
+    return f'{table}_p{month.year}{month.month:02}'
+
+
+def get_month_start(month):
+    """Return the start time of a month in Helsinki time."""
+    return datetime(month.year, month.month, 1, tzinfo=HELSINKI_TZ)
+
+
+def get_partitions(cursor, table):
+    """Return the months of the monthly partitions of a table.
+
+    Returns None if the table is not partitioned.
+    """
+    cursor.execute("SELECT relkind = 'p' FROM pg_class "
+                   'WHERE oid = to_regclass(%s)', (table,))
+    row = cursor.fetchone()
+    if not row or not row[0]:
+        return None
+
+    cursor.execute('SELECT c.relname FROM pg_inherits i '
+                   'JOIN pg_class c ON c.oid = i.inhrelid '
+                   'WHERE i.inhparent = %s::regclass', (table,))
+    months = []
+    for (name,) in cursor.fetchall():
+        try:
+            month = datetime.strptime(name.removeprefix(f'{table}_p'),
+                                      '%Y%m').replace(tzinfo=HELSINKI_TZ)
+        except ValueError:
+            # Not a monthly partition, e.g. the default partition
+            continue
+        months.append(month.date())
+
+    return sorted(months)
+
+
+def create_partition(cursor, table, month):
+    """Create the partition of a month.
+
+    Rows of the month in the default partition are moved into the new partition.
+    """
+    time_column = TABLES[table]
+    default = sql.Identifier(f'{table}_default')
+    month_range = (get_month_start(month), get_month_start(add_months(month, 1)))
+
+    cursor.execute(sql.SQL('SELECT EXISTS (SELECT 1 FROM {} WHERE {} >= %s AND '
+                           '{} < %s)').format(default, sql.Identifier(time_column),
+                                              sql.Identifier(time_column)),
+                   month_range)
+    has_default_rows = cursor.fetchone()[0]
+
+    if has_default_rows:
+        logger.info('Moving rows of %s from the default partition of %s',
+                    month, table)
+        cursor.execute(sql.SQL('ALTER TABLE {} DETACH PARTITION {}').format(
+            sql.Identifier(table), default))
+
+    cursor.execute(sql.SQL('CREATE TABLE {} PARTITION OF {} '
+                           'FOR VALUES FROM ({}) TO ({})').format(
+                               sql.Identifier(get_partition_name(table, month)),
+                               sql.Identifier(table),
+                               sql.Literal(month_range[0]),
+                               sql.Literal(month_range[1])))
+
+    if has_default_rows:
+        cursor.execute(sql.SQL('WITH moved AS (DELETE FROM {} WHERE {} >= %s AND '
+                               '{} < %s RETURNING *) '
+                               'INSERT INTO {} SELECT * FROM moved').format(
+                                   default, sql.Identifier(time_column),
+                                   sql.Identifier(time_column),
+                                   sql.Identifier(table)),
+                       month_range)
+        cursor.execute(sql.SQL('ALTER TABLE {} ATTACH PARTITION {} DEFAULT').format(
+            sql.Identifier(table), default))
+
+    logger.info('Created partition %s', get_partition_name(table, month))
+
+
+def convert_table(cursor, table):
+    """Replace a table with an empty partitioned table.
+
+    The original table is renamed with a _legacy suffix, the new table has the
+    same columns, defaults and constraints and uses the same ID sequence.
+    """
+    legacy = f'{table}_legacy'
+    time_column = TABLES[table]
+
+    cursor.execute(sql.SQL('LOCK TABLE {} IN ACCESS EXCLUSIVE MODE').format(
+        sql.Identifier(table)))
+    cursor.execute(sql.SQL('ALTER TABLE {} RENAME TO {}').format(
+        sql.Identifier(table), sql.Identifier(legacy)))
+    cursor.execute(sql.SQL('ALTER TABLE {} RENAME CONSTRAINT {} TO {}').format(
+        sql.Identifier(legacy), sql.Identifier(f'{table}_pkey'),
+        sql.Identifier(f'{legacy}_pkey')))
+    cursor.execute(sql.SQL('ALTER INDEX {} RENAME TO {}').format(
+        sql.Identifier(f'{table}_{time_column}_brin'),
+        sql.Identifier(f'{legacy}_{time_column}_brin')))
+
+    cursor.execute(sql.SQL('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS '
+                           'INCLUDING CONSTRAINTS, PRIMARY KEY (id, {})) '
+                           'PARTITION BY RANGE ({})').format(
+                               sql.Identifier(table), sql.Identifier(legacy),
+                               sql.Identifier(time_column),
+                               sql.Identifier(time_column)))
+    cursor.execute(sql.SQL('CREATE INDEX {} ON {} USING BRIN ({})').format(
+        sql.Identifier(f'{table}_{time_column}_brin'), sql.Identifier(table),
+        sql.Identifier(time_column)))
+    # The sequence would otherwise be dropped with the legacy table
+    cursor.execute(sql.SQL('ALTER SEQUENCE {} OWNED BY {}.id').format(
+        sql.Identifier(f'{table}_id_seq'), sql.Identifier(table)))
+    cursor.execute(sql.SQL('CREATE TABLE {} PARTITION OF {} DEFAULT').format(
+        sql.Identifier(f'{table}_default'), sql.Identifier(table)))
+
+
+def migrate_table(conn, table, months_ahead):
+    """Migrate a table to monthly partitions.
+
+    The table is first replaced with a partitioned table after which the rows of
+    the original table are moved one month per transaction, so new rows can be
+    inserted during the migration and an interrupted migration can be continued
+    by running it again.
+    """
+    legacy = f'{table}_legacy'
+    time_column = TABLES[table]
+
+    with conn.transaction(), conn.cursor() as cursor:
+        if get_partitions(cursor, table) is None:
+            logger.info('Converting table %s into a partitioned table', table)
+            convert_table(cursor, table)
+
+        cursor.execute('SELECT to_regclass(%s) IS NOT NULL', (legacy,))
+        if not cursor.fetchone()[0]:
+            logger.info('Table %s is already partitioned', table)
+            return
+
+    while True:
+        with conn.transaction(), conn.cursor() as cursor:
+            cursor.execute(sql.SQL('SELECT MIN({}) FROM {}').format(
+                sql.Identifier(time_column), sql.Identifier(legacy)))
+            oldest = cursor.fetchone()[0]
+            if not oldest:
+                cursor.execute(sql.SQL('DROP TABLE {}').format(
+                    sql.Identifier(legacy)))
+                break
+
+            local_oldest = oldest.astimezone(HELSINKI_TZ)
+            month = date(local_oldest.year, local_oldest.month, 1)
+            if month not in get_partitions(cursor, table):
+                create_partition(cursor, table, month)
+
+            cursor.execute(sql.SQL('WITH moved AS (DELETE FROM {} WHERE {} < %s '
+                                   'RETURNING *) '
+                                   'INSERT INTO {} SELECT * FROM moved').format(
+                                       sql.Identifier(legacy),
+                                       sql.Identifier(time_column),
+                                       sql.Identifier(table)),
+                           (get_month_start(add_months(month, 1)),))
+            logger.info('Moved %s rows of %s into table %s', cursor.rowcount,
+                        month.strftime('%Y-%m'), table)
+
+    create_future_partitions(conn, table, months_ahead)
+    logger.info('Migration of table %s is complete', table)
+
+
+def create_future_partitions(conn, table, months_ahead):
+    """Create the partitions of the current month and the given months ahead."""
+    today = datetime.now(tz=HELSINKI_TZ).date()
+    current_month = date(today.year, today.month, 1)
+
+    with conn.transaction(), conn.cursor() as cursor:
+        partitions = get_partitions(cursor, table)
+        for count in range(months_ahead + 1):
+            month = add_months(current_month, count)
+            if month not in partitions:
+                create_partition(cursor, table, month)
+
+
+def apply_retention(conn, table, retention_months, action):
+    """Detach, archive or drop the partitions older than the retention period.
+
+    Detached partitions are kept as standalone tables and archived partitions are
+    additionally moved into the archive schema.
+    """
+    today = datetime.now(tz=HELSINKI_TZ).date()
+    oldest_kept = add_months(date(today.year, today.month, 1), -retention_months)
+
+    with conn.transaction(), conn.cursor() as cursor:
+        for month in get_partitions(cursor, table):
+            if month >= oldest_kept:
+                break
+
+            partition = sql.Identifier(get_partition_name(table, month))
+            cursor.execute(sql.SQL('ALTER TABLE {} DETACH PARTITION {}').format(
+                sql.Identifier(table), partition))
+            if action == 'archive':
+                cursor.execute(sql.SQL('CREATE SCHEMA IF NOT EXISTS {}').format(
+                    sql.Identifier(ARCHIVE_SCHEMA)))
+                cursor.execute(sql.SQL('ALTER TABLE {} SET SCHEMA {}').format(
+                    partition, sql.Identifier(ARCHIVE_SCHEMA)))
+            elif action == 'drop':
+                cursor.execute(sql.SQL('DROP TABLE {}').format(partition))
+
+            logger.info('Applied retention action %s to partition %s', action,
+                        get_partition_name(table, month))
+
+
+def get_table_config(config, table):
+    """Return the partition configuration of a table.
+
+    Exits if partitioning of the table is not supported.
+    """
+    if table in UNSUPPORTED_TABLES:
+        logger.error('Table %s can not be partitioned because %s', table,
+                     UNSUPPORTED_TABLES[table])
+        sys.exit(1)
+    if table not in TABLES:
+        logger.error('Partitioning of table %s is not supported', table)
+        sys.exit(1)
+
+    table_config = config['partitions']['tables'].get(table, {})
+    if table_config.get('retention_action', 'detach') not in RETENTION_ACTIONS:
+        logger.error('Invalid retention action for table %s', table)
+        sys.exit(1)
+
+    return table_config
+
+
+def main():
+    """Run the module code."""
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Manages monthly partitions of '
+                                     'env-logger observation tables.')
+    parser.add_argument('--config', type=str, help='configuration file to use')
+    parser.add_argument('command', choices=['migrate', 'maintain'],
+                        help='migrate: convert tables into partitioned tables, '
+                        'maintain: create future partitions and apply retention')
+    parser.add_argument('--table', type=str, action='append',
+                        help='table to process, can be given many times '
+                        '(default: all configured tables)')
+
+    args = parser.parse_args()
+    config = load_config(args.config or 'config.json')
+    months_ahead = config['partitions'].get('months_ahead', 3)
+    tables = args.table or list(config['partitions']['tables'])
+    table_configs = {table: get_table_config(config, table) for table in tables}
+
+    try:
+        with psycopg.connect(create_db_conn_string(config['db']),
+                             autocommit=True) as conn:
+            for table, table_config in table_configs.items():
+                if args.command == 'migrate':
+                    migrate_table(conn, table, months_ahead)
+                    continue
+
+                with conn.cursor() as cursor:
+                    if get_partitions(cursor, table) is None:
+                        logger.error('Table %s is not partitioned, run the migrate '
+                                     'command first', table)
+                        sys.exit(1)
+
+                create_future_partitions(conn, table, months_ahead)
+                if table_config.get('retention_months'):
+                    apply_retention(conn, table, table_config['retention_months'],
+                                    table_config.get('retention_action', 'detach'))
+    except psycopg.Error:
+        logger.exception('Partition management failed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""A script for maintaining downsampled RuuviTag and Ruuvi Air observations.
+
+The minimum, average and maximum values of each device are stored for 5 minute,
+hourly and daily buckets. The ID of the last aggregated raw row is stored as a
+watermark so that each run only processes new rows, the buckets those rows fall
+into are recomputed from the raw rows. The watermark is only advanced past rows
+whose writing transactions have all finished so that rows committed late with a
+lower ID are not skipped.
+"""
+
+import argparse
+import logging
+import sys
+from time import monotonic, sleep
+
+import psycopg
+
+from db_utils import create_db_conn_string, load_config
+
+logger = logging.getLogger(__name__)
+
+# Source tables and their aggregated value columns
+SOURCES = {'ruuvitag_observations': ('temperature', 'humidity', 'pressure'),
+           'ruuvi_air_observations': ('co2', 'nox', 'voc', 'pm_2_5', 'iaqs')}
+# Bucket expressions of the rollup resolutions in minutes
+RESOLUTIONS = {
+    5: "date_bin('5 minutes', recorded, TIMESTAMPTZ '2000-01-01 00:00:00+00')",
+    60: "date_trunc('hour', recorded, 'Europe/Helsinki')",
+    1440: "date_trunc('day', recorded, 'Europe/Helsinki')"
+}
+# Maximum time in seconds to wait for running transactions to finish
+COMMIT_WAIT_TIMEOUT = 60
+
+
+def get_watermark(cursor, table):
+    """Return the ID of the last aggregated row of a table."""
+    cursor.execute('SELECT last_id FROM rollup_watermarks WHERE source_table = %s',
+                   (table,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def get_committed_max_id(conn, table):
+    """Return the largest ID of a table below which no rows are left to commit.
+
+    IDs are assigned when rows are inserted but the rows become visible only when
+    their transaction commits, so a row with a lower ID can appear after a higher
+    ID has been seen. The largest ID is therefore returned only after every
+    transaction running when it was read has finished. None is returned if they
+    do not finish within the wait timeout.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f'SELECT MAX(id) FROM {table}')  # noqa: S608
+        max_id = cursor.fetchone()[0] or 0
+        cursor.execute('SELECT pg_snapshot_xmax(pg_current_snapshot())::text')
+        xmax = cursor.fetchone()[0]
+
+        deadline = monotonic() + COMMIT_WAIT_TIMEOUT
+        while True:
+            cursor.execute('SELECT pg_snapshot_xmin(pg_current_snapshot()) >= '
+                           '%s::xid8', (xmax,))
+            if cursor.fetchone()[0]:
+                return max_id
+            if monotonic() >= deadline:
+                return None
+            sleep(1)
+
+
+def refresh_buckets(cursor, table, resolution, id_range):
+    """Recompute the buckets of a resolution containing the rows in the ID range.
+
+    Returns the number of refreshed buckets.
+    """
+    bucket = RESOLUTIONS[resolution]
+    aggregates = ', '.join(f'MIN({column}), AVG({column}), MAX({column})'
+                           for column in SOURCES[table])
+    rollup_columns = ', '.join(f'{column}_{function}'
+                               for column in SOURCES[table]
+                               for function in ('min', 'avg', 'max'))
+    updates = ', '.join(f'{column}_{function} = EXCLUDED.{column}_{function}'
+                        for column in SOURCES[table]
+                        for function in ('min', 'avg', 'max'))
+
+    cursor.execute(f"""
+    WITH affected AS (
+        SELECT DISTINCT name, {bucket} AS bucket
+        FROM {table}
+        WHERE id > %(first_id)s AND id <= %(last_id)s
+    ), bounds AS (
+        SELECT MIN(bucket) AS first_bucket,
+               MAX(bucket) + INTERVAL '1 day' + INTERVAL '1 hour' AS bucket_end
+        FROM affected
+    )
+    INSERT INTO {table}_rollup (resolution, name, bucket, sample_count,
+                                {rollup_columns})
+    SELECT %(resolution)s, r.name, {bucket} AS bucket, COUNT(*), {aggregates}
+    FROM {table} r, bounds
+    WHERE r.recorded >= bounds.first_bucket AND r.recorded < bounds.bucket_end
+          AND (r.name, {bucket}) IN (SELECT name, bucket FROM affected)
+    GROUP BY r.name, 3
+    ON CONFLICT (resolution, name, bucket) DO UPDATE
+    SET sample_count = EXCLUDED.sample_count, {updates}""",  # noqa: S608
+                   {'first_id': id_range[0], 'last_id': id_range[1],
+                    'resolution': resolution})
+    return cursor.rowcount
+
+
+def rollup_table(conn, table, batch_size):
+    """Aggregate the new rows of a table into its rollup tables.
+
+    Rows are processed in ID batches, each batch and the advanced watermark are
+    committed together so an interrupted run continues from the last batch. Rows
+    of transactions which are still running are left for the next run.
+    """
+    max_id = get_committed_max_id(conn, table)
+    if max_id is None:
+        logger.warning('Transactions writing to %s did not finish in %s seconds, '
+                       'skipping it in this run', table, COMMIT_WAIT_TIMEOUT)
+        return
+
+    while True:
+        with conn.transaction(), conn.cursor() as cursor:
+            watermark = get_watermark(cursor, table)
+            if watermark >= max_id:
+                break
+
+            id_range = (watermark, min(watermark + batch_size, max_id))
+            counts = [refresh_buckets(cursor, table, resolution, id_range)
+                      for resolution in RESOLUTIONS]
+            cursor.execute('INSERT INTO rollup_watermarks (source_table, last_id) '
+                           'VALUES (%s, %s) ON CONFLICT (source_table) DO UPDATE '
+                           'SET last_id = EXCLUDED.last_id, '
+                           'updated = CURRENT_TIMESTAMP', (table, id_range[1]))
+            logger.info('Aggregated %s rows up to ID %s, refreshed %s buckets', table,
+                        id_range[1], ', '.join(
+                            f'{count} {resolution} minute'
+                            for resolution, count in zip(RESOLUTIONS, counts,
+                                                         strict=True)))
+
+
+def reset_rollups(conn, table):
+    """Remove the rollups and watermark of a table so that they are rebuilt."""
+    with conn.transaction(), conn.cursor() as cursor:
+        cursor.execute(f'TRUNCATE {table}_rollup')
+        cursor.execute('DELETE FROM rollup_watermarks WHERE source_table = %s',
+                       (table,))
+    logger.info('Removed the rollups of %s', table)
+
+
+def main():
+    """Run the module code."""
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Aggregates RuuviTag and Ruuvi Air '
+                                     'observations into downsampled rollup tables.')
+    parser.add_argument('--config', type=str, help='configuration file to use')
+    parser.add_argument('--batch-size', type=int, default=50000,
+                        help='number of raw row IDs aggregated per transaction '
+                        '(default: 50000)')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='remove the existing rollups and rebuild them from '
+                        'all raw rows')
+
+    args = parser.parse_args()
+    config = load_config(args.config or 'config.json')
+
+    try:
+        with psycopg.connect(create_db_conn_string(config['db']),
+                             autocommit=True) as conn:
+            for table in SOURCES:
+                if args.rebuild:
+                    reset_rollups(conn, table)
+                rollup_table(conn, table, args.batch_size)
+    except psycopg.Error:
+        logger.exception('Rollup update failed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,12 +6,20 @@ The fetched data is stored into a PostgreSQL database.
 """
 
 import argparse
+import base64
+import gzip
+import hashlib
 import json
 import logging
+import os
 import sys
-from datetime import datetime, timedelta
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from datetime import UTC, date, datetime, timedelta
 from os import environ
 from pathlib import Path
+from time import monotonic, sleep
 from zoneinfo import ZoneInfo
 
 import psycopg
@@ -42,74 +50,313 @@ def check_day_data(db_config, check_date):
         sys.exit(1)
 
 
-def login_to_carunaplus(config):
-    """Log in to the Caruna+ service."""
-    logger.info('Logging in to Caruna+')
+class CarunaSession:
+    """Class for a Caruna+ session shared by the fetch workers.
 
-    password = config.get('password', None)
-    if not password:
-        password_file = environ.get('CARUNA_PASSWORD_FILE', None)
-        if password_file:
-            with Path.open(password_file, 'r') as pw_file:
-                password = pw_file.readline().strip()
-        else:
-            logger.error('No Caruna password provided, exiting')
+    The token, customer number and asset ID of a login are stored in a session
+    file and reused until the token expires. A full login is made only when there
+    is no valid stored session or the API rejects the stored token.
+    """
+
+    # Time in seconds before token expiry after which a stored session is not used
+    EXPIRY_MARGIN = 60
+
+    def __init__(self, config, session_file):
+        """Class constructor."""
+        self._config = config
+        self._session_file = Path(session_file)
+        self._lock = threading.Lock()
+        self.client = None
+        self.customer_id = None
+        self.asset_id = None
+
+    def open(self):
+        """Open the session by restoring a stored session or logging in."""
+        if not self.restore():
+            self.login()
+
+    def restore(self):
+        """Restore the stored session.
+
+        Returns True if a stored session that has not expired was found and False
+        otherwise.
+        """
+        try:
+            with self._session_file.open('r', encoding='utf-8') as session_file:
+                session = json.load(session_file)
+        except (FileNotFoundError, ValueError):
+            return False
+
+        if session['expires'] and session['expires'] - self.EXPIRY_MARGIN < \
+           datetime.now(tz=UTC).timestamp():
+            logger.info('Stored Caruna+ session has expired')
+            return False
+
+        logger.info('Using stored Caruna+ session')
+        self.client = CarunaPlus(session['token'])
+        self.customer_id = session['customer_id']
+        self.asset_id = session['asset_id']
+        return True
+
+    def login(self):
+        """Log in to the Caruna+ service and store the session."""
+        logger.info('Logging in to Caruna+')
+
+        password = self._config.get('password', None)
+        if not password:
+            password_file = environ.get('CARUNA_PASSWORD_FILE', None)
+            if password_file:
+                with Path.open(password_file, 'r') as pw_file:
+                    password = pw_file.readline().strip()
+            else:
+                logger.error('No Caruna password provided, exiting')
+                sys.exit(1)
+
+        authenticator = Authenticator(self._config['username'], password)
+        try:
+            login_result = authenticator.login()
+        except Exception:
+            logger.exception('Login failed')
+            sys.exit(1)
+
+        token = login_result['token']
+        customer_id = login_result['user']['ownCustomerNumbers'][0]
+
+        client = CarunaPlus(token)
+
+        metering_points = client.get_assets(customer_id)
+        if len(metering_points) == 0 or not metering_points[0]:
+            logger.error('No metering points found')
+            sys.exit(1)
+        if 'assetId' not in metering_points[0]:
+            logger.error('Asset ID not found in metering point')
             sys.exit(1)
 
-    authenticator = Authenticator(config['username'], password)
+        self.client = client
+        self.customer_id = customer_id
+        self.asset_id = metering_points[0]['assetId']
+        self.store(token)
+
+    def store(self, token):
+        """Store the session into the session file readable only by the user."""
+        session = {'token': token,
+                   'customer_id': self.customer_id,
+                   'asset_id': self.asset_id,
+                   'expires': get_token_expiry(token)}
+
+        self._session_file.unlink(missing_ok=True)
+        fd = os.open(self._session_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as session_file:
+            json.dump(session, session_file)
+
+    def get_energy(self, timespan, fetch_date):
+        """Return the energy consumption of the asset for a date.
+
+        Logs in again and retries once if the API rejects the request. Raises a
+        ValueError if the retried request is rejected too.
+        """
+        client = self.client
+        result = self._request_energy(client, timespan, fetch_date)
+        if result is not None:
+            return result
+
+        logger.warning('Caruna+ API rejected the request for %s, logging in again',
+                       fetch_date)
+        with self._lock:
+            # Another worker may have already logged in again
+            if self.client is client:
+                self.login()
+
+        result = self._request_energy(self.client, timespan, fetch_date)
+        if result is None:
+            msg = f'Caruna+ API rejected the retried request for {fetch_date}'
+            raise ValueError(msg)
+        return result
+
+    def _request_energy(self, client, timespan, fetch_date):
+        """Request the energy consumption of the asset for a date.
+
+        None is returned if the response is not a list of consumption values.
+        """
+        try:
+            result = client.get_energy(self.customer_id, self.asset_id, timespan,
+                                       fetch_date.year, fetch_date.month,
+                                       fetch_date.day)
+        except ValueError:
+            # The response was not JSON which is the case for some auth errors
+            return None
+
+        return result if isinstance(result, list) else None
+
+
+def get_token_expiry(token):
+    """Return the expiry time of a JWT token as a Unix timestamp.
+
+    None is returned if the expiry time cannot be read from the token.
+    """
     try:
-        login_result = authenticator.login()
-    except Exception:
-        logger.exception('Login failed')
-        sys.exit(1)
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))['exp']
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
 
-    token = login_result['token']
-    customer_id = login_result['user']['ownCustomerNumbers'][0]
 
-    client = CarunaPlus(token)
+class RateLimiter:
+    """Class for limiting the rate of requests made from many threads."""
 
-    metering_points = client.get_assets(customer_id)
-    if len(metering_points) == 0 or not metering_points[0]:
-        logger.error('No metering points found')
-        sys.exit(1)
-    if 'assetId' not in metering_points[0]:
-        logger.error('Asset ID not found in metering point')
-        sys.exit(1)
+    def __init__(self, rate):
+        """Class constructor.
 
-    asset_id = metering_points[0]['assetId']
+        The rate is given as requests per second, a zero rate disables limiting.
+        """
+        self._interval = 1 / rate if rate > 0 else 0
+        self._lock = threading.Lock()
+        self._next_time = monotonic()
 
-    return (client, customer_id, asset_id)
+    def wait(self):
+        """Wait until the next request is allowed."""
+        with self._lock:
+            now = monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self._interval
 
+        if wait_time > 0:
+            sleep(wait_time)
 
-def fetch_consumption_data(login_data, manual_fetch_date=None):
-    """Fetch electricity consumption data from the Caruna API.
 
-    By default data for the previous day is fetched.
+class ResponseCache:
+    """Class for caching raw Caruna API responses on disk.
+
+    Responses are stored compressed in files named by the hash of the asset ID,
+    time span and date. Responses fetched when their day was older than the given
+    number of days are never refetched while other responses expire after the
+    given maximum age, so a provisional response fetched soon after its day is
+    not kept forever. In offline mode responses never expire.
     """
-    if not manual_fetch_date:
-        fetch_date = datetime.now(tz=HELSINKI_TZ).date() - timedelta(days=1)
-    else:
-        try:
-            fetch_dt = datetime.strptime(manual_fetch_date, '%Y-%m-%d').replace(
-                tzinfo=HELSINKI_TZ)
-        except ValueError:
-            logger.exception('Invalid date provided')
-            sys.exit(1)
 
-        fetch_date = fetch_dt.date()
+    def __init__(self, directory, max_age, immutable_days, offline=False):
+        """Class constructor."""
+        self._directory = Path(directory)
+        self._max_age = max_age
+        self._immutable_days = immutable_days
+        self.offline = offline
+
+    def _get_path(self, asset_id, timespan, fetch_date):
+        """Return the cache file path of a response."""
+        key = f'{asset_id}:{timespan.value}:{fetch_date.isoformat()}'
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return self._directory / digest[:2] / f'{digest}.json.gz'
+
+    def get(self, asset_id, timespan, fetch_date):
+        """Return a cached response or None if there is no fresh response."""
+        path = self._get_path(asset_id, timespan, fetch_date)
+        if not path.exists():
+            return None
+
+        fetched = path.stat().st_mtime
+        immutable_from = datetime(fetch_date.year, fetch_date.month, fetch_date.day,
+                                  tzinfo=HELSINKI_TZ) + \
+            timedelta(days=self._immutable_days + 1)
+        if not self.offline and fetched < immutable_from.timestamp() and \
+           datetime.now(tz=UTC).timestamp() - fetched > \
+           self._max_age.total_seconds():
+            return None
+
+        with gzip.open(path, 'rt', encoding='utf-8') as cache_file:
+            return json.load(cache_file)
+
+    def put(self, asset_id, timespan, fetch_date, response):
+        """Store a response into the cache."""
+        path = self._get_path(asset_id, timespan, fetch_date)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write into a temporary file first so that a partial file is never read
+        tmp_path = path.with_suffix('.tmp')
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as cache_file:
+            json.dump(response, cache_file)
+        tmp_path.replace(path)
+
+    def get_asset_id(self):
+        """Return the asset ID of the latest login or None if it is not known."""
+        path = self._directory / 'asset_id'
+        return path.read_text(encoding='utf-8').strip() if path.exists() else None
+
+    def set_asset_id(self, asset_id):
+        """Store the asset ID of a login for use in offline mode."""
+        self._directory.mkdir(parents=True, exist_ok=True)
+        (self._directory / 'asset_id').write_text(str(asset_id), encoding='utf-8')
+
+
+def create_cache(args, config):
+    """Create the response cache based on the configuration.
+
+    Returns None if caching is disabled.
+    """
+    if args.no_cache:
+        return None
+
+    cache_config = config.get('cache', {})
+    return ResponseCache(cache_config.get('directory', 'cache'),
+                         timedelta(hours=cache_config.get('max_age_hours', 6)),
+                         cache_config.get('immutable_days', 7),
+                         args.offline)
+
+
+def parse_date(date_str):
+    """Parse a date in the YYYY-MM-DD format.
+
+    Exits if the date is not valid.
+    """
+    try:
+        return datetime.strptime(date_str, '%Y-%m-%d').replace(
+            tzinfo=HELSINKI_TZ).date()
+    except ValueError:
+        logger.exception('Invalid date provided')
+        sys.exit(1)
+
 
+def get_raw_consumption(session, fetch_date, cache=None, rate_limiter=None):
+    """Return the raw consumption data of a date.
+
+    A cached response is used when available, otherwise the data is fetched from
+    the Caruna API. Raises a ValueError if there is no cached response in offline
+    mode.
+    """
+    asset_id = session.asset_id
+
+    if cache:
+        raw_consumption = cache.get(asset_id, TimeSpan.DAILY, fetch_date)
+        if raw_consumption is not None:
+            logger.info('Using cached consumption data for %s', fetch_date)
+            return raw_consumption
+        if cache.offline:
+            msg = f'No cached consumption data for {fetch_date}'
+            raise ValueError(msg)
+
+    if rate_limiter:
+        rate_limiter.wait()
     logger.info('Fetching consumption data for %s', fetch_date)
 
-    raw_consumption = login_data[0].get_energy(login_data[1], login_data[2],
-                                               TimeSpan.DAILY, fetch_date.year,
-                                               fetch_date.month, fetch_date.day)
+    raw_consumption = session.get_energy(TimeSpan.DAILY, fetch_date)
+    if cache:
+        cache.put(asset_id, TimeSpan.DAILY, fetch_date, raw_consumption)
+
+    return raw_consumption
+
+
+def fetch_consumption_data(session, fetch_date, cache=None, rate_limiter=None):
+    """Fetch electricity consumption data for a date.
+
+    Raises a ValueError if a consumption value is missing from the data.
+    """
+    raw_consumption = get_raw_consumption(session, fetch_date, cache, rate_limiter)
     consumption = []
     for point in raw_consumption:
         if 'invoicedConsumption' in point:
             if point['invoicedConsumption'] is None:
-                logger.error('Got a None value for consumption at %s, exiting',
-                             point['timestamp'])
-                sys.exit(1)
+                msg = f'Got a None value for consumption at {point["timestamp"]}'
+                raise ValueError(msg)
 
             consumption.append({'time': point['timestamp'],
                                 'consumption': point['invoicedConsumption']})
@@ -117,22 +364,53 @@ def fetch_consumption_data(login_data, manual_fetch_date=None):
     return consumption
 
 
-def store_consumption(db_config, consumption_data):
-    """Store consumption data to a database pointed by the DB config."""
-    insert_query = (
-        'INSERT INTO electricity_consumption (time, consumption) '
-        'VALUES (%s, %s)'
-    )
+def upsert_consumption(cursor, consumption_data):
+    """Upsert consumption data with the given cursor.
 
-    try:
-        with psycopg.connect(create_db_conn_string(db_config)) as conn, \
-             conn.cursor() as cursor:
-            for point in consumption_data:
-                cursor.execute(insert_query, (point['time'],
-                                              point['consumption']))
-    except psycopg.Error:
-        logger.exception('Data insert failed')
-        sys.exit(1)
+    The data is copied into a temporary staging table and merged from there into
+    the consumption table. Existing values are updated so that storing the same
+    data again does not create duplicate rows. Returns the number of upserted
+    rows.
+    """
+    cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS consumption_staging '
+                   '(time TIMESTAMP WITH TIME ZONE NOT NULL, '
+                   'consumption REAL NOT NULL) ON COMMIT DELETE ROWS')
+
+    with cursor.copy('COPY consumption_staging (time, consumption) '
+                     'FROM STDIN') as copy:
+        for point in consumption_data:
+            copy.write_row((point['time'], point['consumption']))
+
+    # A time can only be upserted once per statement so duplicates are dropped
+    cursor.execute('INSERT INTO electricity_consumption (time, consumption) '
+                   'SELECT DISTINCT ON (time) time, consumption '
+                   'FROM consumption_staging ORDER BY time '
+                   'ON CONFLICT (time) DO UPDATE '
+                   'SET consumption = EXCLUDED.consumption')
+    return cursor.rowcount
+
+
+def get_tax_per_kwh(fees, day):
+    """Return the electricity tax in euros per kWh for a day.
+
+    The tax of the first interval containing the day is used, a missing start or
+    end date leaves the interval open on that side.
+    """
+    for interval in fees.get('tax', []):
+        if (not interval.get('start') or
+            date.fromisoformat(interval['start']) <= day) and \
+           (not interval.get('end') or day <= date.fromisoformat(interval['end'])):
+            return interval['per_kwh']
+
+    return 0
+
+
+def refresh_rollups(cursor, fees, day):
+    """Refresh the daily and monthly consumption and cost rollups of a day."""
+    cursor.execute('SELECT refresh_electricity_rollup(%s, %s, %s, %s, %s, %s)',
+                   (day, fees.get('contract_margin', 0), fees.get('transfer_fee', 0),
+                    get_tax_per_kwh(fees, day), fees.get('contract_base_fee', 0),
+                    fees.get('transfer_base_fee', 0)))
 
 
 def create_db_conn_string(db_config):
@@ -159,26 +437,183 @@ def create_db_conn_string(db_config):
     )
 
 
-def handle_storage(args, db_config, consumption_data):
-    """Handle the consumption storage process."""
+def handle_storage(args, cursor, fetch_date, consumption_data,  # noqa: PLR0913
+                   *, missing_slots=None, fees=None):
+    """Handle the consumption storage process of a single date.
+
+    When missing slots are given only the values for them are stored. The
+    consumption and cost rollups of the date are refreshed in the same
+    transaction. Returns True on success and False otherwise.
+    """
     required_data_array_length = 24
 
     if args.verbose:
-        logger.info('Consumption data: length %s, array %s',
+        logger.info('Consumption data for %s: length %s, array %s', fetch_date,
                     len(consumption_data), consumption_data)
 
-    if not args.force_store and len(consumption_data) < required_data_array_length:
-        logger.error('Data fetching failed, not enough data was received')
+    if missing_slots is not None:
+        consumption_data = [point for point in consumption_data
+                            if datetime.fromisoformat(point['time']) in missing_slots]
+        logger.info('Received values for %s missing slots on %s',
+                    len(consumption_data), fetch_date)
+        if not consumption_data:
+            return True
+    elif not args.force_store and \
+         len(consumption_data) < required_data_array_length:
+        logger.error('Data fetching for %s failed, not enough data was received',
+                     fetch_date)
         logger.info('Received data array length: %s', len(consumption_data))
-        sys.exit(1)
+        return False
 
     if args.no_store:
-        logger.info('Not storing data to database')
-        return
+        logger.info('Not storing data for %s to database', fetch_date)
+        return True
 
-    store_consumption(db_config, consumption_data)
+    try:
+        with cursor.connection.transaction():
+            row_count = upsert_consumption(cursor, consumption_data)
+            refresh_rollups(cursor, fees or {}, fetch_date)
+    except psycopg.Error:
+        logger.exception('Data insert for %s failed', fetch_date)
+        return False
+
+    logger.info('Stored %s consumption values for %s', row_count, fetch_date)
+    return True
+
+
+def fetch_and_store(args, db_config, session, dates,  # noqa: PLR0913
+                    *, cache=None, missing_slots=None, fees=None):
+    """Fetch and store consumption data for the given dates.
+
+    Data is fetched by a pool of worker threads with a limited request rate and
+    the data of each date is stored as soon as it has been received. When missing
+    slots are given only the values for them are stored. Returns the dates for
+    which fetching or storing failed.
+    """
+    rate_limiter = RateLimiter(args.rate)
+    failed_dates = []
+
+    def fetch(fetch_date):
+        return fetch_consumption_data(session, fetch_date, cache, rate_limiter)
+
+    with ExitStack() as stack:
+        cursor = None
+        if not args.no_store:
+            try:
+                conn = stack.enter_context(
+                    psycopg.connect(create_db_conn_string(db_config)))
+            except psycopg.Error:
+                logger.exception('Database connection failed')
+                sys.exit(1)
+            cursor = stack.enter_context(conn.cursor())
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=args.workers))
+
+        futures = {executor.submit(fetch, fetch_date): fetch_date
+                   for fetch_date in dates}
+        for future in as_completed(futures):
+            fetch_date = futures[future]
+            try:
+                consumption_data = future.result()
+            except Exception:
+                logger.exception('Consumption data fetch for %s failed', fetch_date)
+                failed_dates.append(fetch_date)
+                continue
+
+            if not handle_storage(args, cursor, fetch_date, consumption_data,
+                                  missing_slots=missing_slots, fees=fees):
+                failed_dates.append(fetch_date)
+
+    return sorted(failed_dates)
+
+
+def find_missing_slots(db_config, start_date, end_date, resolution):
+    """Find consumption time slots without a value in the given date range.
+
+    The expected slots are generated in the database and compared against the
+    stored values in a single query. The slots of a day are generated with the
+    given resolution (in minutes) unless the data stored for the day has a coarser
+    resolution, e.g. hourly data, in which case the resolution of the stored data
+    is used.
+    """
+    step = timedelta(minutes=resolution)
+
+    try:
+        with psycopg.connect(create_db_conn_string(db_config)) as conn, \
+             conn.cursor() as cursor:
+            cursor.execute(t"""WITH days AS (
+                SELECT day::timestamp AT TIME ZONE 'Europe/Helsinki' AS day_start,
+                       (day + interval '1 day')::timestamp
+                           AT TIME ZONE 'Europe/Helsinki' AS day_end
+                FROM generate_series({start_date}::date, {end_date}::date,
+                                     interval '1 day') AS day
+            ), day_steps AS (
+                SELECT day_start, day_end,
+                       GREATEST({step}::interval,
+                                (SELECT MIN(stored_step)
+                                 FROM (SELECT time - LAG(time) OVER (ORDER BY time)
+                                           AS stored_step
+                                       FROM electricity_consumption
+                                       WHERE time >= day_start AND time < day_end)
+                                      AS stored)) AS step
+                FROM days
+            )
+            SELECT slot FROM day_steps,
+                   generate_series(day_start, day_end - step, step) AS slot
+            WHERE NOT EXISTS (SELECT 1 FROM electricity_consumption
+                              WHERE time = slot)
+            ORDER BY slot""")
+            return [row[0] for row in cursor.fetchall()]
+    except psycopg.Error:
+        logger.exception('Missing data check failed')
+        sys.exit(1)
 
-    logger.info('Successfully stored electricity consumption data')
+
+def get_date_range(args, default_days):
+    """Return the date range given with the command line arguments.
+
+    By default the range contains the given number of days ending yesterday.
+    """
+    yesterday = datetime.now(tz=HELSINKI_TZ).date() - timedelta(days=1)
+
+    start = parse_date(args.from_date) if args.from_date \
+        else yesterday - timedelta(days=default_days - 1)
+    end = parse_date(args.to_date) if args.to_date else yesterday
+    if start > end:
+        logger.error('Range start date is after the end date')
+        sys.exit(1)
+
+    return (start, end)
+
+
+def get_fetch_dates(args):
+    """Return the dates to fetch data for based on the command line arguments."""
+    if args.date:
+        return [parse_date(date_str) for date_str in args.date.split(',')]
+
+    start, end = get_date_range(args, 1)
+    return [start + timedelta(days=day) for day in range((end - start).days + 1)]
+
+
+def open_session(args, fetch_config, cache):
+    """Return a Caruna+ session.
+
+    In offline mode the session is not logged in and only has the asset ID of a
+    previous login.
+    """
+    session = CarunaSession(fetch_config,
+                            fetch_config.get('session_file', 'caruna_session.json'))
+    if args.offline:
+        session.asset_id = fetch_config.get('asset_id') or cache.get_asset_id()
+        if not session.asset_id:
+            logger.error('Asset ID is not known, offline mode requires a previous '
+                         'online run or an asset ID in the configuration')
+            sys.exit(1)
+    else:
+        session.open()
+        if cache:
+            cache.set_asset_id(session.asset_id)
+
+    return session
 
 
 def main():
@@ -190,11 +625,28 @@ def main():
                                      'into a PostgreSQL database. By default data for '
                                      'the previous day is fetched.')
     parser.add_argument('--config', type=str, help='configuration file to use')
-    parser.add_argument('--date', type=str, help='date (in YYYY-MM-DD format) for '
-                        'which to fetch data, multiple comma separated values are '
-                        'supported')
+    date_group = parser.add_mutually_exclusive_group()
+    date_group.add_argument('--date', type=str, help='date (in YYYY-MM-DD format) '
+                            'for which to fetch data, multiple comma separated '
+                            'values are supported')
+    date_group.add_argument('--from', type=str, dest='from_date',
+                            help='first date (in YYYY-MM-DD format) of a date range '
+                            'for which to fetch data')
+    parser.add_argument('--to', type=str, dest='to_date',
+                        help='last date (in YYYY-MM-DD format) of the date range, '
+                        'defaults to yesterday')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of concurrent fetch workers (default: 4)')
+    parser.add_argument('--rate', type=float, default=2,
+                        help='maximum number of fetch requests per second, zero '
+                        'means unlimited (default: 2)')
     parser.add_argument('--check-for-missing', action='store_true',
-                        help='check for missing data from the day before yesterday')
+                        help='find time slots without data in the date range '
+                        '(default: the last seven days) and store data only for them')
+    parser.add_argument('--resolution', type=int, choices=[15, 60], default=60,
+                        help='time resolution in minutes of consumption data used '
+                        'when checking for missing data, days with data of a '
+                        'coarser resolution are checked with it (default: 60)')
     parser.add_argument('--force-store', action='store_true',
                         help='store data despite missing values or existing data '
                         'is found')
@@ -202,6 +654,11 @@ def main():
                         help='do not store consumption data to database')
     parser.add_argument('--verbose', action='store_true',
                         help='print returned consumption data')
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument('--no-cache', action='store_true',
+                             help='do not use cached API responses')
+    cache_group.add_argument('--offline', action='store_true',
+                             help='only use cached API responses, do not log in')
 
     args = parser.parse_args()
     config_file = args.config or 'config.json'
@@ -213,28 +670,42 @@ def main():
     with Path(config_file).open('r', encoding='utf-8') as cfg_file:
         config = json.load(cfg_file)
 
-    if not args.date and not args.no_store and not args.force_store:
-        day_diff = 2 if args.check_for_missing else 1
-        check_date = datetime.now(tz=HELSINKI_TZ).date() - timedelta(days=day_diff)
+    if args.to_date and not args.from_date:
+        logger.error('The --to flag requires the --from flag')
+        sys.exit(1)
 
-        if check_day_data(config['db'], check_date):
+    missing_slots = None
+    if args.check_for_missing:
+        start, end = get_date_range(args, 7)
+        missing_slots = set(find_missing_slots(config['db'], start, end,
+                                               args.resolution))
+        if not missing_slots:
+            logger.info('No missing data found between %s and %s', start, end)
+            return
+        dates = sorted({slot.astimezone(HELSINKI_TZ).date()
+                        for slot in missing_slots})
+        logger.info('Found %s missing time slots on %s days', len(missing_slots),
+                    len(dates))
+    else:
+        dates = get_fetch_dates(args)
+
+        if not args.date and not args.from_date and not args.no_store \
+           and not args.force_store and check_day_data(config['db'], dates[0]):
             logger.info('Not storing data again because existing data is found')
             return
 
-    login_data = login_to_carunaplus(config['fetch'])
+    cache = create_cache(args, config)
+    session = open_session(args, config['fetch'], cache)
 
-    if args.date:
-        for fetch_date in args.date.split(','):
-            handle_storage(args, config['db'],
-                           fetch_consumption_data(login_data, fetch_date))
-    elif args.check_for_missing:
-        fetch_date = datetime.now(tz=HELSINKI_TZ).date() - timedelta(days=2)
-
-        handle_storage(args, config['db'],
-                       fetch_consumption_data(login_data, fetch_date.isoformat()))
-    else:
-        handle_storage(args, config['db'],
-                       fetch_consumption_data(login_data))
+    failed_dates = fetch_and_store(args, config['db'], session, dates, cache=cache,
+                                   missing_slots=missing_slots,
+                                   fees=config.get('fees'))
+    if failed_dates:
+        logger.error('Storing consumption data failed for dates: %s',
+                     ', '.join(str(failed_date) for failed_date in failed_dates))
+        sys.exit(1)
+
+    logger.info('Successfully stored electricity consumption data')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+"""A script for calculating electricity costs from stored consumption and prices.
+
+Consumption and spot prices are loaded from a PostgreSQL database into arrays
+aligned on a common time grid, after which costs, savings from shifting
+consumption into the cheapest hours and the costs of alternative fixed price
+tariffs are calculated per month in Helsinki time.
+"""
+
+import argparse
+import json
+import logging
+import sys
+from datetime import date, datetime, timedelta
+from os import environ
+from pathlib import Path
+from time import monotonic
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import psycopg
+
+logger = logging.getLogger(__name__)
+HELSINKI_TZ = ZoneInfo('Europe/Helsinki')
+
+# Length of a grid slot in seconds
+SLOT_SECONDS = 15 * 60
+
+
+def load_series(cursor, table, time_column, value_column, *,  # noqa: PLR0913
+                start, end):
+    """Load a time series from a table as Unix timestamp and value arrays."""
+    cursor.execute(f'SELECT EXTRACT(EPOCH FROM {time_column})::bigint, '  # noqa: S608
+                   f'{value_column} FROM {table} WHERE {time_column} >= %s AND '
+                   f'{time_column} < %s ORDER BY {time_column}',
+                   (start, end))
+    rows = cursor.fetchall()
+
+    return (np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)),
+            np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows)))
+
+
+def to_grid(times, values, grid_start, slot_count, split):
+    """Place a series onto the 15 minute grid starting at grid_start.
+
+    The resolution of the series is detected from its timestamps. Values of a
+    coarser series are either split evenly (energy) or repeated (price) into the
+    slots they cover. Slots without a value are NaN.
+    """
+    grid = np.full(slot_count, np.nan)
+    if times.size == 0:
+        return grid
+
+    resolution = int(np.median(np.diff(times))) if times.size > 1 else SLOT_SECONDS
+    slots_per_value = max(resolution // SLOT_SECONDS, 1)
+
+    indices = ((times - grid_start) // SLOT_SECONDS)[:, np.newaxis] + \
+        np.arange(slots_per_value)
+    slot_values = np.repeat((values / slots_per_value if split else values)
+                            [:, np.newaxis], slots_per_value, axis=1)
+    valid = (indices >= 0) & (indices < slot_count)
+    grid[indices[valid]] = slot_values[valid]
+
+    return grid
+
+
+def resample(grid, slots_per_value, split):
+    """Resample a 15 minute grid into a coarser resolution.
+
+    Energy values are summed and prices averaged.
+    """
+    if slots_per_value == 1:
+        return grid
+
+    reshaped = grid.reshape(-1, slots_per_value)
+    return reshaped.sum(axis=1) if split else reshaped.mean(axis=1)
+
+
+def get_local_days(grid_start, slot_count, resolution):
+    """Return the Helsinki time day numbers of grid slots.
+
+    Day numbers are days since the Unix epoch. UTC offsets are resolved once per
+    hour so that days are correct across DST changes.
+    """
+    hour_count = -(-slot_count * resolution // 3600)
+    offsets = np.array([datetime.fromtimestamp(grid_start + hour * 3600,
+                                               tz=HELSINKI_TZ)
+                        .utcoffset().total_seconds()
+                        for hour in range(hour_count)], dtype=np.int64)
+    slot_times = grid_start + np.arange(slot_count, dtype=np.int64) * resolution
+
+    return (slot_times + offsets[(slot_times - grid_start) // 3600]) // 86400
+
+
+def get_shift_savings(days, consumption, prices, shift_share, shift_slots):
+    """Return the daily savings from shifting consumption.
+
+    The given share of each day's consumption is assumed to be movable into the
+    cheapest slots of the same day. Returns the day numbers and savings in
+    cents.
+    """
+    valid = ~np.isnan(prices)
+    days, consumption, prices = days[valid], consumption[valid], prices[valid]
+
+    unique_days, day_index = np.unique(days, return_inverse=True)
+    day_consumption = np.bincount(day_index, weights=np.nan_to_num(consumption))
+    day_cost = np.bincount(day_index,
+                           weights=np.nan_to_num(consumption * prices))
+
+    # Rank the prices within each day with a single sort
+    order = np.lexsort((prices, day_index))
+    sorted_days = day_index[order]
+    ranks = np.arange(order.size) - np.searchsorted(sorted_days, sorted_days)
+    cheapest = ranks < shift_slots
+    cheapest_avg = np.bincount(sorted_days[cheapest],
+                               weights=prices[order][cheapest],
+                               minlength=unique_days.size) / \
+        np.maximum(np.bincount(sorted_days[cheapest],
+                               minlength=unique_days.size), 1)
+
+    shifted_consumption = day_consumption * shift_share
+    savings = shift_share * day_cost - shifted_consumption * cheapest_avg
+
+    return unique_days, np.maximum(savings, 0)
+
+
+def calculate_costs(series, start_date, end_date, resolution, options):
+    """Calculate monthly consumption, costs and savings.
+
+    Returns a list of dictionaries, one per month.
+    """
+    grid_start = int(datetime(start_date.year, start_date.month, start_date.day,
+                              tzinfo=HELSINKI_TZ).timestamp())
+    grid_end = int((datetime(end_date.year, end_date.month, end_date.day,
+                             tzinfo=HELSINKI_TZ) + timedelta(days=1)).timestamp())
+    slot_count = (grid_end - grid_start) // SLOT_SECONDS
+    slots_per_value = resolution * 60 // SLOT_SECONDS
+
+    consumption = to_grid(*series['consumption'], grid_start, slot_count, True)
+    # Prefer 15 minute prices and fill the rest with hourly prices
+    prices = to_grid(*series['price_minute'], grid_start, slot_count, False)
+    hourly_prices = to_grid(*series['price'], grid_start, slot_count, False)
+    prices = np.where(np.isnan(prices), hourly_prices, prices)
+
+    consumption = resample(consumption, slots_per_value, True)
+    prices = resample(prices, slots_per_value, False)
+    days = get_local_days(grid_start, consumption.size, resolution * 60)
+
+    # Prices are in cents per kWh
+    cost = consumption * prices / 100
+    months = days.astype('datetime64[D]').astype('datetime64[M]')
+    unique_months, month_index = np.unique(months, return_inverse=True)
+
+    def month_sum(values):
+        return np.bincount(month_index, weights=np.nan_to_num(values),
+                           minlength=unique_months.size)
+
+    month_consumption = month_sum(consumption)
+    month_cost = month_sum(cost)
+    priced_consumption = month_sum(np.where(np.isnan(prices), np.nan, consumption))
+
+    shift_days, day_savings = get_shift_savings(
+        days, consumption, prices, options['shift_share'],
+        options['shift_hours'] * 60 // resolution)
+    shift_months = np.searchsorted(
+        unique_months, shift_days.astype('datetime64[D]').astype('datetime64[M]'))
+    month_savings = np.bincount(shift_months, weights=day_savings,
+                                minlength=unique_months.size) / 100
+
+    return [{'month': str(month),
+             'consumption': month_consumption[i],
+             'cost': month_cost[i],
+             'avg_price': 100 * month_cost[i] / priced_consumption[i]
+             if priced_consumption[i] else np.nan,
+             'shift_savings': month_savings[i],
+             'fixed_costs': [month_consumption[i] * fixed_price / 100
+                             for fixed_price in options['fixed_prices']]}
+            for i, month in enumerate(unique_months)]
+
+
+def load_data(db_config, start_date, end_date):
+    """Load consumption and price series for the given date range."""
+    start = datetime(start_date.year, start_date.month, start_date.day,
+                     tzinfo=HELSINKI_TZ)
+    end = datetime(end_date.year, end_date.month, end_date.day,
+                   tzinfo=HELSINKI_TZ) + timedelta(days=1)
+
+    try:
+        with psycopg.connect(create_db_conn_string(db_config)) as conn, \
+             conn.cursor() as cursor:
+            return {
+                'consumption': load_series(cursor, 'electricity_consumption',
+                                           'time', 'consumption',
+                                           start=start, end=end),
+                'price': load_series(cursor, 'electricity_price', 'start_time',
+                                     'price', start=start, end=end),
+                'price_minute': load_series(cursor, 'electricity_price_minute',
+                                            'start_time', 'price',
+                                            start=start, end=end)
+            }
+    except psycopg.Error:
+        logger.exception('Data loading failed')
+        sys.exit(1)
+
+
+def create_db_conn_string(db_config):
+    """Create the database connection string."""
+    db_config = {
+        'host': environ['DB_HOST'] if 'DB_HOST' in environ else db_config['host'],
+        'name': environ['DB_NAME'] if 'DB_NAME' in environ else db_config['dbname'],
+        'username': environ['DB_USERNAME'] if 'DB_USERNAME' in environ
+        else db_config['username'],
+        'password': db_config.get('password', None)
+    }
+    if not db_config['password']:
+        password_file = environ.get('DB_PASSWORD_FILE', None)
+        if password_file:
+            with Path.open(password_file, 'r') as pw_file:
+                db_config['password'] = pw_file.readline().strip()
+        else:
+            logger.error('No database server password provided, exiting')
+            sys.exit(1)
+
+    return (
+        f'host={db_config["host"]} user={db_config["username"]} '
+        f'password={db_config["password"]} dbname={db_config["name"]}'
+    )
+
+
+def print_costs(costs, fixed_prices):
+    """Print the monthly costs."""
+    header = f'{"Month":<9}{"kWh":>10}{"Cost (€)":>11}{"c/kWh":>8}{"Shift (€)":>11}'
+    header += ''.join(f'{f"Fixed {price}":>13}' for price in fixed_prices)
+    print(header)
+
+    for month in costs:
+        line = (f'{month["month"]:<9}{month["consumption"]:>10.2f}'
+                f'{month["cost"]:>11.2f}{month["avg_price"]:>8.2f}'
+                f'{month["shift_savings"]:>11.2f}')
+        line += ''.join(f'{fixed_cost:>13.2f}' for fixed_cost in month['fixed_costs'])
+        print(line)
+
+
+def main():
+    """Run the module code."""
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Calculates electricity costs from '
+                                     'stored consumption and spot prices.')
+    parser.add_argument('--config', type=str, help='configuration file to use')
+    parser.add_argument('--start', type=date.fromisoformat, required=True,
+                        help='first date (in YYYY-MM-DD format) of the calculation')
+    parser.add_argument('--end', type=date.fromisoformat,
+                        help='last date (in YYYY-MM-DD format) of the calculation '
+                        '(default: yesterday)')
+    parser.add_argument('--resolution', type=int, choices=[15, 60], default=15,
+                        help='time resolution in minutes of the calculation '
+                        '(default: 15)')
+    parser.add_argument('--shift-share', type=float, default=0.2,
+                        help='share of daily consumption which can be shifted into '
+                        'the cheapest hours (default: 0.2)')
+    parser.add_argument('--shift-hours', type=int, default=3,
+                        help='number of cheapest hours per day the consumption is '
+                        'shifted into (default: 3)')
+    parser.add_argument('--fixed-price', type=float, action='append', default=[],
+                        help='fixed price in cents per kWh to compare against, can '
+                        'be given many times')
+
+    args = parser.parse_args()
+    config_file = args.config or 'config.json'
+
+    if not Path(config_file).exists():
+        logger.error('Could not find configuration file "%s"', config_file)
+        sys.exit(1)
+
+    with Path(config_file).open('r', encoding='utf-8') as cfg_file:
+        config = json.load(cfg_file)
+
+    end_date = args.end or datetime.now(tz=HELSINKI_TZ).date() - timedelta(days=1)
+    if args.start > end_date:
+        logger.error('Start date is after the end date')
+        sys.exit(1)
+
+    series = load_data(config['db'], args.start, end_date)
+
+    start_time = monotonic()
+    costs = calculate_costs(series, args.start, end_date, args.resolution,
+                            {'shift_share': args.shift_share,
+                             'shift_hours': args.shift_hours,
+                             'fixed_prices': args.fixed_price})
+    logger.info('Calculated costs in %.3f seconds', monotonic() - start_time)
+
+    print_costs(costs, args.fixed_price)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,53 +3,117 @@
 """A script for inserting electricity prices into a PostgreSQL database."""
 
 import argparse
+import gzip
 import json
 import logging
+import random
 import sys
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from datetime import date, datetime, time, timedelta
+from itertools import accumulate
 from math import isinf
 from os import environ
 from pathlib import Path
+from statistics import quantiles
+from time import sleep
 from zoneinfo import ZoneInfo
 
 import psycopg
+import requests
 from nordpool import elspot
 
 logger = logging.getLogger(__name__)
 HELSINKI_TZ = ZoneInfo('Europe/Helsinki')
 
 VAT_MULTIPLIER = 1.255
+# Maximum allowed difference in cents between derived and published prices
+PRICE_TOLERANCE = 0.011
+# Minimum number of hours with a price for the prices of a day to be complete
+PRICE_MIN_HOURS = 20
+# Window lengths in hours and percentiles of the daily price index
+INDEX_WINDOW_HOURS = range(1, 7)
+INDEX_PERCENTILES = (10, 25, 50, 75, 90)
 
 
-def fetch_prices(config, fetch_date, hourly=True):
-    """Fetch electricity spot prices from the Nord Pool API.
+class PriceCache:
+    """Class for caching Nord Pool price responses on disk.
+
+    Prices are stored compressed in one file per price area, date and time
+    resolution. Only complete days are cached, their prices never change once
+    published so cached prices do not expire.
+    """
+
+    def __init__(self, directory):
+        """Class constructor."""
+        self._directory = Path(directory)
+
+    def _get_path(self, area_code, fetch_date, resolution):
+        """Return the cache file path of a response."""
+        return self._directory / area_code / \
+            f'{fetch_date.isoformat()}_{resolution}.json.gz'
+
+    def get(self, area_code, fetch_date, resolution):
+        """Return cached prices or None if there are none."""
+        path = self._get_path(area_code, fetch_date, resolution)
+        if not path.exists():
+            return None
+
+        with gzip.open(path, 'rt', encoding='utf-8') as cache_file:
+            return [{'time': datetime.fromisoformat(price['time']),
+                     'value': price['value']}
+                    for price in json.load(cache_file)]
+
+    def put(self, area_code, fetch_date, resolution, prices):
+        """Store prices into the cache."""
+        path = self._get_path(area_code, fetch_date, resolution)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write into a temporary file first so that a partial file is never read
+        tmp_path = path.with_suffix('.tmp')
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as cache_file:
+            json.dump([{'time': price['time'].isoformat(), 'value': price['value']}
+                       for price in prices], cache_file)
+        tmp_path.replace(path)
+
+
+def parse_date(date_str):
+    """Parse a date in the YYYY-MM-DD format.
+
+    Exits if the date is not valid.
+    """
+    try:
+        return datetime.strptime(date_str, '%Y-%m-%d').replace(
+            tzinfo=HELSINKI_TZ).date()
+    except ValueError:
+        logger.exception('Invalid date provided')
+        sys.exit(1)
+
+
+def fetch_prices(config, fetch_date, hourly=False, cache=None):
+    """Fetch electricity spot prices of a date from the Nord Pool API.
 
     Prices are fetched for the given price area with either a 15 or 60 minutes time
-    resolution).
-    By default the next day is used or desired date can be provided.
+    resolution. Prices are returned as received, in euros per MWh without VAT.
+    Cached prices are used when available. Raises a ValueError if the prices of
+    the whole day are not available.
     """
     area_code = config['area_code']
+    resolution = 60 if hourly else 15
 
-    today = datetime.now(tz=HELSINKI_TZ).date()
-    start = datetime(today.year, today.month, today.day, tzinfo=HELSINKI_TZ)
-
-    if fetch_date:
-        try:
-            start = datetime.strptime(
-                fetch_date, '%Y-%m-%d').replace(tzinfo=HELSINKI_TZ)
-        except ValueError:
-            logger.exception('Invalid date provided')
-            sys.exit(1)
-    else:
-        start += timedelta(days=1)
+    if cache:
+        prices = cache.get(area_code, fetch_date, resolution)
+        if prices is not None:
+            logger.info('Using cached %s minute resolution price data for %s',
+                        resolution, fetch_date)
+            return prices
 
+    start = datetime(fetch_date.year, fetch_date.month, fetch_date.day,
+                     tzinfo=HELSINKI_TZ)
     end = start + timedelta(hours=23)
 
-    prices = []
-
     logger.info('Fetching %s minute resolution price data for area code %s '
-                'for interval [%s, %s]',
-                60 if hourly else 15, area_code, start, end)
+                'for interval [%s, %s]', resolution, area_code, start, end)
 
     prices_spot = elspot.Prices()
     if hourly:
@@ -58,36 +122,214 @@ def fetch_prices(config, fetch_date, hourly=True):
         price_data = prices_spot.fetch(areas=[area_code], end_date=end, resolution=15)
 
     if not price_data or area_code not in price_data['areas']:
-        logger.error('Price data fetch failed')
-        sys.exit(1)
+        msg = f'Price data fetch for {fetch_date} failed'
+        raise ValueError(msg)
+
+    prices = [{'time': value['start'], 'value': value['value']}
+              for value in price_data['areas'][area_code]['values']
+              if not isinf(value['value'])]
 
-    for value in price_data['areas'][area_code]['values']:
-        if isinf(value['value']):
-            continue
+    if len(prices) < PRICE_MIN_HOURS * 60 // resolution:
+        msg = f'Not enough price data was received for {fetch_date}'
+        raise ValueError(msg)
 
-        prices.append({'time': value['start'],
-                       # Price is without VAT so it is manually added
-                       'price': round((value['value'] / 10) * VAT_MULTIPLIER, 2)})
+    if cache:
+        cache.put(area_code, fetch_date, resolution, prices)
 
     return prices
 
 
-def store_prices(db_config, price_data, hourly=True):
-    """Store the prices to a database pointed by the DB config."""
-    insert_query = (
-        f'INSERT INTO electricity_price{"" if hourly else "_minute"} '  # noqa: S608
-        '(start_time, price) VALUES (%s, %s)'
-    )
+def derive_hourly_prices(prices):
+    """Derive hourly prices from 15 minute prices.
+
+    The hourly price is the average of the prices within the hour, which is how
+    the hourly price index is formed by Nord Pool.
+    """
+    hours = {}
+    for price in prices:
+        hours.setdefault(price['time'].replace(minute=0, second=0, microsecond=0),
+                         []).append(price['value'])
+
+    return [{'time': hour, 'value': sum(values) / len(values)}
+            for hour, values in sorted(hours.items())]
+
+
+def check_hourly_prices(derived_prices, published_prices):
+    """Check that derived hourly prices match the published hourly prices.
+
+    Prices are compared after conversion to consumer prices. Returns True if all
+    prices match and False otherwise.
+    """
+    derived = {price['time']: price['price']
+               for price in to_consumer_prices(derived_prices)}
+    published = {price['time']: price['price']
+                 for price in to_consumer_prices(published_prices)}
+
+    if derived.keys() != published.keys():
+        logger.error('Derived and published hourly prices have different hours')
+        return False
+
+    mismatches = [hour for hour, price in derived.items()
+                  if abs(price - published[hour]) > PRICE_TOLERANCE]
+    for hour in mismatches:
+        logger.error('Derived hourly price %s for %s does not match the published '
+                     'price %s', derived[hour], hour, published[hour])
+
+    return not mismatches
+
+
+def to_consumer_prices(prices):
+    """Convert spot prices in euros per MWh to cents per kWh with VAT."""
+    # Price is without VAT so it is manually added
+    return [{'time': price['time'],
+             'price': round((price['value'] / 10) * VAT_MULTIPLIER, 2)}
+            for price in prices]
+
+
+def upsert_prices(cursor, price_data, hourly):
+    """Upsert prices of one time resolution with the given cursor.
+
+    The prices are copied into a temporary staging table and merged from there
+    into the price table. Rows whose price does not change are left untouched so
+    that storing the same prices again does not modify the table. Returns the
+    number of inserted or updated rows.
+    """
+    table = f'electricity_price{"" if hourly else "_minute"}'
+
+    cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS price_staging '
+                   '(start_time TIMESTAMP WITH TIME ZONE NOT NULL, '
+                   'price REAL NOT NULL) ON COMMIT DELETE ROWS')
+    cursor.execute('TRUNCATE price_staging')
 
+    with cursor.copy('COPY price_staging (start_time, price) FROM STDIN') as copy:
+        for price in price_data:
+            copy.write_row((price['time'], round(float(price['price']), 2)))
+
+    # A start time can only be upserted once per statement so duplicates are
+    # dropped
+    cursor.execute(f'INSERT INTO {table} (start_time, price) '  # noqa: S608
+                   'SELECT DISTINCT ON (start_time) start_time, price '
+                   'FROM price_staging ORDER BY start_time '
+                   'ON CONFLICT (start_time) DO UPDATE '
+                   'SET price = EXCLUDED.price '
+                   f'WHERE {table}.price IS DISTINCT FROM EXCLUDED.price')
+    return cursor.rowcount
+
+
+def find_price_windows(prices, size):
+    """Find the cheapest and most expensive windows of the given number of slots.
+
+    Window sums are calculated with a sliding window over cumulative sums.
+    Returns the start indices of the cheapest and most expensive windows.
+    """
+    sums = [0, *accumulate(prices)]
+    window_sums = [sums[start + size] - sums[start]
+                   for start in range(len(prices) - size + 1)]
+
+    return (min(range(len(window_sums)), key=window_sums.__getitem__),
+            max(range(len(window_sums)), key=window_sums.__getitem__))
+
+
+def create_price_index(prices):
+    """Create the price index of a day from its 15 minute consumer prices.
+
+    The index contains the price percentiles, the price rank of each slot and the
+    cheapest and most expensive contiguous windows of one to six hours.
+    """
+    prices = sorted(prices, key=lambda price: price['time'])
+    values = [price['price'] for price in prices]
+    slot_minutes = 15
+
+    ranks = [0] * len(values)
+    for rank, slot in enumerate(sorted(range(len(values)),
+                                       key=lambda slot: (values[slot], slot)),
+                                start=1):
+        ranks[slot] = rank
+
+    all_percentiles = quantiles(values, n=100, method='inclusive')
+    index = {'slot_count': len(values),
+             'percentiles': [round(all_percentiles[percentile - 1], 2)
+                             for percentile in INDEX_PERCENTILES],
+             'slot_ranks': ranks,
+             'cheapest_start': [], 'cheapest_avg': [],
+             'expensive_start': [], 'expensive_avg': []}
+
+    for hours in INDEX_WINDOW_HOURS:
+        size = hours * 60 // slot_minutes
+        for kind, start in zip(('cheapest', 'expensive'),
+                               find_price_windows(values, size), strict=True):
+            index[f'{kind}_start'].append(prices[start]['time'])
+            index[f'{kind}_avg'].append(
+                round(sum(values[start:start + size]) / size, 2))
+
+    return index
+
+
+def store_price_index(cursor, day, index):
+    """Store the price index of a day with the given cursor."""
+    cursor.execute('INSERT INTO electricity_price_index (day, slot_count, '
+                   'percentiles, slot_ranks, cheapest_start, cheapest_avg, '
+                   'expensive_start, expensive_avg) VALUES (%(day)s, '
+                   '%(slot_count)s, %(percentiles)s, %(slot_ranks)s, '
+                   '%(cheapest_start)s, %(cheapest_avg)s, %(expensive_start)s, '
+                   '%(expensive_avg)s) ON CONFLICT (day) DO UPDATE '
+                   'SET slot_count = EXCLUDED.slot_count, '
+                   'percentiles = EXCLUDED.percentiles, '
+                   'slot_ranks = EXCLUDED.slot_ranks, '
+                   'cheapest_start = EXCLUDED.cheapest_start, '
+                   'cheapest_avg = EXCLUDED.cheapest_avg, '
+                   'expensive_start = EXCLUDED.expensive_start, '
+                   'expensive_avg = EXCLUDED.expensive_avg, '
+                   'updated = CURRENT_TIMESTAMP',
+                   {'day': day, **index})
+
+
+def store_prices(cursor, fetch_date, hourly_prices, minute_prices, fees=None):
+    """Store the prices of a date with the given cursor.
+
+    Prices of both time resolutions are stored in a single transaction together
+    with the price index of the date and refreshing the consumption and cost
+    rollups of the days of the hourly prices. Returns True on success and False
+    otherwise.
+    """
     try:
-        with psycopg.connect(create_db_conn_string(db_config)) as conn, \
-             conn.cursor() as cursor:
-            for price in price_data:
-                cursor.execute(insert_query, (price['time'],
-                                              round(float(price['price']), 2)))
+        with cursor.connection.transaction():
+            hourly_count = upsert_prices(cursor, hourly_prices, True)
+            minute_count = upsert_prices(cursor, minute_prices, False)
+            store_price_index(cursor, fetch_date, create_price_index(minute_prices))
+            for day in sorted({price['time'].astimezone(HELSINKI_TZ).date()
+                               for price in hourly_prices}):
+                refresh_rollups(cursor, fees or {}, day)
     except psycopg.Error:
-        logger.exception('Price insert failed')
-        sys.exit(1)
+        logger.exception('Price insert for %s failed', fetch_date)
+        return False
+
+    logger.info('Inserted or updated %s hourly and %s 15 minute prices for %s',
+                hourly_count, minute_count, fetch_date)
+    return True
+
+
+def get_tax_per_kwh(fees, day):
+    """Return the electricity tax in euros per kWh for a day.
+
+    The tax of the first interval containing the day is used, a missing start or
+    end date leaves the interval open on that side.
+    """
+    for interval in fees.get('tax', []):
+        if (not interval.get('start') or
+            date.fromisoformat(interval['start']) <= day) and \
+           (not interval.get('end') or day <= date.fromisoformat(interval['end'])):
+            return interval['per_kwh']
+
+    return 0
+
+
+def refresh_rollups(cursor, fees, day):
+    """Refresh the daily and monthly consumption and cost rollups of a day."""
+    cursor.execute('SELECT refresh_electricity_rollup(%s, %s, %s, %s, %s, %s)',
+                   (day, fees.get('contract_margin', 0), fees.get('transfer_fee', 0),
+                    get_tax_per_kwh(fees, day), fees.get('contract_base_fee', 0),
+                    fees.get('transfer_base_fee', 0)))
 
 
 def create_db_conn_string(db_config):
@@ -114,17 +356,154 @@ def create_db_conn_string(db_config):
     )
 
 
-def fetch_and_store(config, fetch_date, hourly=True):
-    """Fetch and store electricity prices for all time resolutions."""
-    price_array_min_length = 20
+def get_schedule(config):
+    """Return the price fetch schedule based on the configuration.
 
-    prices = fetch_prices(config['fetch'], fetch_date, hourly)
+    Day-ahead prices are expected to be published at the given local time on the
+    previous day. Fetching is retried until the deadline measured from the
+    publication time, the retry interval is doubled after every attempt up to
+    the maximum interval.
+    """
+    return {'publish_time': time.fromisoformat(config.get('publish_time',
+                                                          '13:45')),
+            'deadline': timedelta(hours=config.get('deadline_hours', 10)),
+            'initial_interval': config.get('initial_interval_seconds', 60),
+            'max_interval': config.get('max_interval_seconds', 1800)}
 
-    if len(prices) < price_array_min_length:
-        logger.error('Price fetching failed, not enough data was received')
+
+def get_retry_delay(schedule, attempt):
+    """Return the delay in seconds before the given retry attempt.
+
+    The delay grows exponentially and has a random jitter of up to half of the
+    delay so that retries of many clients are spread out.
+    """
+    delay = min(schedule['initial_interval'] * 2 ** attempt,
+                schedule['max_interval'])
+    return random.uniform(delay / 2, delay)  # noqa: S311
+
+
+def wait_for_prices(config, fetch_date, schedule, cache=None):
+    """Wait until the 15 minute prices of a date are published and return them.
+
+    Nothing is fetched before the expected publication time. After it fetching is
+    retried with a jittered exponential backoff until complete prices are received
+    or the deadline passes, after which a ValueError is raised. Request errors such
+    as connection failures, timeouts and HTTP server errors are retried the same
+    way.
+    """
+    publish_time = datetime.combine(fetch_date - timedelta(days=1),
+                                    schedule['publish_time'], tzinfo=HELSINKI_TZ)
+    deadline = publish_time + schedule['deadline']
+    attempt = 0
+
+    now = datetime.now(tz=HELSINKI_TZ)
+    if now < publish_time:
+        logger.info('Waiting until %s for the prices of %s to be published',
+                    publish_time, fetch_date)
+        sleep((publish_time - now).total_seconds())
+
+    while True:
+        try:
+            return fetch_prices(config, fetch_date, cache=cache)
+        except (ValueError, requests.RequestException) as error:
+            now = datetime.now(tz=HELSINKI_TZ)
+            if now >= deadline:
+                msg = f'Prices for {fetch_date} were not published by {deadline}'
+                raise ValueError(msg) from error
+
+            delay = min(get_retry_delay(schedule, attempt),
+                        (deadline - now).total_seconds())
+            attempt += 1
+            logger.info('Prices for %s are not available yet (%s), retrying in '
+                        '%.0f seconds', fetch_date, error, delay)
+            sleep(delay)
+
+
+def get_day_prices(config, fetch_date, verify_hourly=False, cache=None,
+                   schedule=None):
+    """Return the hourly and 15 minute consumer prices of a date.
+
+    The 15 minute prices are fetched once and the hourly prices are derived from
+    them. When a schedule is given the prices are waited for until they are
+    published. Optionally the derived hourly prices are verified against the
+    published ones. Raises a ValueError on failure.
+    """
+    prices = wait_for_prices(config, fetch_date, schedule, cache) if schedule \
+        else fetch_prices(config, fetch_date, cache=cache)
+    hourly_prices = derive_hourly_prices(prices)
+
+    if verify_hourly and not check_hourly_prices(
+            hourly_prices, fetch_prices(config, fetch_date, True, cache)):
+        msg = f'Hourly price verification for {fetch_date} failed'
+        raise ValueError(msg)
+
+    return (to_consumer_prices(hourly_prices), to_consumer_prices(prices))
+
+
+def fetch_and_store(config, dates, options, cache=None):
+    """Fetch and store electricity prices for the given dates.
+
+    Prices are fetched by a pool of worker threads and the prices of each date are
+    stored as soon as they have been received. The database connection is opened
+    when the first prices have been received as waiting for scheduled prices can
+    take hours. Returns the dates for which fetching or storing failed.
+    """
+    failed_dates = []
+
+    with ExitStack() as stack:
+        executor = stack.enter_context(
+            ThreadPoolExecutor(max_workers=options['workers']))
+        cursor = None
+
+        futures = {executor.submit(get_day_prices, config['fetch'], fetch_date,
+                                   options['verify_hourly'], cache,
+                                   options.get('schedule')): fetch_date
+                   for fetch_date in dates}
+        for future in as_completed(futures):
+            fetch_date = futures[future]
+            try:
+                hourly_prices, minute_prices = future.result()
+            except Exception:
+                logger.exception('Price fetch for %s failed', fetch_date)
+                failed_dates.append(fetch_date)
+                continue
+
+            if not cursor:
+                try:
+                    conn = stack.enter_context(
+                        psycopg.connect(create_db_conn_string(config['db'])))
+                except psycopg.Error:
+                    logger.exception('Database connection failed')
+                    executor.shutdown(cancel_futures=True)
+                    sys.exit(1)
+                cursor = stack.enter_context(conn.cursor())
+
+            if not store_prices(cursor, fetch_date, hourly_prices, minute_prices,
+                                config.get('fees')):
+                failed_dates.append(fetch_date)
+
+    return sorted(failed_dates)
+
+
+def get_fetch_dates(args):
+    """Return the dates to fetch prices for based on the command line arguments.
+
+    By default the next day is used.
+    """
+    tomorrow = datetime.now(tz=HELSINKI_TZ).date() + timedelta(days=1)
+
+    if args.date:
+        return [parse_date(args.date)]
+    if not args.from_date:
+        return [tomorrow]
+
+    start = parse_date(args.from_date)
+    end = parse_date(args.to_date) if args.to_date else tomorrow
+    if start > end:
+        logger.error('Range start date is after the end date')
         sys.exit(1)
 
-    store_prices(config['db'], prices, hourly)
+    return [start + timedelta(days=day) for day in range((end - start).days + 1)]
 
 
 def main():
@@ -136,8 +515,25 @@ def main():
                                      'into a database. By default fetches prices for '
                                      'the next day.')
     parser.add_argument('--config', type=str, help='configuration file to use')
-    parser.add_argument('--date', type=str, help='date (in YYYY-MM-DD format) for '
-                        'which to fetch data')
+    date_group = parser.add_mutually_exclusive_group()
+    date_group.add_argument('--date', type=str, help='date (in YYYY-MM-DD format) '
+                            'for which to fetch data')
+    date_group.add_argument('--from', type=str, dest='from_date',
+                            help='first date (in YYYY-MM-DD format) of a date range '
+                            'for which to fetch data')
+    parser.add_argument('--to', type=str, dest='to_date',
+                        help='last date (in YYYY-MM-DD format) of the date range, '
+                        'defaults to the next day')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of concurrent fetch workers (default: 4)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use cached API responses')
+    parser.add_argument('--schedule', action='store_true',
+                        help='wait until the prices are published and retry with '
+                        'a backoff until they are complete')
+    parser.add_argument('--verify-hourly', action='store_true',
+                        help='verify the derived hourly prices against the hourly '
+                        'prices published by Nord Pool')
 
     args = parser.parse_args()
     config_file = args.config or 'config.json'
@@ -149,11 +545,23 @@ def main():
     with Path(config_file).open('r', encoding='utf-8') as cfg_file:
         config = json.load(cfg_file)
 
-    # 60 minute resolution
-    fetch_and_store(config, args.date, True)
+    if args.to_date and not args.from_date:
+        logger.error('The --to flag requires the --from flag')
+        sys.exit(1)
 
-    # 15 minute resolution
-    fetch_and_store(config, args.date, False)
+    cache = None if args.no_cache else \
+        PriceCache(config.get('cache', {}).get('directory', 'cache'))
+
+    failed_dates = fetch_and_store(
+        config, get_fetch_dates(args),
+        {'workers': args.workers, 'verify_hourly': args.verify_hourly,
+         'schedule': get_schedule(config.get('schedule', {})) if args.schedule
+         else None},
+        cache)
+    if failed_dates:
+        logger.error('Storing prices failed for dates: %s',
+                     ', '.join(str(failed_date) for failed_date in failed_dates))
+        sys.exit(1)
 
     logger.info('Successfully stored electricity prices')
 
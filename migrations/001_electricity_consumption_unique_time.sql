@@ -0,0 +1,13 @@
+-- Make electricity consumption time values unique so that consumption data can
+-- be upserted. Duplicate rows are removed, the newest row of each time is kept.
+
+BEGIN;
+
+DELETE FROM electricity_consumption c
+USING electricity_consumption newer
+WHERE c.time = newer.time AND c.id < newer.id;
+
+ALTER TABLE electricity_consumption
+      ADD CONSTRAINT electricity_consumption_time_key UNIQUE (time);
+
+COMMIT;
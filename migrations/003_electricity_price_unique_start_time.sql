@@ -0,0 +1,20 @@
+-- Make electricity price start times unique so that prices can be upserted.
+-- Duplicate rows are removed, the newest row of each start time is kept.
+
+BEGIN;
+
+DELETE FROM electricity_price p
+USING electricity_price newer
+WHERE p.start_time = newer.start_time AND p.id < newer.id;
+
+ALTER TABLE electricity_price
+      ADD CONSTRAINT electricity_price_start_time_key UNIQUE (start_time);
+
+DELETE FROM electricity_price_minute p
+USING electricity_price_minute newer
+WHERE p.start_time = newer.start_time AND p.id < newer.id;
+
+ALTER TABLE electricity_price_minute
+      ADD CONSTRAINT electricity_price_minute_start_time_key UNIQUE (start_time);
+
+COMMIT;
@@ -0,0 +1,24 @@
+-- Add a daily electricity price index table which is updated by the price storage
+-- script. The index of existing days is created by running the script for them.
+
+BEGIN;
+
+-- Daily electricity price index computed from 15 minute prices by the price
+-- storage script, days are in Helsinki time and prices in cents / kWh with VAT
+CREATE TABLE electricity_price_index (
+       day DATE PRIMARY KEY,
+       slot_count SMALLINT NOT NULL,
+       -- 10th, 25th, 50th, 75th and 90th price percentiles
+       percentiles REAL[] NOT NULL,
+       -- price rank of each slot in time order, the cheapest slot has rank 1
+       slot_ranks SMALLINT[] NOT NULL,
+       -- start times and average prices of the cheapest and most expensive
+       -- contiguous windows, the Nth element is for a window of N hours
+       cheapest_start TIMESTAMP WITH TIME ZONE[] NOT NULL,
+       cheapest_avg REAL[] NOT NULL,
+       expensive_start TIMESTAMP WITH TIME ZONE[] NOT NULL,
+       expensive_avg REAL[] NOT NULL,
+       updated TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+COMMIT;
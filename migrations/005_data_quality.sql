@@ -0,0 +1,35 @@
+-- Add the findings and scanned chunk tables of the data quality scanner.
+
+BEGIN;
+
+-- Data quality findings of the data quality scanner
+CREATE TABLE data_quality_findings (
+       id SERIAL PRIMARY KEY,
+       table_name VARCHAR(40) NOT NULL,
+       column_name VARCHAR(40) NOT NULL,
+       row_id INTEGER NOT NULL,
+       time TIMESTAMP WITH TIME ZONE NOT NULL,
+       -- name of the rule the value violates: range, rate or zscore
+       rule VARCHAR(10) NOT NULL,
+       value REAL,
+       detail TEXT,
+       found TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+CREATE INDEX data_quality_findings_table_time_idx
+       ON data_quality_findings (table_name, time);
+
+-- Fingerprints of the time chunks scanned by the data quality scanner, a chunk
+-- is scanned again when its fingerprint or the rules of its table change
+CREATE TABLE data_quality_chunks (
+       table_name VARCHAR(40) NOT NULL,
+       chunk_start TIMESTAMP WITH TIME ZONE NOT NULL,
+       row_count INTEGER NOT NULL,
+       max_id INTEGER NOT NULL,
+       max_xmin BIGINT NOT NULL,
+       rules_hash CHAR(64) NOT NULL,
+       scanned TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
+       PRIMARY KEY (table_name, chunk_start)
+);
+
+COMMIT;
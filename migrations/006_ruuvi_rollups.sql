@@ -0,0 +1,57 @@
+-- Add downsampled RuuviTag and Ruuvi Air observation tables which are updated by
+-- the rollup script of the db-maintenance tools.
+
+BEGIN;
+
+-- Downsampled RuuviTag observations per device with a resolution of 5, 60
+-- or 1440 minutes, daily buckets are days in Helsinki time
+CREATE TABLE ruuvitag_observations_rollup (
+       resolution SMALLINT NOT NULL,
+       name VARCHAR(15) NOT NULL,
+       bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+       sample_count INTEGER NOT NULL,
+       temperature_min REAL,
+       temperature_avg REAL,
+       temperature_max REAL,
+       humidity_min REAL,
+       humidity_avg REAL,
+       humidity_max REAL,
+       pressure_min REAL,
+       pressure_avg REAL,
+       pressure_max REAL,
+       PRIMARY KEY (resolution, name, bucket)
+);
+
+-- Downsampled Ruuvi Air observations per device with a resolution of 5, 60
+-- or 1440 minutes, daily buckets are days in Helsinki time
+CREATE TABLE ruuvi_air_observations_rollup (
+       resolution SMALLINT NOT NULL,
+       name VARCHAR(15) NOT NULL,
+       bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+       sample_count INTEGER NOT NULL,
+       co2_min REAL,
+       co2_avg REAL,
+       co2_max REAL,
+       nox_min REAL,
+       nox_avg REAL,
+       nox_max REAL,
+       voc_min REAL,
+       voc_avg REAL,
+       voc_max REAL,
+       pm_2_5_min REAL,
+       pm_2_5_avg REAL,
+       pm_2_5_max REAL,
+       iaqs_min REAL,
+       iaqs_avg REAL,
+       iaqs_max REAL,
+       PRIMARY KEY (resolution, name, bucket)
+);
+
+-- Last raw row IDs aggregated into the rollup tables
+CREATE TABLE rollup_watermarks (
+       source_table VARCHAR(40) PRIMARY KEY,
+       last_id INTEGER NOT NULL,
+       updated TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+COMMIT;
@@ -0,0 +1,60 @@
+-- Divide the monthly base fees of the electricity rollups evenly for all days of
+-- a month instead of only the days which have consumption, like the cost
+-- calculation of env-logger does. Existing rollups are updated by calling
+-- refresh_electricity_rollup for each day.
+
+BEGIN;
+
+-- Refreshes the daily rollup of the given day and the monthly rollup of its month.
+-- Fees are in euros, base fees are monthly and are divided evenly for all days
+-- of a month. The monthly rollup includes the base fees of the days which do not
+-- have a daily rollup.
+CREATE OR REPLACE FUNCTION refresh_electricity_rollup(rollup_day DATE,
+       contract_margin DOUBLE PRECISION, transfer_fee DOUBLE PRECISION,
+       tax DOUBLE PRECISION, contract_base_fee DOUBLE PRECISION,
+       transfer_base_fee DOUBLE PRECISION) RETURNS VOID AS $$
+DECLARE
+       day_start TIMESTAMP WITH TIME ZONE :=
+                 rollup_day::timestamp AT TIME ZONE 'Europe/Helsinki';
+       day_end TIMESTAMP WITH TIME ZONE :=
+               (rollup_day + 1)::timestamp AT TIME ZONE 'Europe/Helsinki';
+       month_start DATE := date_trunc('month', rollup_day)::date;
+       month_days INTEGER := (month_start + INTERVAL '1 month')::date - month_start;
+BEGIN
+       INSERT INTO electricity_day_rollup (day, consumption, price_avg, price_count,
+                                           spot_cost, cost)
+       SELECT rollup_day, COALESCE(c.consumption, 0), p.price_avg, p.price_count,
+              COALESCE(c.spot_cost, 0),
+              COALESCE(c.spot_cost, 0) +
+              COALESCE(c.consumption, 0) * (contract_margin + transfer_fee + tax) +
+              (contract_base_fee + transfer_base_fee) / month_days
+       FROM (SELECT SUM(ec.consumption) AS consumption,
+                    SUM(ec.consumption * ep.price) / 100 AS spot_cost
+             FROM electricity_consumption ec
+             LEFT JOIN electricity_price ep ON ep.start_time = ec.time
+             WHERE ec.time >= day_start AND ec.time < day_end) c,
+            (SELECT AVG(price) AS price_avg, COUNT(price) AS price_count
+             FROM electricity_price
+             WHERE start_time >= day_start AND start_time < day_end) p
+       ON CONFLICT (day) DO UPDATE
+       SET consumption = EXCLUDED.consumption, price_avg = EXCLUDED.price_avg,
+           price_count = EXCLUDED.price_count, spot_cost = EXCLUDED.spot_cost,
+           cost = EXCLUDED.cost, updated = CURRENT_TIMESTAMP;
+
+       INSERT INTO electricity_month_rollup (month, consumption, price_avg,
+                                             spot_cost, cost)
+       SELECT month_start, SUM(consumption),
+              SUM(price_avg * price_count) / NULLIF(SUM(price_count), 0),
+              SUM(spot_cost),
+              SUM(cost) + (contract_base_fee + transfer_base_fee) *
+              (month_days - COUNT(*)) / month_days
+       FROM electricity_day_rollup
+       WHERE day >= month_start AND day < month_start + month_days
+       ON CONFLICT (month) DO UPDATE
+       SET consumption = EXCLUDED.consumption, price_avg = EXCLUDED.price_avg,
+           spot_cost = EXCLUDED.spot_cost, cost = EXCLUDED.cost,
+           updated = CURRENT_TIMESTAMP;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMIT;
@@ -12,10 +12,14 @@ import logging
 import smtplib
 import ssl
 import sys
-from datetime import datetime
+import threading
+from contextlib import contextmanager
+from datetime import UTC, datetime, timedelta
 from email.mime.text import MIMEText
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from os import environ
 from pathlib import Path
+from time import monotonic, sleep
 from zoneinfo import ZoneInfo
 
 import psycopg
@@ -23,6 +27,128 @@ import psycopg
 smtp_connection = None
 logger = logging.getLogger(__name__)
 
+# Metric names
+LAST_OBSERVATION = 'env_logger_last_observation_timestamp_seconds'
+LAST_OBSERVATION_AGE = 'env_logger_last_observation_age_seconds'
+CHECK_DURATION = 'env_logger_monitor_check_duration_seconds'
+DB_QUERY_DURATION = 'env_logger_monitor_db_query_duration_seconds'
+SMTP_SEND_DURATION = 'env_logger_monitor_smtp_send_duration_seconds'
+ALERT_ACTIVE = 'env_logger_monitor_alert_active'
+CHECK_FAILURES = 'env_logger_monitor_check_failures_total'
+
+METRIC_HELP = {
+    LAST_OBSERVATION: 'Recording time of the latest observation of a source',
+    LAST_OBSERVATION_AGE: 'Seconds since the latest observation of a source',
+    CHECK_DURATION: 'Duration of the latest monitor check',
+    DB_QUERY_DURATION: 'Duration of the database queries of the latest monitor check',
+    SMTP_SEND_DURATION: 'Duration of the latest email send',
+    ALERT_ACTIVE: 'Whether the alert condition of a monitor check is active',
+    CHECK_FAILURES: 'Number of monitor check runs which failed with a database error'
+}
+# Metrics which are counters, all other metrics are gauges
+COUNTER_METRICS = {CHECK_FAILURES}
+
+# Tables supported by the flatline monitor and the column identifying a sensor
+# in them
+FLATLINE_TABLES = {'observations': None,
+                   'ruuvitag_observations': 'name',
+                   'ruuvi_air_observations': 'name'}
+
+
+class Metrics:
+    """Class for collecting gauge and counter metrics in the Prometheus text format.
+
+    The observation age is derived from the stored observation timestamps when
+    the metrics are rendered so that it stays current between checks.
+    """
+
+    def __init__(self):
+        """Class constructor."""
+        self._lock = threading.Lock()
+        self._values = {name: {} for name in METRIC_HELP}
+
+    def set(self, metric, value, **labels):
+        """Set the value of a metric with the given labels."""
+        with self._lock:
+            self._values[metric][tuple(sorted(labels.items()))] = value
+
+    def increment(self, metric, **labels):
+        """Increment the value of a counter metric with the given labels."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[metric][key] = self._values[metric].get(key, 0) + 1
+
+    @contextmanager
+    def timer(self, metric, **labels):
+        """Set the duration of the wrapped block as the value of a metric."""
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.set(metric, monotonic() - start, **labels)
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        now = datetime.now(tz=UTC).timestamp()
+
+        with self._lock:
+            values = {name: dict(series) for name, series in self._values.items()}
+        values[LAST_OBSERVATION_AGE] = {labels: now - value for labels, value
+                                        in values[LAST_OBSERVATION].items()}
+
+        lines = []
+        for name, series in values.items():
+            if not series:
+                continue
+            lines.append(f'# HELP {name} {METRIC_HELP[name]}')
+            lines.append(f'# TYPE {name} '
+                         f'{"counter" if name in COUNTER_METRICS else "gauge"}')
+            for labels, value in series.items():
+                label_str = ','.join(f'{key}="{escape_label_value(str(val))}"'
+                                     for key, val in labels)
+                lines.append(f'{name}{{{label_str}}} {value}' if label_str
+                             else f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, file_name):
+        """Write the metrics into a file for the node exporter textfile collector.
+
+        The file is replaced atomically so that a partial file is never read.
+        """
+        tmp_file = Path(f'{file_name}.tmp')
+        tmp_file.write_text(self.render(), encoding='utf-8')
+        tmp_file.replace(file_name)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Request handler serving the metrics from the /metrics path."""
+
+    def do_GET(self):
+        """Serve the metrics."""
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # noqa: A002
+        """Log requests at the debug level."""
+        logger.debug(format, *args)
+
+
+def escape_label_value(value):
+    """Escape a metric label value."""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
+
 
 class ObservationMonitor:
     """Class for monitoring environment observations."""
@@ -34,11 +160,15 @@ class ObservationMonitor:
 
     def get_obs_time(self):
         """Return the recording time of the latest observation."""
-        with psycopg.connect(create_db_conn_string(self._config['db'])) as conn, \
+        with metrics.timer(DB_QUERY_DURATION, check='observation'), \
+             psycopg.connect(create_db_conn_string(self._config['db'])) as conn, \
              conn.cursor() as cursor:
             cursor.execute('SELECT recorded FROM observations '
                            'ORDER BY id DESC LIMIT 1')
             result = cursor.fetchone()
+            if result:
+                metrics.set(LAST_OBSERVATION, result[0].timestamp(),
+                            source='observation')
             return result[0] if result else datetime.now(
                 tz=ZoneInfo(self._config['db']['DisplayTimezone']))
 
@@ -54,8 +184,11 @@ class ObservationMonitor:
                     ZoneInfo(self._config['db']['DisplayTimezone']))
         time_diff = datetime.now(tz=last_obs_time.tzinfo) - last_obs_time
 
-        if int(time_diff.total_seconds() / 60) > \
-           int(self._config['observation']['Timeout']):
+        inactive = int(time_diff.total_seconds() / 60) > \
+            int(self._config['observation']['Timeout'])
+        metrics.set(ALERT_ACTIVE, int(inactive), check='observation')
+
+        if inactive:
             logger.warning('No observations received since %s',
                            last_obs_time_tz.isoformat())
             if self._state['email_sent'] == 'False':
@@ -103,7 +236,8 @@ class ObservationsColumnMonitor:
         timezone = ZoneInfo(self._config['db']['DisplayTimezone'])
         current_dt = datetime.now(tz=timezone)
 
-        with psycopg.connect(create_db_conn_string(self._config['db'])) as conn, \
+        with metrics.timer(DB_QUERY_DURATION, check=self._column_name), \
+             psycopg.connect(create_db_conn_string(self._config['db'])) as conn, \
              conn.cursor() as cursor:
             cursor.execute(f'SELECT {self._column_name}, recorded FROM observations '  # noqa: S608
                            'ORDER BY id DESC LIMIT 1')
@@ -121,6 +255,9 @@ class ObservationsColumnMonitor:
                                        self._column_human_name,
                                        recorded_tz.isoformat())
                         return (True, recorded_tz.isoformat())
+            else:
+                metrics.set(LAST_OBSERVATION, result[1].timestamp(),
+                            source=self._column_name)
 
             return (False, result[1].astimezone(timezone))
 
@@ -132,6 +269,7 @@ class ObservationsColumnMonitor:
         logger.info('Starting %s value inactivity check', self._column_human_name)
 
         column_status, last_recorded = self.check_column_status()
+        metrics.set(ALERT_ACTIVE, int(column_status), check=self._column_name)
 
         if column_status:
             if self._state['email_sent'] == 'False':
@@ -170,11 +308,15 @@ class BeaconMonitor:
 
     def get_beacon_scan_time(self):
         """Return the recording time of the latest BLE beacon scan."""
-        with psycopg.connect(create_db_conn_string(self._config['db'])) as conn, \
+        with metrics.timer(DB_QUERY_DURATION, check='blebeacon'), \
+             psycopg.connect(create_db_conn_string(self._config['db'])) as conn, \
              conn.cursor() as cursor:
             cursor.execute('SELECT recorded FROM observations WHERE id = '
                            '(SELECT obs_id FROM beacons ORDER BY id DESC LIMIT 1)')
             result = cursor.fetchone()
+            if result:
+                metrics.set(LAST_OBSERVATION, result[0].timestamp(),
+                            source='blebeacon')
             return result[0] if result else datetime.now(
                 tz=ZoneInfo(self._config['db']['DisplayTimezone']))
 
@@ -191,8 +333,11 @@ class BeaconMonitor:
         time_diff = datetime.now(tz=last_obs_time.tzinfo) - last_obs_time
 
         # Timeout is in hours
-        if int(time_diff.total_seconds()) > \
-           int(self._config['blebeacon']['Timeout']) * 60 * 60:
+        inactive = int(time_diff.total_seconds()) > \
+            int(self._config['blebeacon']['Timeout']) * 60 * 60
+        metrics.set(ALERT_ACTIVE, int(inactive), check='blebeacon')
+
+        if inactive:
             logger.warning('No BLE beacon has been scanned after %s',
                            last_obs_time_tz.isoformat())
             if self._state['email_sent'] == 'False' and \
@@ -228,13 +373,17 @@ class RuuvitagMonitor:
         """Return recording time of the latest RuuviTag beacon observation."""
         results = {}
 
-        with psycopg.connect(create_db_conn_string(self._config['db'])) as conn, \
+        with metrics.timer(DB_QUERY_DURATION, check='ruuvitag'), \
+             psycopg.connect(create_db_conn_string(self._config['db'])) as conn, \
              conn.cursor() as cursor:
             for name in self._config['ruuvitag']['Name'].split(','):
                 cursor.execute(t"""SELECT recorded FROM ruuvitag_observations WHERE
                 name = {name} ORDER BY recorded DESC LIMIT 1""")
 
                 result = cursor.fetchone()
+                if result:
+                    metrics.set(LAST_OBSERVATION, result[0].timestamp(),
+                                source='ruuvitag', name=name)
                 results[name] = result[0] if result else datetime.now(
                     tz=ZoneInfo(self._config['db']['DisplayTimezone']))
 
@@ -256,8 +405,11 @@ class RuuvitagMonitor:
                 ZoneInfo(self._config['db']['DisplayTimezone']))
 
             # Timeout is in minutes
-            if int(time_diff.total_seconds()) > \
-               int(self._config['ruuvitag']['Timeout']) * 60:
+            inactive = int(time_diff.total_seconds()) > \
+                int(self._config['ruuvitag']['Timeout']) * 60
+            metrics.set(ALERT_ACTIVE, int(inactive), check='ruuvitag', name=name)
+
+            if inactive:
                 if self._state[name]['email_sent'] == 'False':
                     logger.warning('No RuuviTag observation for name "%s" has '
                                    'been scanned after %s',
@@ -289,6 +441,190 @@ class RuuvitagMonitor:
         return self._state
 
 
+class FlatlineMonitor:
+    """Class for detecting stuck sensors and impossible value jumps.
+
+    Statistics are computed with SQL window aggregates over the rows received
+    since the previous check.
+    """
+
+    def __init__(self, config, state):
+        """Class constructor."""
+        self._config = config
+        self._state = state
+        self._window = timedelta(minutes=int(config['flatline']['Window']))
+        self._min_samples = int(config['flatline']['MinSamples'])
+        self._min_variance = float(config['flatline']['MinVariance'])
+        self._max_step_gap = timedelta(
+            minutes=int(config['flatline'].get('MaxStepGap', '15')))
+
+    def get_columns(self):
+        """Return the (table, column, maximum step) values to check.
+
+        The maximum step is None when jump detection is not enabled for a column.
+        """
+        columns = []
+
+        for value in self._config['flatline']['Columns'].split(','):
+            name, _, max_step = value.strip().partition(':')
+            table, _, column = name.partition('.')
+            if table not in FLATLINE_TABLES or not column.isidentifier():
+                logger.error('Invalid flatline check column "%s", skipping', value)
+                continue
+            columns.append((table, column, float(max_step) if max_step else None))
+
+        return columns
+
+    def get_window_stats(self, cursor, table, column, since):
+        """Return windowed statistics of a column for values recorded after since.
+
+        One row per sensor is returned containing the latest recording time, the
+        variance, number of value changes and sample count of the window ending at
+        the latest value, and the largest step change among the new values with its
+        recording time. Steps over gaps longer than the maximum step gap, e.g. after
+        a sensor outage, are ignored.
+        """
+        sensor = FLATLINE_TABLES[table] or "''"
+        # Values recorded during the window before since are only used as context
+        # for the windows of the new values
+        cursor.execute(f"""
+        WITH steps AS (
+            SELECT {sensor} AS sensor, recorded, {column}::double precision AS value,
+                   {column} - LAG({column}) OVER p AS change,
+                   recorded - LAG(recorded) OVER p AS gap
+            FROM {table}
+            WHERE recorded > %(since)s - %(window)s AND {column} IS NOT NULL
+            WINDOW p AS (PARTITION BY {sensor} ORDER BY recorded)
+        ), windows AS (
+            SELECT sensor, recorded,
+                   CASE WHEN gap <= %(max_step_gap)s THEN change END AS step,
+                   VAR_POP(value) OVER w AS variance,
+                   COUNT(NULLIF(change, 0)) OVER w AS changes,
+                   COUNT(*) OVER w AS samples
+            FROM steps
+            WINDOW w AS (PARTITION BY sensor ORDER BY recorded
+                         RANGE BETWEEN %(window)s::interval PRECEDING AND CURRENT ROW)
+        )
+        SELECT sensor, MAX(recorded),
+               (ARRAY_AGG(variance ORDER BY recorded DESC))[1],
+               (ARRAY_AGG(changes ORDER BY recorded DESC))[1],
+               (ARRAY_AGG(samples ORDER BY recorded DESC))[1],
+               MAX(ABS(step)),
+               (ARRAY_AGG(recorded ORDER BY ABS(step) DESC NULLS LAST))[1]
+        FROM windows
+        WHERE recorded > %(since)s
+        GROUP BY sensor""",  # noqa: S608
+                       {'since': since, 'window': self._window,
+                        'max_step_gap': self._max_step_gap})
+
+        return cursor.fetchall()
+
+    def check_flatline(self):
+        """Check the configured columns for flatlined values and value jumps.
+
+        Sends an email if a sensor flatlines, recovers or its value jumps more than
+        allowed.
+        """
+        logger.info('Starting flatline and value jump check')
+
+        timezone = ZoneInfo(self._config['db']['DisplayTimezone'])
+        current_dt = datetime.now(tz=timezone)
+
+        with metrics.timer(DB_QUERY_DURATION, check='flatline'), \
+             psycopg.connect(create_db_conn_string(self._config['db'])) as conn, \
+             conn.cursor() as cursor:
+            for table, column, max_step in self.get_columns():
+                key = f'{table}.{column}'
+                column_state = self._state.setdefault(key, {'last_recorded': None,
+                                                            'sensors': {}})
+                since = datetime.fromisoformat(column_state['last_recorded']) \
+                    if column_state['last_recorded'] else current_dt - self._window
+
+                stats = self.get_window_stats(cursor, table, column, since)
+                for (sensor, last_recorded, variance, changes, samples,
+                     step, step_recorded) in stats:
+                    label = f'{key} ({sensor})' if sensor else key
+                    sensor_state = column_state['sensors'].setdefault(
+                        sensor, {'email_sent': 'False'})
+
+                    if max_step is not None:
+                        self.handle_jump(label, sensor_state, max_step, step,
+                                         step_recorded.astimezone(timezone))
+
+                    self.handle_flatline(label, sensor_state,
+                                         samples >= self._min_samples and
+                                         (changes == 0 or
+                                          variance <= self._min_variance),
+                                         last_recorded.astimezone(timezone))
+
+                if stats:
+                    column_state['last_recorded'] = max(
+                        row[1] for row in stats).isoformat()
+
+    def handle_jump(self, label, sensor_state, max_step, step, step_recorded):
+        """Handle the value jump status of a single sensor value.
+
+        Sends an email once when the value changes more than allowed and again
+        when the changes are back within the allowed limits.
+        """
+        jumped = step is not None and step > max_step
+        metrics.set(ALERT_ACTIVE, int(jumped), check='value_jump', name=label)
+        jump_email_sent = sensor_state.setdefault('jump_email_sent', 'False')
+
+        if jumped:
+            logger.warning('Value of %s changed by %s at %s', label, step,
+                           step_recorded.isoformat())
+            if jump_email_sent == 'False' and \
+               send_email(self._config['email'],
+                          f'env-logger: {label} value jump warning',
+                          f'The value of {label} changed by {step} at '
+                          f'{step_recorded.isoformat()} which exceeds the maximum '
+                          f'allowed change of {max_step}. Please check for '
+                          'possible problems.'):
+                sensor_state['jump_email_sent'] = 'True'
+        elif jump_email_sent == 'True':
+            send_email(self._config['email'],
+                       f'env-logger: {label} value jumps stopped',
+                       f'The value of {label} has changed within the allowed '
+                       'limits since the previous check.')
+            logger.info('Value of %s has changed within the allowed limits', label)
+            sensor_state['jump_email_sent'] = 'False'
+
+    def handle_flatline(self, label, sensor_state, flatlined, last_recorded):
+        """Handle the flatline status of a single sensor value.
+
+        Sends an email if the value has flatlined or recovered.
+        """
+        window_minutes = int(self._window.total_seconds() / 60)
+        metrics.set(ALERT_ACTIVE, int(flatlined), check='flatline', name=label)
+
+        if flatlined:
+            logger.warning('Value of %s has not changed in %s minutes before %s',
+                           label, window_minutes, last_recorded.isoformat())
+            if sensor_state['email_sent'] == 'False':
+                if send_email(self._config['email'],
+                              f'env-logger: {label} flatline warning',
+                              f'The value of {label} has not changed in the '
+                              f'{window_minutes} minutes before '
+                              f'{last_recorded.isoformat()}. Please check for '
+                              'possible problems.'):
+                    sensor_state['email_sent'] = 'True'
+                else:
+                    sensor_state['email_sent'] = 'False'
+        elif sensor_state['email_sent'] == 'True':
+            send_email(self._config['email'],
+                       f'env-logger: {label} value changing',
+                       f'The value of {label} is changing again at '
+                       f'{last_recorded.isoformat()}.')
+            logger.info('Value of %s is changing again at %s', label,
+                        last_recorded.isoformat())
+            sensor_state['email_sent'] = 'False'
+
+    def get_state(self):
+        """Return the flatline check state."""
+        return self._state
+
+
 def create_smtp_connection(config):
     """Create a SMTP SSL connection which can be used to send email."""
     email_username = environ['EMAIL_USERNAME'] if 'EMAIL_USERNAME' in environ \
@@ -321,6 +657,12 @@ def send_email(config, subject, message):
     msg['From'] = config['Sender']
     msg['To'] = config['Recipient']
 
+    with metrics.timer(SMTP_SEND_DURATION):
+        return _send_message(config, msg)
+
+
+def _send_message(config, msg):
+    """Send a message over the shared SMTP connection, opening it when needed."""
     global smtp_connection  # noqa: PLW0603
 
     if not smtp_connection:
@@ -333,7 +675,7 @@ def send_email(config, subject, message):
         smtp_connection.send_message(msg)
     except smtplib.SMTPException:
         logger.exception('Failed to send email with subject "%s"',
-                          subject)
+                          msg['Subject'])
         return False
 
     return True
@@ -363,14 +705,90 @@ def create_db_conn_string(db_config):
     )
 
 
+def run_checks(config, state):
+    """Run the enabled monitor checks and update the state accordingly."""
+    if config['observation']['Enabled'] == 'True':
+        with metrics.timer(CHECK_DURATION, check='observation'):
+            obs = ObservationMonitor(config, state['observation'])
+            obs.check_observation()
+            state['observation'] = obs.get_state()
+    if config['outsidetemp']['Enabled'] == 'True':
+        with metrics.timer(CHECK_DURATION, check='outside_temperature'):
+            otm = ObservationsColumnMonitor(config, state['outsidetemp'],
+                                            config['outsidetemp']['Timeout'],
+                                            'outside_temperature',
+                                            'outside temperature')
+            otm.handle_status_data()
+            state['outsidetemp'] = otm.get_state()
+    if config['outsidelight']['Enabled'] == 'True':
+        with metrics.timer(CHECK_DURATION, check='outside_light'):
+            olm = ObservationsColumnMonitor(config, state['outsidelight'],
+                                            config['outsidelight']['Timeout'],
+                                            'outside_light', 'outside light')
+            olm.handle_status_data()
+            state['outsidelight'] = olm.get_state()
+    if config['blebeacon']['Enabled'] == 'True':
+        with metrics.timer(CHECK_DURATION, check='blebeacon'):
+            beacon = BeaconMonitor(config, state['blebeacon'])
+            beacon.check_beacon()
+            state['blebeacon'] = beacon.get_state()
+    if config['ruuvitag']['Enabled'] == 'True':
+        with metrics.timer(CHECK_DURATION, check='ruuvitag'):
+            ruuvitag = RuuvitagMonitor(config, state['ruuvitag'])
+            ruuvitag.check_ruuvitag()
+            state['ruuvitag'] = ruuvitag.get_state()
+    if config.has_section('flatline') and config['flatline']['Enabled'] == 'True':
+        with metrics.timer(CHECK_DURATION, check='flatline'):
+            flatline = FlatlineMonitor(config, state.get('flatline', {}))
+            flatline.check_flatline()
+            state['flatline'] = flatline.get_state()
+
+
+def run_checks_safely(config, state):
+    """Run the monitor checks counting and logging database errors.
+
+    Returns True on success and False otherwise.
+    """
+    try:
+        run_checks(config, state)
+    except psycopg.Error:
+        # Each check opens its own database connection so the next run
+        # reconnects after e.g. a database restart
+        logger.exception('Monitor checks failed')
+        metrics.increment(CHECK_FAILURES)
+        return False
+
+    return True
+
+
+def start_metrics_server(port):
+    """Start a HTTP server serving the metrics in a background thread."""
+    server = ThreadingHTTPServer(('', port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('Serving metrics on port %s', port)
+
+
 def main():  # noqa: C901
     """Run the module code."""
+    global smtp_connection  # noqa: PLW0603
+
     logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
                         level=logging.INFO)
 
     parser = argparse.ArgumentParser(description='Monitors observation reception.')
     parser.add_argument('--config', type=str, help='configuration file to use '
                         '(default: monitor.cfg)')
+    parser.add_argument('--daemon', action='store_true',
+                        help='run the checks repeatedly and serve metrics over HTTP')
+    parser.add_argument('--interval', type=int, default=60,
+                        help='interval between checks in seconds in daemon mode '
+                        '(default: 60)')
+    parser.add_argument('--metrics-port', type=int, default=9877,
+                        help='port of the metrics HTTP server in daemon mode '
+                        '(default: 9877)')
+    parser.add_argument('--metrics-file', type=str,
+                        help='file to write metrics into after the checks, e.g. for '
+                        'the node exporter textfile collector')
 
     args = parser.parse_args()
     config_file = args.config or 'monitor.cfg'
@@ -405,36 +823,27 @@ def main():  # noqa: C901
             state['ruuvitag'][name] = {}
             state['ruuvitag'][name]['email_sent'] = 'False'
 
-    if config['observation']['Enabled'] == 'True':
-        obs = ObservationMonitor(config, state['observation'])
-        obs.check_observation()
-        state['observation'] = obs.get_state()
-    if config['outsidetemp']['Enabled'] == 'True':
-        otm = ObservationsColumnMonitor(config, state['outsidetemp'],
-                                        config['outsidetemp']['Timeout'],
-                                        'outside_temperature', 'outside temperature')
-        otm.handle_status_data()
-        state['outsidetemp'] = otm.get_state()
-    if config['outsidelight']['Enabled'] == 'True':
-        olm = ObservationsColumnMonitor(config, state['outsidelight'],
-                                        config['outsidelight']['Timeout'],
-                                        'outside_light', 'outside light')
-        olm.handle_status_data()
-        state['outsidelight'] = olm.get_state()
-    if config['blebeacon']['Enabled'] == 'True':
-        beacon = BeaconMonitor(config, state['blebeacon'])
-        beacon.check_beacon()
-        state['blebeacon'] = beacon.get_state()
-    if config['ruuvitag']['Enabled'] == 'True':
-        ruuvitag = RuuvitagMonitor(config, state['ruuvitag'])
-        ruuvitag.check_ruuvitag()
-        state['ruuvitag'] = ruuvitag.get_state()
+    if args.daemon:
+        start_metrics_server(args.metrics_port)
+
+    while True:
+        success = run_checks_safely(config, state)
+
+        with Path(state_file_name).open('w', encoding='utf-8') as state_file:
+            json.dump(state, state_file, indent=4)
+
+        if args.metrics_file:
+            metrics.write_textfile(args.metrics_file)
 
-    with Path(state_file_name).open('w', encoding='utf-8') as state_file:
-        json.dump(state, state_file, indent=4)
+        if smtp_connection:
+            smtp_connection.quit()
+            smtp_connection = None
 
-    if smtp_connection:
-        smtp_connection.quit()
+        if not args.daemon:
+            if not success:
+                sys.exit(1)
+            break
+        sleep(args.interval)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""A program for reporting the availability of env-logger data sources.
+
+Outages are found with a gaps-and-islands analysis of observation times which is
+done one day at a time. The outages of complete days are cached so that repeated
+reports only query days which have not been seen before.
+"""
+
+import argparse
+import configparser
+import json
+import logging
+import sys
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+import psycopg
+
+from monitor import create_db_conn_string
+
+logger = logging.getLogger(__name__)
+
+
+def get_sources(config):
+    """Return the data sources to report on.
+
+    Each source is a (key, table, time column, name, maximum gap) tuple where the
+    name is used to select a device from tables containing many of them.
+    """
+    report_config = config['report']
+    sources = [('observations', 'observations', 'recorded', None,
+                timedelta(minutes=int(report_config['ObservationGap']))),
+               ('weather_data', 'weather_data', 'time', None,
+                timedelta(minutes=int(report_config['WeatherGap'])))]
+
+    sources.extend((f'ruuvitag_observations ({name})', 'ruuvitag_observations',
+                    'recorded', name,
+                    timedelta(minutes=int(report_config['RuuvitagGap'])))
+                   for name in config['ruuvitag']['Name'].split(','))
+    sources.extend((f'ruuvi_air_observations ({name})', 'ruuvi_air_observations',
+                    'recorded', name,
+                    timedelta(minutes=int(report_config['RuuviAirGap'])))
+                   for name in filter(None,
+                                      report_config.get('RuuviAirName', '').split(',')))
+
+    return sources
+
+
+def find_outages(cursor, source, start, end):
+    """Return the outages of a source within the [start, end) interval.
+
+    Consecutive observation times more than the maximum gap apart form an outage.
+    Observations within the maximum gap outside the interval are included so that
+    outages crossing the interval boundaries are detected, the boundaries
+    themselves act as observations when there are none. Returned outages are
+    clipped to the interval.
+    """
+    _, table, time_column, name, max_gap = source
+    name_filter = 'AND name = %(name)s' if name else ''
+
+    cursor.execute(f"""
+    WITH points AS (
+        SELECT {time_column} AS point FROM {table}
+        WHERE {time_column} >= %(lower)s AND {time_column} < %(upper)s {name_filter}
+        UNION ALL SELECT %(lower)s
+        UNION ALL SELECT %(upper)s
+    ), gaps AS (
+        SELECT LAG(point) OVER (ORDER BY point) AS gap_start, point AS gap_end
+        FROM points
+    )
+    SELECT GREATEST(gap_start, %(start)s), LEAST(gap_end, %(end)s)
+    FROM gaps
+    WHERE gap_end - gap_start > %(max_gap)s
+          AND gap_end > %(start)s AND gap_start < %(end)s
+    ORDER BY gap_start""",  # noqa: S608
+                   {'lower': start - max_gap,
+                    'upper': min(end + max_gap, datetime.now(tz=start.tzinfo)),
+                    'start': start, 'end': end, 'max_gap': max_gap, 'name': name})
+
+    return cursor.fetchall()
+
+
+def get_day_outages(cursor, cache, source, day, timezone):
+    """Return the outages of a source on the given day.
+
+    Outages of complete days are read from and stored into the cache.
+    """
+    key, _, _, _, max_gap = source
+    source_cache = cache.setdefault(key, {'max_gap': max_gap.total_seconds(),
+                                          'days': {}})
+    if source_cache['max_gap'] != max_gap.total_seconds():
+        # Cached outages are not valid for a different gap length
+        source_cache.update({'max_gap': max_gap.total_seconds(), 'days': {}})
+
+    if day.isoformat() in source_cache['days']:
+        return [(datetime.fromisoformat(start), datetime.fromisoformat(end))
+                for start, end in source_cache['days'][day.isoformat()]]
+
+    now = datetime.now(tz=timezone)
+    start = datetime(day.year, day.month, day.day, tzinfo=timezone)
+    end = min(datetime.combine(day + timedelta(days=1), datetime.min.time(),
+                               tzinfo=timezone), now)
+    outages = find_outages(cursor, source, start, end)
+
+    if end + max_gap <= now:
+        source_cache['days'][day.isoformat()] = [
+            (outage_start.isoformat(), outage_end.isoformat())
+            for outage_start, outage_end in outages]
+
+    return outages
+
+
+def merge_outages(outages):
+    """Merge consecutive outages split at day boundaries."""
+    merged = []
+
+    for start, end in outages:
+        if merged and merged[-1][1] == start:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def create_report(config, cache, start_date, end_date):
+    """Create an availability report for the [start_date, end_date] range.
+
+    Returns a dictionary with the availability percentage and outages of each
+    source.
+    """
+    timezone = ZoneInfo(config['db']['DisplayTimezone'])
+    range_start = datetime(start_date.year, start_date.month, start_date.day,
+                           tzinfo=timezone)
+    range_end = min(datetime.combine(end_date + timedelta(days=1),
+                                     datetime.min.time(), tzinfo=timezone),
+                    datetime.now(tz=timezone))
+    report = {}
+
+    with psycopg.connect(create_db_conn_string(config['db'])) as conn, \
+         conn.cursor() as cursor:
+        for source in get_sources(config):
+            logger.info('Analysing source %s', source[0])
+            outages = []
+            day = start_date
+            while day <= end_date and \
+                  datetime(day.year, day.month, day.day, tzinfo=timezone) < range_end:
+                outages.extend(get_day_outages(cursor, cache, source, day, timezone))
+                day += timedelta(days=1)
+
+            missing = sum((end - start).total_seconds() for start, end in outages)
+            report[source[0]] = {
+                'availability': round(100 * (1 - missing / (range_end - range_start)
+                                             .total_seconds()), 2),
+                'missing_minutes': round(missing / 60),
+                'outages': merge_outages(outages)
+            }
+
+    return report
+
+
+def print_report(report, timezone):
+    """Print the availability report."""
+    print(f'{"Source":<40}{"Availability (%)":>18}{"Missing (min)":>16}')
+    for key, values in report.items():
+        print(f'{key:<40}{values["availability"]:>18.2f}'
+              f'{values["missing_minutes"]:>16}')
+
+    for key, values in report.items():
+        if not values['outages']:
+            continue
+        print(f'\nOutages of {key}:')
+        for start, end in values['outages']:
+            print(f'  {start.astimezone(timezone).isoformat(timespec="minutes")} - '
+                  f'{end.astimezone(timezone).isoformat(timespec="minutes")} '
+                  f'({round((end - start).total_seconds() / 60)} min)')
+
+
+def main():
+    """Run the module code."""
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Reports the availability and '
+                                     'outages of observation data sources.')
+    parser.add_argument('--config', type=str, help='configuration file to use '
+                        '(default: monitor.cfg)')
+    parser.add_argument('--start', type=date.fromisoformat, required=True,
+                        help='first day (in YYYY-MM-DD format) of the report')
+    parser.add_argument('--end', type=date.fromisoformat,
+                        help='last day (in YYYY-MM-DD format) of the report '
+                        '(default: today)')
+
+    args = parser.parse_args()
+    config_file = args.config or 'monitor.cfg'
+
+    if not Path(config_file).exists():
+        logger.error('Could not find configuration file "%s"', config_file)
+        sys.exit(1)
+
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    timezone = ZoneInfo(config['db']['DisplayTimezone'])
+    end_date = args.end or datetime.now(tz=timezone).date()
+
+    if args.start > end_date:
+        logger.error('Report start date is after the end date')
+        sys.exit(1)
+
+    cache_file = Path(config['report'].get('CacheFile', 'report_cache.json'))
+    try:
+        with cache_file.open('r', encoding='utf-8') as cache_fd:
+            cache = json.load(cache_fd)
+    except FileNotFoundError:
+        cache = {}
+
+    report = create_report(config, cache, args.start, end_date)
+
+    with cache_file.open('w', encoding='utf-8') as cache_fd:
+        json.dump(cache, cache_fd)
+
+    print_report(report, timezone)
+
+
+if __name__ == '__main__':
+    main()
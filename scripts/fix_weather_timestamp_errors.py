@@ -3,47 +3,179 @@
 """Fix odd weather timestamp values in the database.
 
 Sometimes the timestamp is off by many hours from the previous and this script
-fixes those.
+fixes those. Consecutive rows with erroneous timestamps are grouped into runs in
+ID order with window functions in the database, each run starting where the time
+drops behind the previous row and ending where it jumps back forward, and each run
+is fixed as a whole. The results are streamed through a server-side cursor, so
+the whole table can be processed. Fixes are applied in
+batches and the ID of the last fixed row is stored in a checkpoint file so that
+an interrupted run can be resumed.
 """
 
-from datetime import timedelta
+import argparse
+from datetime import date, timedelta
+from pathlib import Path
 
 import psycopg
 
 
+def find_errors(conn, args, start_id):
+    """Yield the rows of the runs of timestamps which are too far behind.
+
+    A run starts at a row whose time is at least the threshold behind the previous
+    row and ends before the next row whose time is at least the threshold ahead of
+    its previous row. Each row is a (id, time, time before the run, time after the
+    run, corrected time) tuple. The times of a run are moved forward by the same
+    whole hours so that the run starts after the time before it. Runs which are
+    longer than the maximum run length or whose corrected times are not before the
+    time after the run are ambiguous as the rows before the run may be the
+    erroneous ones, their corrected time is None.
+
+    When resuming, the rows are read from the last row before the given start ID
+    so that the rows after it are compared against their predecessors. The date
+    range is applied to the recording times of the observations of the rows, as
+    the times of the rows are the ones being repaired.
+    """
+    conditions = [('w.id >= (SELECT COALESCE(MAX(id), 0) FROM weather_data '
+                   'WHERE id < %(start_id)s)')]
+    if args.start:
+        conditions.append('o.recorded >= %(start)s')
+    if args.end:
+        conditions.append('o.recorded < %(end)s')
+
+    with conn.cursor(name='weather_timestamp_errors', withhold=True) as cursor:
+        cursor.itersize = args.batch_size
+        cursor.execute(f"""
+        WITH neighbours AS (
+            SELECT w.id, w.time, LAG(w.time) OVER (ORDER BY w.id) AS prev_time,
+                   LEAD(w.time) OVER (ORDER BY w.id) AS next_time
+            FROM weather_data w
+            JOIN observations o ON o.id = w.obs_id
+            WHERE {' AND '.join(conditions)}
+        ), islands AS (
+            SELECT id, time, prev_time, next_time,
+                   prev_time - time >= %(threshold)s AS is_drop,
+                   COUNT(*) FILTER (WHERE prev_time - time >= %(threshold)s OR
+                                          time - prev_time >= %(threshold)s)
+                       OVER (ORDER BY id) AS island
+            FROM neighbours
+        ), runs AS (
+            SELECT id, time,
+                   FIRST_VALUE(is_drop) OVER w AS is_run,
+                   FIRST_VALUE(prev_time) OVER w AS before_time,
+                   LAST_VALUE(next_time) OVER w AS after_time,
+                   LAST_VALUE(time) OVER w AS last_time,
+                   COUNT(*) OVER w AS run_length,
+                   make_interval(hours => floor(EXTRACT(EPOCH FROM
+                       FIRST_VALUE(prev_time) OVER w - FIRST_VALUE(time) OVER w)
+                       / 3600)::integer + 1) AS shift
+            FROM islands
+            WINDOW w AS (PARTITION BY island ORDER BY id
+                         ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+        )
+        SELECT id, time, before_time, after_time,
+               CASE WHEN run_length <= %(max_run)s AND
+                         (after_time IS NULL OR after_time > last_time + shift)
+                    THEN time + shift END
+        FROM runs
+        WHERE is_run AND id > %(start_id)s
+        ORDER BY id""",  # noqa: S608
+                       {'start_id': start_id, 'start': args.start,
+                        'end': args.end + timedelta(days=1) if args.end else None,
+                        'threshold': timedelta(hours=args.threshold),
+                        'max_run': args.max_run})
+        yield from cursor
+
+
+def apply_fixes(conn, fixes):
+    """Update the timestamps of the given (id, corrected time) rows at once."""
+    values = ', '.join(['(%s, %s::timestamptz)'] * len(fixes))
+    with conn.cursor() as cursor:
+        cursor.execute('UPDATE weather_data w SET time = v.time '  # noqa: S608
+                       f'FROM (VALUES {values}) AS v(id, time) WHERE w.id = v.id',
+                       [value for fix in fixes for value in fix])
+    conn.commit()
+
+
+def read_checkpoint(checkpoint_file):
+    """Return the last fixed row ID from the checkpoint file or zero."""
+    if not checkpoint_file.exists():
+        return 0
+    return int(checkpoint_file.read_text(encoding='utf-8').strip())
+
+
 def main():
     """Run the weather timestamp fix."""
-    threshold_hours = 3
-    # Change these as necessary
-    db_name = 'env_logger'
-    row_limit = 4000
-
-    with psycopg.connect(f'dbname={db_name}') as conn, conn.cursor() as cursor:
-        cursor.execute('SELECT id, time FROM weather_data ORDER by id DESC '
-                       'LIMIT %s',
-                       (row_limit,))
-        rows = cursor.fetchall()
-        i = 0
-
-        while i < len(rows):
-            diff_hours = (rows[i][1] - rows[i + 1][1]).total_seconds() / 3600
-            if abs(diff_hours) >= threshold_hours:
-                print(f'The difference {int(diff_hours)} hours of {rows[i]} '
-                      f'and {rows[i + 1]} exceeds {threshold_hours} hours')
-                if diff_hours > 0:
-                    corr_index = i + 1
-                    corrected = rows[corr_index][1] + \
-                            timedelta(hours=int(diff_hours))
-                else:
-                    corr_index = i
-                    corrected = rows[corr_index][1] + \
-                            timedelta(hours=int(abs(diff_hours)) + 1)
-
-                print(f'Correcting timestamp of row ID {rows[corr_index][0]} '
-                      'to {corrected}')
-                cursor.execute('UPDATE weather_data SET time = %s WHERE id = %s',
-                               (corrected, rows[corr_index][0]))
-            i += 2
+    parser = argparse.ArgumentParser(description='Fixes weather data timestamps '
+                                     'which are off by many hours.')
+    parser.add_argument('--dbname', type=str, default='env_logger',
+                        help='name of the database (default: env_logger)')
+    parser.add_argument('--start', type=date.fromisoformat,
+                        help='first date (in YYYY-MM-DD format) of the rows to '
+                        'check, the recording time of the observation of a row is '
+                        'used as the time of the row can be wrong')
+    parser.add_argument('--end', type=date.fromisoformat,
+                        help='last date (in YYYY-MM-DD format) of the rows to '
+                        'check, compared with the recording time of the '
+                        'observation')
+    parser.add_argument('--threshold', type=int, default=3,
+                        help='minimum error in hours to fix (default: 3)')
+    parser.add_argument('--max-run', type=int, default=12,
+                        help='maximum number of consecutive erroneous rows fixed '
+                        'together, longer runs are skipped as ambiguous '
+                        '(default: 12)')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='number of rows to fix per update (default: 1000)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only report the errors, do not fix them')
+    parser.add_argument('--checkpoint-file', type=Path,
+                        default=Path('fix_weather_timestamp_errors.checkpoint'),
+                        help='file storing the progress of the fix')
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the checkpoint file and start from the beginning')
+    args = parser.parse_args()
+
+    start_id = 0 if args.restart or args.dry_run \
+        else read_checkpoint(args.checkpoint_file)
+    if start_id:
+        print(f'Resuming after row ID {start_id}')
+
+    fixed_count = 0
+    ambiguous_count = 0
+    fixes = []
+
+    with psycopg.connect(f'dbname={args.dbname}') as conn:
+        for row_id, time, before_time, after_time, corrected in \
+                find_errors(conn, args, start_id):
+            if not corrected:
+                print(f'Skipping row ID {row_id} with time {time}, the times '
+                      f'{before_time} before and {after_time} after its run do '
+                      'not tell which rows are wrong')
+                ambiguous_count += 1
+                continue
+
+            print(f'{"Would correct" if args.dry_run else "Correcting"} timestamp '
+                  f'of row ID {row_id} from {time} to {corrected} (before run '
+                  f'{before_time}, after run {after_time})')
+            fixes.append((row_id, corrected))
+
+            if len(fixes) == args.batch_size:
+                if not args.dry_run:
+                    apply_fixes(conn, fixes)
+                    args.checkpoint_file.write_text(str(row_id), encoding='utf-8')
+                fixed_count += len(fixes)
+                fixes = []
+
+        if fixes and not args.dry_run:
+            apply_fixes(conn, fixes)
+        fixed_count += len(fixes)
+
+    if not args.dry_run:
+        # The run is complete so the next one starts from the beginning
+        args.checkpoint_file.unlink(missing_ok=True)
+
+    print(f'{"Found" if args.dry_run else "Fixed"} {fixed_count} timestamp errors, '
+          f'skipped {ambiguous_count} ambiguous rows')
 
 
 if __name__ == '__main__':
@@ -700,24 +700,62 @@
                                             ["id = ?" obs-id]
                                             rs-opts))))
 
+(defn refresh-elec-rollups
+  "Refreshes the daily and monthly electricity consumption and cost rollups of
+  the days (in Helsinki time) of the electricity consumption rows with the given
+  IDs."
+  [db-con ids]
+  (doseq [{:keys [day]} (jdbc/execute! db-con
+                                       [(str "SELECT DISTINCT (time AT TIME ZONE "
+                                             "'Europe/Helsinki')::date AS day "
+                                             "FROM electricity_consumption "
+                                             "WHERE id = ANY(?)")
+                                        (int-array ids)]
+                                       rs-opts)]
+    (jdbc/execute-one! db-con
+                       ["SELECT refresh_electricity_rollup(?, ?, ?, ?, ?, ?)"
+                        day
+                        (:elec-contract-margin env)
+                        (:elec-transfer-fee env)
+                        (elec-tax-per-kwh-for-date
+                         (java.sql.Date/.toLocalDate day))
+                        (:elec-contract-base-fee env)
+                        (:elec-transfer-base-fee env)])))
+
 (defn insert-elec-consumption-data
-  "Inserts given electricity consumption data."
+  "Inserts given electricity consumption data. The consumption of an already
+  stored time is updated with the new value, if the data has several values
+  for a time the last one is used. The consumption and cost rollups of the
+  days of the data are refreshed."
   [db-con consumption-data]
   (jdbc/with-transaction [tx db-con]
     (try
-      (let [res (js/insert-multi! tx
+      (let [rows (vals (reduce (fn [rows [time _ :as row]]
+                                 (assoc rows time row))
+                               {}
+                               consumption-data))
+            res (js/insert-multi! tx
                                   :electricity_consumption
                                   [:time :consumption]
-                                  consumption-data
-                                  rs-opts)]
-        (if (= (count consumption-data) (count res))
-          true
+                                  rows
+                                  (assoc rs-opts
+                                         :suffix (str "ON CONFLICT (time) DO "
+                                                      "UPDATE SET consumption "
+                                                      "= EXCLUDED.consumption")))]
+        (if (= (count rows) (count res))
+          (do
+            (refresh-elec-rollups tx (map :id res))
+            true)
           (do
             (Connection/.rollback tx)
             false)))
       (catch PSQLException pe
         (error pe "Electricity consumption data insert failed")
         (Connection/.rollback tx)
+        false)
+      (catch clojure.lang.ExceptionInfo ei
+        (error ei "Electricity consumption rollup refresh failed")
+        (Connection/.rollback tx)
         false))))
 
 (defn get-latest-elec-consumption-record-time
@@ -697,6 +697,28 @@
                                         (sql/format
                                          {:select [:%count.id]
                                           :from :electricity_consumption})))))
+      (testing "overlapping data updates the stored consumption"
+        (is (true? (insert-elec-consumption-data
+                    test-ds
+                    [[(jt/plus current-dt (jt/hours 1)) 0.2]
+                     [(jt/plus current-dt (jt/hours 2)) 0.3]
+                     [(jt/plus current-dt (jt/hours 2)) 0.35]])))
+        (is (every? true?
+                    (map #(rel= %1 (:consumption %2) :tol 0.001)
+                         [0.1 0.2 0.35]
+                         (jdbc/execute! test-ds
+                                        (sql/format
+                                         {:select [:consumption]
+                                          :from :electricity_consumption
+                                          :order-by [:time]})))))
+        (is (pos? (:count (jdbc/execute-one! test-ds
+                                             (sql/format
+                                              {:select [:%count.day]
+                                               :from :electricity_day_rollup})))))
+        (is (pos? (:count (jdbc/execute-one! test-ds
+                                             (sql/format
+                                              {:select [:%count.month]
+                                               :from :electricity_month_rollup}))))))
       (with-redefs [js/insert-multi! (fn [_ _ _ _ _]
                                        [{:id 1}])]
         (is (false? (insert-elec-consumption-data test-ds consumption-data))))
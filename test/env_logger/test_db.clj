@@ -34,6 +34,8 @@
   (jdbc/execute! test-ds (sql/format {:delete-from :electricity_price_minute}))
   (jdbc/execute! test-ds (sql/format {:delete-from :electricity_price}))
   (jdbc/execute! test-ds (sql/format {:delete-from :electricity_consumption}))
+  (jdbc/execute! test-ds (sql/format {:delete-from :electricity_day_rollup}))
+  (jdbc/execute! test-ds (sql/format {:delete-from :electricity_month_rollup}))
   (jdbc/execute! test-ds (sql/format {:delete-from :observations})))
 
 (defn seed-base-observation!
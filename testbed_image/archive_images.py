@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""A script for compacting and indexing the FMI Testbed image archive.
+
+The archive is processed one day directory and product at a time in parallel
+worker processes, the products and their image name prefixes are read from the
+configuration file of testbed_image.py. The images of a product are re-encoded
+losslessly into a smaller form, either in place as palette PNGs or as lossless
+WebP copies, and an animated time-lapse, a sprite of thumbnails and an index file
+describing them are created for each day. Only days with images newer than their
+index file or with images left pending by the previous run are processed. The
+hash index entries of images re-encoded in place are updated with the hashes of
+the new content.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+from io import BytesIO
+from os import cpu_count
+from pathlib import Path
+
+from PIL import Image, ImageChops
+
+from testbed_image import DAY_DIRECTORY_PATTERN, HashIndex, load_config
+
+logger = logging.getLogger(__name__)
+
+# Number of thumbnails per sprite row, one hour of five minute images
+SPRITE_COLUMNS = 12
+# Names of the files created per day and product
+INDEX_FILE = '{prefix}-index.json'
+TIMELAPSE_FILE = '{prefix}-timelapse.webp'
+SPRITE_FILE = '{prefix}-thumbnails.webp'
+
+
+def get_images(day_directory, prefix):
+    """Return the paths of the images of a product in a day directory.
+
+    The timestamp is matched too so that the images of a product whose prefix
+    starts with the prefix of another product are not included.
+    """
+    pattern = re.compile(rf'{re.escape(prefix)}-\d{{4}}-\d{{2}}-\d{{2}}T.+\.png')
+    return sorted(path for path in day_directory.glob(f'{prefix}-*.png')
+                  if pattern.fullmatch(path.name))
+
+
+def read_day_index(index_file):
+    """Return the index of the images of a day or an empty dict if it is missing."""
+    if not index_file.exists():
+        return {}
+
+    with index_file.open('r', encoding='utf-8') as index_fd:
+        return json.load(index_fd)
+
+
+def get_day_directories(directory, prefixes, since, force):
+    """Return the day directories and product prefixes which need processing.
+
+    A day needs processing when it has images newer than its index file or
+    images which were left pending by the previous run.
+    """
+    days = []
+
+    for day_directory in sorted(directory.iterdir()):
+        if not day_directory.is_dir() or \
+           not DAY_DIRECTORY_PATTERN.fullmatch(day_directory.name) or \
+           (since and date.fromisoformat(day_directory.name) < since):
+            continue
+
+        for prefix in prefixes:
+            index_file = day_directory / INDEX_FILE.format(prefix=prefix)
+            if force or not index_file.exists() or \
+               read_day_index(index_file).get('pending') or \
+               any(image.stat().st_mtime > index_file.stat().st_mtime
+                   for image in get_images(day_directory, prefix)):
+                days.append((day_directory, prefix))
+
+    return days
+
+
+def to_palette(image):
+    """Return the image in palette mode or None if it has too many colours."""
+    if image.mode == 'P':
+        return image
+
+    rgba_image = image.convert('RGBA')
+    if not rgba_image.getcolors(256):
+        return None
+
+    palette_image = rgba_image.quantize(colors=256)
+    # Quantization is not guaranteed to keep the exact colours
+    if ImageChops.difference(palette_image.convert('RGBA'),
+                             rgba_image).getbbox():
+        return None
+
+    return palette_image
+
+
+def transcode_image(path, output_format):
+    """Re-encode an image losslessly.
+
+    A palette PNG replaces the original image only if it is smaller, a WebP
+    image is written next to the original image. Returns the number of saved
+    bytes and the SHA-256 hash of the replaced image, which is None if the
+    image was not replaced.
+    """
+    with Image.open(path) as image:
+        if output_format == 'webp':
+            webp_path = path.with_suffix('.webp')
+            image.save(webp_path, 'WEBP', lossless=True, method=6)
+            return path.stat().st_size - webp_path.stat().st_size, None
+
+        palette_image = to_palette(image) or image
+        output = BytesIO()
+        palette_image.save(output, 'PNG', optimize=True)
+
+    saved_bytes = path.stat().st_size - output.tell()
+    if saved_bytes <= 0:
+        return 0, None
+
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_bytes(output.getbuffer())
+    tmp_path.replace(path)
+    return saved_bytes, hashlib.sha256(output.getbuffer()).hexdigest()
+
+
+def create_sprite(images, thumbnail_width, quality):
+    """Create a sprite of the thumbnails of the images.
+
+    Returns the sprite and the size of a thumbnail.
+    """
+    width, height = images[0].size
+    thumbnail_size = (thumbnail_width, round(height * thumbnail_width / width))
+    rows = (len(images) + SPRITE_COLUMNS - 1) // SPRITE_COLUMNS
+    sprite = Image.new('RGB', (thumbnail_size[0] * min(len(images), SPRITE_COLUMNS),
+                               thumbnail_size[1] * rows), 'white')
+
+    for index, image in enumerate(images):
+        row, column = divmod(index, SPRITE_COLUMNS)
+        thumbnail = image.convert('RGBA').resize(thumbnail_size,
+                                                 Image.Resampling.LANCZOS)
+        # Use the alpha channel as the mask so that transparent areas stay white
+        sprite.paste(thumbnail, (column * thumbnail_size[0], row * thumbnail_size[1]),
+                     thumbnail)
+
+    output = BytesIO()
+    sprite.save(output, 'WEBP', quality=quality)
+    return output, thumbnail_size
+
+
+def process_day(day_directory, prefix, options):
+    """Transcode the new images of a product of a day and create the time-lapse.
+
+    A sprite and an index file are created as well. The index lists the
+    transcoded images, images listed in the keep option are not transcoded but
+    left pending for a later run. Returns the number of images, the number of
+    bytes saved by transcoding and a dict of the new hashes of the images replaced
+    in place by their path relative to the archive.
+    """
+    index_file = day_directory / INDEX_FILE.format(prefix=prefix)
+    previous_index = {} if options['force'] else read_day_index(index_file)
+    paths = get_images(day_directory, prefix)
+    if not paths:
+        return 0, 0, {}
+
+    if 'transcoded' in previous_index:
+        transcoded = set(previous_index['transcoded'])
+    else:
+        # Indexes written before the transcoded images were listed
+        index_mtime = index_file.stat().st_mtime if previous_index else 0
+        transcoded = {path.name for path in paths
+                      if path.stat().st_mtime <= index_mtime}
+
+    saved_bytes = 0
+    hashes = {}
+    pending = []
+    for path in paths:
+        relative_path = f'{day_directory.name}/{path.name}'
+        if path.name in transcoded:
+            continue
+        if relative_path in options['keep']:
+            pending.append(path.name)
+            continue
+        path_saved_bytes, digest = transcode_image(path, options['format'])
+        saved_bytes += path_saved_bytes
+        transcoded.add(path.name)
+        if digest:
+            hashes[relative_path] = digest
+
+    timelapse_file = TIMELAPSE_FILE.format(prefix=prefix)
+    sprite_file = SPRITE_FILE.format(prefix=prefix)
+    images = [Image.open(path) for path in paths]
+    try:
+        images[0].save(day_directory / timelapse_file, 'WEBP', save_all=True,
+                       append_images=images[1:], duration=options['duration'],
+                       loop=0, quality=options['quality'])
+        sprite, thumbnail_size = create_sprite(images, options['thumbnail_width'],
+                                               options['quality'])
+    finally:
+        for image in images:
+            image.close()
+    (day_directory / sprite_file).write_bytes(sprite.getbuffer())
+
+    index = {'day': day_directory.name,
+             'timelapse': timelapse_file,
+             'sprite': sprite_file,
+             'thumbnail_size': thumbnail_size,
+             'columns': SPRITE_COLUMNS,
+             'images': [path.name for path in paths],
+             'transcoded': sorted(transcoded & {path.name for path in paths}),
+             'pending': pending}
+    tmp_file = index_file.with_suffix('.tmp')
+    with tmp_file.open('w', encoding='utf-8') as index_fd:
+        json.dump(index, index_fd, indent=2)
+    tmp_file.replace(index_file)
+
+    return len(paths), saved_bytes, hashes
+
+
+def update_hash_index(hash_index, hashes):
+    """Replace the hashes of re-encoded images in a hash index.
+
+    Only images already in the index are updated.
+    """
+    updated_count = hash_index.update(hashes, existing_only=True)
+    if updated_count:
+        logger.info('Updated the hashes of %s re-encoded images', updated_count)
+
+
+def main():
+    """Run the module code."""
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Compacts the FMI Testbed image '
+                                     'archive and creates daily time-lapses and '
+                                     'thumbnail sprites.')
+    parser.add_argument('directory', type=Path,
+                        help='archive directory containing the day directories')
+    parser.add_argument('--config', type=str,
+                        help='TOML configuration file of testbed_image.py to read '
+                        'the products from (default: testbed_image_config.toml)')
+    parser.add_argument('--format', choices=['png', 'webp'], default='png',
+                        help='png: replace images with smaller palette PNGs, '
+                        'webp: write lossless WebP copies of images (default: png)')
+    parser.add_argument('--since', type=date.fromisoformat,
+                        help='only process days from this date (in YYYY-MM-DD '
+                        'format) onwards')
+    parser.add_argument('--force', action='store_true',
+                        help='process all days even if they have not changed')
+    parser.add_argument('--duration', type=int, default=200,
+                        help='time-lapse frame duration in milliseconds '
+                        '(default: 200)')
+    parser.add_argument('--thumbnail-width', type=int, default=160,
+                        help='thumbnail width in pixels (default: 160)')
+    parser.add_argument('--quality', type=int, default=80,
+                        help='WebP quality of time-lapses and sprites (default: 80)')
+    parser.add_argument('--workers', type=int, default=cpu_count(),
+                        help='number of worker processes (default: number of CPUs)')
+
+    args = parser.parse_args()
+    if not args.directory.is_dir():
+        logger.error('Could not find archive directory: %s', args.directory)
+        sys.exit(1)
+
+    products = {product['prefix']: product
+                for product in load_config(args.config or
+                                           'testbed_image_config.toml')['products']}
+    # The most recent image of a product is not re-encoded in place as its hash is
+    # compared against the next captured image to detect duplicates
+    last_paths = {max(hashes) for hashes in
+                  (HashIndex(product['hash_index']).load()
+                   for product in products.values()) if hashes} \
+        if args.format == 'png' else set()
+    options = {'format': args.format, 'force': args.force,
+               'duration': args.duration, 'quality': args.quality,
+               'thumbnail_width': args.thumbnail_width, 'keep': last_paths}
+    days = get_day_directories(args.directory, products, args.since, args.force)
+    logger.info('Processing %s product days', len(days))
+
+    failed_days = []
+    new_hashes = {prefix: {} for prefix in products}
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(process_day, day_directory, prefix, options):
+                   (day_directory, prefix) for day_directory, prefix in days}
+        for future in as_completed(futures):
+            day_directory, prefix = futures[future]
+            try:
+                image_count, saved_bytes, hashes = future.result()
+            except Exception:
+                logger.exception('Processing of day %s of %s failed',
+                                 day_directory.name, prefix)
+                failed_days.append(day_directory.name)
+                continue
+            new_hashes[prefix].update(hashes)
+            logger.info('Processed %s %s images of %s, transcoding saved %s bytes',
+                        image_count, prefix, day_directory.name, saved_bytes)
+
+    # The indexes are updated in the main process as the workers run in parallel
+    for prefix, hashes in new_hashes.items():
+        if hashes:
+            update_hash_index(HashIndex(products[prefix]['hash_index']), hashes)
+
+    if failed_days:
+        logger.error('Processing failed for %s days', len(failed_days))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Tests for the testbed_image module."""
+
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest.mock import patch
+from urllib.parse import parse_qs
+
+import httpx
+
+import testbed_image
+
+PAGE_URL = 'https://testbed.example.com/?imgtype=radar'
+IMAGE_URL = 'https://testbed.example.com/radar.png'
+ENV_LOGGER_URL = 'https://env-logger.example.com'
+AUTH_URL = 'https://auth.example.com/token'
+IMAGE = b'radar image'
+
+
+class TestbedServer:
+    """Fake Testbed and env-logger servers answering with cache validators."""
+
+    def __init__(self):
+        """Class constructor."""
+        self.registration_ok = True
+        self.registered_names = []
+        self.handlers = {PAGE_URL: self.get_page,
+                         IMAGE_URL: self.get_image,
+                         AUTH_URL: self.get_token,
+                         f'{ENV_LOGGER_URL}/obs/tb-image': self.register}
+
+    def handle(self, request):
+        """Return the response to a request."""
+        handler = self.handlers.get(str(request.url))
+        return handler(request) if handler else httpx.Response(404)
+
+    @staticmethod
+    def get_page(request):
+        """Return the Testbed page."""
+        if request.headers.get('If-None-Match') == '"page"':
+            return httpx.Response(304)
+        return httpx.Response(
+            200, headers={'ETag': '"page"'},
+            text=f'<img id="{testbed_image.IMAGE_ELEMENT_ID}" src="{IMAGE_URL}">')
+
+    @staticmethod
+    def get_image(request):
+        """Return the Testbed image."""
+        if request.headers.get('If-None-Match') == '"image"':
+            return httpx.Response(304)
+        return httpx.Response(200, headers={'ETag': '"image"'}, content=IMAGE)
+
+    @staticmethod
+    def get_token(_request):
+        """Return an access token."""
+        return httpx.Response(200, json={'access_token': 'token'})
+
+    def register(self, request):
+        """Register an image name unless registration is set to fail."""
+        if not self.registration_ok:
+            return httpx.Response(500)
+        self.registered_names.extend(
+            parse_qs(request.content.decode('utf-8'))['name'])
+        return httpx.Response(200)
+
+
+class CaptureTest(unittest.IsolatedAsyncioTestCase):
+    """Tests for capturing, storing and registering images."""
+
+    def setUp(self):
+        """Create the configuration and the fake servers."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        self.config = {
+            'storage': {'type': 'local', 'directory': str(self.directory / 'images')},
+            'products': [{**testbed_image.DEFAULT_PRODUCT,
+                          'url': PAGE_URL,
+                          'hash_index': str(self.directory / 'hashes.txt'),
+                          'element_id': testbed_image.IMAGE_ELEMENT_ID,
+                          'timeout': 30}],
+            'max_connections': 1,
+            'env_logger': {'enabled': True, 'url': ENV_LOGGER_URL},
+            'auth': {'token_endpoint': AUTH_URL, 'client_id': 'id',
+                     'client_secret': 'secret'}}
+        self.server = TestbedServer()
+        transport = httpx.MockTransport(self.server.handle)
+        async_client = httpx.AsyncClient
+        client_patch = patch.object(
+            httpx, 'AsyncClient',
+            lambda **kwargs: async_client(transport=transport, **kwargs))
+        client_patch.start()
+        self.addCleanup(client_patch.stop)
+
+    async def run_capture(self, timestamp):
+        """Run a capture with a freshly loaded HTTP cache like a cron run."""
+        http_cache = testbed_image.HttpCache(self.directory / 'http_cache.json')
+        return await testbed_image.capture(self.config, http_cache, timestamp)
+
+    async def test_failed_registration_is_retried(self):
+        """An image whose registration failed is stored and registered again."""
+        timestamp = datetime(2026, 10, 19, 12, 0, tzinfo=testbed_image.HELSINKI_TZ)
+        self.server.registration_ok = False
+        self.assertFalse(await self.run_capture(timestamp))
+        self.assertEqual(testbed_image.HashIndex(
+            self.config['products'][0]['hash_index']).load(), {})
+
+        # The page is not modified and would return a 304 for the image too
+        self.server.registration_ok = True
+        self.assertTrue(await self.run_capture(timestamp + timedelta(minutes=5)))
+
+        name = 'testbed-2026-10-19T12:05+0300.png'
+        self.assertEqual(self.server.registered_names, [name])
+        self.assertEqual((self.directory / 'images' / '2026-10-19' / name)
+                         .read_bytes(), IMAGE)
+        self.assertIn(f'2026-10-19/{name}', testbed_image.HashIndex(
+            self.config['products'][0]['hash_index']).load())
+
+    async def test_unchanged_image_is_skipped(self):
+        """A registered image is not stored again when it has not changed."""
+        timestamp = datetime(2026, 10, 19, 12, 0, tzinfo=testbed_image.HELSINKI_TZ)
+        self.assertTrue(await self.run_capture(timestamp))
+        self.assertTrue(await self.run_capture(timestamp + timedelta(minutes=5)))
+
+        self.assertEqual(len(self.server.registered_names), 1)
+        self.assertEqual(sorted(path.name for path in
+                                (self.directory / 'images').glob('*/*.png')),
+                         ['testbed-2026-10-19T12:00+0300.png'])
+
+
+if __name__ == '__main__':
+    unittest.main()
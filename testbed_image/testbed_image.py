@@ -1,70 +1,632 @@
 #!/usr/bin/env python3
-"""A script for downloading the current FMI Testbed image.
+"""A script for storing the current FMI Testbed images.
 
-Prints an empty string on failure and a filename where the latest Testbed image
-is stored on success.
+The images of the configured Testbed products are fetched concurrently and
+stored into a local directory or over SFTP to a remote server, in both cases
+into a subdirectory per day. The name of the stored image of one product is
+optionally registered with the env-logger backend. Images identical to the
+previously stored image of the product are skipped using an index of image
+content hashes, the index can also be built for an existing archive to find
+duplicate images in it. The Testbed pages and images are fetched with
+conditional requests so that unchanged responses are neither downloaded nor
+parsed again.
 """
 
+import argparse
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import re
 import sys
+import tomllib
+from contextlib import contextmanager
 from datetime import datetime
-from pathlib import Path
+from html.parser import HTMLParser
+from pathlib import Path, PurePosixPath
 from zoneinfo import ZoneInfo
 
-import requests
-from bs4 import BeautifulSoup
+import httpx
+import paramiko
 
+logger = logging.getLogger(__name__)
+HELSINKI_TZ = ZoneInfo('Europe/Helsinki')
 
-def download_image():
-    """Download the latest FMI Testbed image.
+# Product captured when no products are configured
+DEFAULT_PRODUCT = {'name': 'radar',
+                   'url': 'https://testbed.fmi.fi/?imgtype=radar&t=5&n=1',
+                   'prefix': 'testbed',
+                   'hash_index': 'image_hashes.txt',
+                   'register': True}
+# Name prefix of the images the env-logger backend accepts
+REGISTERED_PREFIX = 'testbed'
+# ID of the image element on the Testbed pages
+IMAGE_ELEMENT_ID = 'anim_image_anim_anim'
+# Size of the chunks in which the image is downloaded
+CHUNK_SIZE = 64 * 1024
+# Pattern of the day directories of the image archive
+DAY_DIRECTORY_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
 
-    Returns the image data on success and None otherwise.
+
+class HttpCache:
+    """Class for caching the validators of HTTP responses on disk.
+
+    The ETag and Last-Modified values of each URL are stored together with data
+    derived from the response, so that an unchanged response does not need to be
+    downloaded or processed again.
     """
-    timestamp = datetime.now(tz=ZoneInfo('Europe/Helsinki')).isoformat()
-    try:
-        resp = requests.get('https://testbed.fmi.fi/?imgtype=radar&t=5&n=1', timeout=10)
-    except requests.ConnectionError as ce:
-        print(f'{timestamp}: Failed to access Testbed page: {ce}',
-              file=sys.stderr)
-        return None
 
-    if not resp.ok:
-        return None
+    def __init__(self, path):
+        """Class constructor."""
+        self._path = Path(path)
+        try:
+            with self._path.open('r', encoding='utf-8') as cache_file:
+                self._entries = json.load(cache_file)
+        except FileNotFoundError:
+            self._entries = {}
+
+    def get(self, url):
+        """Return the cached entry of a URL or an empty dict."""
+        return self._entries.get(url, {})
+
+    def get_headers(self, url):
+        """Return the conditional request headers of a URL."""
+        entry = self.get(url)
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        return headers
+
+    def put(self, url, resp, **data):
+        """Store the validators of a response and data derived from it."""
+        self._entries[url] = {'etag': resp.headers.get('ETag'),
+                              'last_modified': resp.headers.get('Last-Modified'),
+                              **data}
+
+    def remove(self, url):
+        """Remove the entry of a URL."""
+        self._entries.pop(url, None)
+
+    def save(self):
+        """Save the cache."""
+        # Write into a temporary file first so that a partial cache is never read
+        tmp_path = self._path.with_suffix('.tmp')
+        with tmp_path.open('w', encoding='utf-8') as cache_file:
+            json.dump(self._entries, cache_file, indent=2)
+        tmp_path.replace(self._path)
+
+
+class ImageUrlParser(HTMLParser):
+    """Parser finding the source URL of the image element of a Testbed page."""
+
+    def __init__(self, element_id):
+        """Class constructor."""
+        super().__init__()
+        self.element_id = element_id
+        self.image_url = None
+
+    def handle_starttag(self, tag, attrs):
+        """Store the source URL of the image element."""
+        attrs = dict(attrs)
+        if tag == 'img' and attrs.get('id') == self.element_id:
+            self.image_url = attrs.get('src')
+
+
+class HashIndex:
+    """Class for an index of the SHA-256 hashes of stored images.
+
+    The index is a text file in the sha256sum output format with one line per
+    image, sorted by the image path. As the image names contain their timestamp
+    the last line is the most recently stored image. Changes to the index are made
+    while holding a lock file so that the capture and archive processing scripts
+    do not lose each other's changes.
+    """
+
+    def __init__(self, path):
+        """Class constructor."""
+        self._path = Path(path)
+        self._lock_path = self._path.with_name(f'{self._path.name}.lock')
+
+    @contextmanager
+    def _locked(self):
+        """Hold an exclusive lock of the index for the duration of the block.
+
+        A separate lock file is used as the index file is replaced when saved.
+        """
+        with self._lock_path.open('a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def get_last_hash(self):
+        """Return the hash of the most recently stored image or None."""
+        if not self._path.exists():
+            return None
+
+        with self._path.open('rb') as index_file:
+            # Only read the end of the file as the index grows without a limit
+            index_file.seek(max(index_file.seek(0, 2) - 1024, 0))
+            lines = index_file.read().splitlines()
+
+        return lines[-1].decode('utf-8').split()[0] if lines else None
+
+    def add(self, digest, path):
+        """Add the hash of a stored image."""
+        with self._locked(), self._path.open('a', encoding='utf-8') as index_file:
+            index_file.write(f'{digest}  {path}\n')
+
+    def load(self):
+        """Return the index as a dict of hashes by image path."""
+        if not self._path.exists():
+            return {}
+
+        with self._path.open('r', encoding='utf-8') as index_file:
+            return {path: digest for digest, path in
+                    (line.split(maxsplit=1) for line in index_file.read().splitlines())}
+
+    def update(self, hashes, existing_only=False):
+        """Merge a dict of hashes by image path into the index.
+
+        The index is read again while holding the lock so that hashes added in
+        the meantime are kept. Optionally only the hashes of the images already
+        in the index are replaced. Returns the number of changed hashes.
+        """
+        with self._locked():
+            index_hashes = self.load()
+            changed = {path: digest for path, digest in hashes.items()
+                       if (path in index_hashes or not existing_only) and
+                       index_hashes.get(path) != digest}
+            if changed:
+                self._write(index_hashes | changed)
+
+        return len(changed)
 
-    bs = BeautifulSoup(resp.text, 'lxml')
-    images = bs.find_all(id='anim_image_anim_anim')
+    def _write(self, hashes):
+        """Replace the index with a dict of hashes by image path."""
+        # Write into a temporary file first so that a partial index is never read
+        tmp_path = self._path.with_suffix('.tmp')
+        with tmp_path.open('w', encoding='utf-8') as index_file:
+            index_file.writelines(f'{hashes[path]}  {path}\n'
+                                  for path in sorted(hashes))
+        tmp_path.replace(self._path)
 
-    if len(images) != 1:
+
+class LocalStorage:
+    """Stores images into a local directory."""
+
+    def __init__(self, config):
+        """Create the storage."""
+        self.directory = Path(config['directory'])
+
+    def __enter__(self):
+        """Enter the runtime context."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Exit the runtime context."""
+
+    def store(self, day, name, image):
+        """Store an image.
+
+        The image is written under a temporary name and renamed when complete.
+        """
+        day_directory = self.directory / day
+        day_directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = day_directory / f'{name}.part'
+
+        tmp_path.write_bytes(image)
+        tmp_path.replace(day_directory / name)
+
+    def list_images(self, prefix):
+        """Return the paths of the stored images relative to the storage directory."""
+        return [f'{path.parent.name}/{path.name}'
+                for path in self.directory.glob(f'*/{prefix}-*.png')
+                if DAY_DIRECTORY_PATTERN.fullmatch(path.parent.name)]
+
+    def read(self, path):
+        """Return the content of a stored image."""
+        return (self.directory / path).read_bytes()
+
+
+class SftpStorage:
+    """Stores images on a remote server over a single SFTP connection."""
+
+    def __init__(self, config):
+        """Create the storage."""
+        self.config = config
+        self.directory = PurePosixPath(config['directory'])
+        self.client = None
+        self.sftp = None
+
+    def __enter__(self):
+        """Open the SSH connection and the SFTP session."""
+        self.client = paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        self.client.connect(self.config['host'], port=self.config.get('port', 22),
+                            username=self.config['username'],
+                            key_filename=self.config.get('key_filename'),
+                            timeout=10)
+        self.sftp = self.client.open_sftp()
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the SFTP session and the SSH connection."""
+        if self.sftp:
+            self.sftp.close()
+        self.client.close()
+
+    def store(self, day, name, image):
+        """Store an image.
+
+        The image is written under a temporary name and renamed when complete.
+        """
+        day_directory = self.directory / day
+        try:
+            self.sftp.stat(str(day_directory))
+        except FileNotFoundError:
+            self.sftp.mkdir(str(day_directory))
+        tmp_path = str(day_directory / f'{name}.part')
+
+        with self.sftp.open(tmp_path, 'wb') as image_file:
+            # Do not wait for the server to acknowledge each write
+            image_file.set_pipelined()
+            image_file.write(image)
+        self.sftp.posix_rename(tmp_path, str(day_directory / name))
+
+    def list_images(self, prefix):
+        """Return the paths of the stored images relative to the storage directory."""
+        return [f'{day}/{name}'
+                for day in self.sftp.listdir(str(self.directory))
+                if DAY_DIRECTORY_PATTERN.fullmatch(day)
+                for name in self.sftp.listdir(str(self.directory / day))
+                if name.startswith(f'{prefix}-') and name.endswith('.png')]
+
+    def read(self, path):
+        """Return the content of a stored image."""
+        with self.sftp.open(str(self.directory / path), 'rb') as image_file:
+            image_file.prefetch()
+            return image_file.read()
+
+
+STORAGES = {'local': LocalStorage,
+            'sftp': SftpStorage}
+
+
+async def get_image_url(client, http_cache, product):
+    """Return the URL of the latest image of a product or None on failure.
+
+    The URL is taken from the cache when the page has not changed. Otherwise the
+    page is parsed as it is streamed and the rest of the page is not downloaded
+    once the image element has been found.
+    """
+    url = product['url']
+    parser = ImageUrlParser(product['element_id'])
+
+    async with client.stream('GET', url, headers=http_cache.get_headers(url)) as resp:
+        if resp.status_code == httpx.codes.NOT_MODIFIED and \
+           http_cache.get(url).get('image_url'):
+            return http_cache.get(url)['image_url']
+
+        if not resp.is_success:
+            logger.error('Testbed page request of product %s failed with status %s',
+                         product['name'], resp.status_code)
+            return None
+
+        async for chunk in resp.aiter_text():
+            parser.feed(chunk)
+            if parser.image_url:
+                break
+
+    if not parser.image_url:
+        logger.error('Could not find the image of product %s on the Testbed page',
+                     product['name'])
         return None
-    img_url = images[0]['src']
 
-    if not img_url:
+    http_cache.put(url, resp, image_url=parser.image_url)
+    return parser.image_url
+
+
+async def download_image(client, http_cache, image_url):
+    """Download the image from the URL.
+
+    Returns the image data and its SHA-256 hash. The data and hash are None when
+    the image has not changed since it was last downloaded.
+    """
+    digest = hashlib.sha256()
+    chunks = []
+
+    async with client.stream('GET', image_url,
+                             headers=http_cache.get_headers(image_url)) as resp:
+        if resp.status_code == httpx.codes.NOT_MODIFIED:
+            return None, None
+
+        resp.raise_for_status()
+        async for chunk in resp.aiter_bytes(chunk_size=CHUNK_SIZE):
+            digest.update(chunk)
+            chunks.append(chunk)
+
+    http_cache.put(image_url, resp)
+    return b''.join(chunks), digest.hexdigest()
+
+
+async def capture_product(client, http_cache, product):
+    """Fetch the latest image of a product within the timeout of the product.
+
+    Returns the image URL, data and SHA-256 hash on success and None otherwise.
+    """
+    try:
+        async with asyncio.timeout(product['timeout']):
+            image_url = await get_image_url(client, http_cache, product)
+            if not image_url:
+                return None
+
+            return image_url, *await download_image(client, http_cache, image_url)
+    except TimeoutError:
+        logger.error('Fetching the image of product %s timed out',  # noqa: TRY400
+                     product['name'])
+    except httpx.HTTPError:
+        logger.exception('Failed to fetch the image of product %s', product['name'])
+
+    return None
+
+
+def store_image(storage, product, image, timestamp):
+    """Store the image unless it is identical to the previously stored image.
+
+    Returns the name of the stored image, an empty string for a duplicate image
+    and None on failure. The hash of the image is not added to the hash index
+    here as the image may still need to be registered.
+    """
+    _, data, digest = image
+    hash_index = HashIndex(product['hash_index'])
+    if digest == hash_index.get_last_hash():
+        logger.info('Image of product %s is identical to the previous image, '
+                    'skipping it', product['name'])
+        return ''
+
+    day = timestamp.strftime('%Y-%m-%d')
+    name = f'{product["prefix"]}-{timestamp.strftime("%Y-%m-%dT%H:%M%z")}.png'
+    try:
+        storage.store(day, name, data)
+    except OSError:
+        logger.exception('Failed to store the image of product %s', product['name'])
         return None
 
+    return name
+
+
+def store_images(config, images, timestamp, http_cache):
+    """Store the new images of the products over a single storage connection.
+
+    The cache entries of images which could not be stored are removed so that
+    they are downloaded again on the next run. Returns a dict of the stored
+    image names by product name, the name is an empty string for a skipped
+    image and None on failure.
+    """
+    names = {}
+    new_images = {}
+    for product, image in zip(config['products'], images, strict=True):
+        if not image:
+            names[product['name']] = None
+        elif not image[1]:
+            logger.info('Image of product %s has not changed since the previous '
+                        'run, skipping it', product['name'])
+            names[product['name']] = ''
+        else:
+            new_images[product['name']] = (product, image)
+    if not new_images:
+        return names
+
     try:
-        resp = requests.get(img_url, timeout=10)
-    except requests.ConnectionError as ce:
-        print(f'{timestamp}: Failed to download Testbed image: {ce}',
-              file=sys.stderr)
+        with STORAGES[config['storage']['type']](config['storage']) as storage:
+            for product, image in new_images.values():
+                names[product['name']] = store_image(storage, product, image,
+                                                     timestamp)
+    except (OSError, paramiko.SSHException):
+        logger.exception('Could not connect to the storage')
+        names.update(dict.fromkeys(new_images))
+
+    for name, (_, image) in new_images.items():
+        if names[name] is None:
+            http_cache.remove(image[0])
+        elif names[name]:
+            logger.info('Stored image %s', names[name])
+
+    return names
+
+
+def index_archive(storage, hash_index, prefix):
+    """Add the hashes of the archived images missing from the index.
+
+    Logs the groups of identical images and returns the number of duplicate
+    images, that is images identical to an earlier image.
+    """
+    new_paths = sorted(set(storage.list_images(prefix)) - hash_index.load().keys())
+    logger.info('Hashing %s archived images', len(new_paths))
+
+    hash_index.update({path: hashlib.sha256(storage.read(path)).hexdigest()
+                       for path in new_paths})
+    hashes = hash_index.load()
+
+    paths_by_hash = {}
+    for path in sorted(hashes):
+        paths_by_hash.setdefault(hashes[path], []).append(path)
+
+    duplicate_count = 0
+    for paths in paths_by_hash.values():
+        if len(paths) > 1:
+            logger.info('Identical images: %s', ', '.join(paths))
+            duplicate_count += len(paths) - 1
+
+    return duplicate_count
+
+
+async def get_access_token(client, config):
+    """Fetch JWT access token used for image name storage."""
+    resp = await client.post(config['auth']['token_endpoint'],
+                             data={'grant_type': 'client_credentials',
+                                   'client_id': config['auth']['client_id'],
+                                   'client_secret': config['auth']['client_secret']})
+    if not resp.is_success:
+        logger.error('JWT token fetch failed')
         return None
 
-    return resp.content
+    return resp.json()['access_token']
+
+
+async def register_image(client, config, name):
+    """Add the image name to the env-logger database.
+
+    Returns True on success and False otherwise.
+    """
+    try:
+        access_token = await get_access_token(client, config)
+        if not access_token:
+            return False
+
+        resp = await client.post(f'{config["env_logger"]["url"]}/obs/tb-image',
+                                 data={'name': name},
+                                 headers={'Bearer': access_token})
+    except httpx.HTTPError:
+        logger.exception('Image name registration failed')
+        return False
+
+    if not resp.is_success:
+        logger.error('Image name registration failed with status %s',
+                     resp.status_code)
+        return False
+
+    return True
+
+
+async def capture(config, http_cache, timestamp):
+    """Capture the images of all products and register the configured image.
 
+    The products are fetched concurrently over a shared connection pool and the
+    images are then stored over a single storage connection. The hash of an image
+    is added to the hash index only after it has been both stored and registered.
+    When the registration fails the cache entry of the image is removed as well,
+    so that the image is downloaded, stored and registered again on the next run
+    instead of being skipped as unchanged or as a duplicate. Returns True when all
+    products were handled successfully and False otherwise.
+    """
+    async with httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=config['max_connections']),
+            follow_redirects=True, timeout=10) as client:
+        images = await asyncio.gather(*(capture_product(client, http_cache, product)
+                                        for product in config['products']))
+        names = await asyncio.to_thread(store_images, config, images, timestamp,
+                                        http_cache)
+
+        success = None not in names.values()
+        register = config['env_logger'].get('enabled', False)
+        for product, image in zip(config['products'], images, strict=True):
+            name = names[product['name']]
+            if not name:
+                continue
+            if register and product['register'] and \
+               not await register_image(client, config, name):
+                http_cache.remove(image[0])
+                success = False
+                continue
+            HashIndex(product['hash_index']).add(
+                image[2], f'{timestamp.strftime("%Y-%m-%d")}/{name}')
+
+        # The cache is only saved once the images are stored and registered so
+        # that failed images are downloaded again on the next run
+        await asyncio.to_thread(http_cache.save)
+
+    return success
+
+
+def load_config(config_file):
+    """Load the TOML configuration file.
+
+    Exits if the file does not exist or can not be parsed.
+    """
+    if not Path(config_file).is_file():
+        logger.error('Could not find configuration file: %s', config_file)
+        sys.exit(1)
 
-def main():  # noqa: RET503
+    with Path(config_file).open('rb') as conf_file:
+        try:
+            config = tomllib.load(conf_file)
+        except tomllib.TOMLDecodeError:
+            logger.exception('Could not parse configuration file')
+            sys.exit(1)
+
+    if config['storage'].get('type') not in STORAGES:
+        logger.error('Invalid storage type, must be one of: %s',
+                     ', '.join(STORAGES))
+        sys.exit(1)
+
+    config['products'] = [{'prefix': product.get('name'),
+                           'hash_index': f'{product.get("name")}_hashes.txt',
+                           'element_id': IMAGE_ELEMENT_ID,
+                           'timeout': 30,
+                           'register': False,
+                           **product}
+                          for product in config.get('products', [DEFAULT_PRODUCT])]
+    config.setdefault('max_connections', 10)
+
+    if any('name' not in product or 'url' not in product
+           for product in config['products']):
+        logger.error('Each product must have a name and a URL')
+        sys.exit(1)
+    if len({product['name'] for product in config['products']}) != \
+       len(config['products']):
+        logger.error('Product names must be unique')
+        sys.exit(1)
+    registered = [product for product in config['products'] if product['register']]
+    if len(registered) > 1 or \
+       (registered and registered[0]['prefix'] != REGISTERED_PREFIX):
+        logger.error('Only one product can be registered and its prefix must be '
+                     '"%s"', REGISTERED_PREFIX)
+        sys.exit(1)
+
+    return config
+
+
+def main():
     """Run the module code."""
-    image = download_image()
-    if not image:
-        print()
-        return 1
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description="""Stores the current FMI Testbed images locally or on a remote
+        server. A configuration file named "testbed_image_config.toml" is used unless
+        provided with the --config flag.""")
+    parser.add_argument('--config', type=str,
+                        help='TOML configuration file to use')
+    parser.add_argument('--index-archive', action='store_true',
+                        help='add the hashes of all archived images to the hash '
+                        'indexes and report identical images instead of storing '
+                        'the current images')
 
-    helsinki_tz = ZoneInfo('Europe/Helsinki')
-    filename_dt = datetime.now(tz=helsinki_tz).strftime('%Y-%m-%dT%H:%M%z')
-    filename = f'testbed-{filename_dt}.png'
+    args = parser.parse_args()
+    config = load_config(args.config or 'testbed_image_config.toml')
+    timestamp = datetime.now(tz=HELSINKI_TZ)
 
-    with Path(filename).open('wb') as tb_image:
-        tb_image.write(image)
+    if args.index_archive:
+        try:
+            with STORAGES[config['storage']['type']](config['storage']) as storage:
+                for product in config['products']:
+                    duplicate_count = index_archive(
+                        storage, HashIndex(product['hash_index']), product['prefix'])
+                    logger.info('Found %s duplicate images of product %s',
+                                duplicate_count, product['name'])
+        except (OSError, paramiko.SSHException):
+            logger.exception('Archive indexing failed')
+            sys.exit(1)
+        return
 
-    print(filename)
+    http_cache = HttpCache(config.get('http_cache', 'http_cache.json'))
+    if not asyncio.run(capture(config, http_cache, timestamp)):
+        sys.exit(1)
 
 
-main()
+if __name__ == '__main__':
+    main()